@@ -2,6 +2,7 @@
 Talk to perlin opt
 
 Usage: src.main.opt_generate
+       src.main.opt_generate --trace 64 --request-rate 4 --max-batch-size 16
 
 NOTE: this script is WIP.
 """
@@ -17,6 +18,7 @@ import tqdm
 
 from ..utils import batch_to, get_bench, seed
 from ..models import perlin_opt
+from ..models.perlin_opt.engine import GenerationEngine, GenerationRequest, synthetic_trace, format_summary
 from ..models import perlin_attention
 from ..trainer.perlin_trainer import OptTrainer, add_perlin_model_options, parse_perlin_model_options
 from ..models.perlin_attention import modules as pmodules
@@ -104,19 +106,22 @@ def main(
         #         do_sample=True,
         #         stopping_criteria=StoppingCriteriaList(),
         #     )
-        input_ids = inputs.input_ids.to(trainer.device)
-        input_ids = input_ids.repeat(batch_size, 1)
-        while input_ids.size()[1] < max_length:
-            output = model.generate(
-                input_ids,
-                max_length=max_length,
-                use_cache=use_cache,
+        engine = GenerationEngine(model, max_batch_size=batch_size)
+        requests = [
+            GenerationRequest(
+                input_ids=inputs.input_ids[0].tolist(),
+                max_new_tokens=max(1, max_length - inputs.input_ids.shape[-1]),
+                request_id=i,
                 temperature=0.95,
-                do_sample=True,
-                stopping_criteria=StoppingCriteriaList(),
             )
-            input_ids = torch.cat([input_ids, output[:, input_ids.shape[1]:]], dim=1)
-            print(f'generated {input_ids.shape[1]} / {max_length}')
+            for i in range(batch_size)
+        ]
+        for req in requests:
+            engine.add_request(req)
+        while engine.has_work():
+            engine.step()
+        input_ids = torch.tensor([req.input_ids + req.output_ids for req in requests])
+        print(f'generated {input_ids.shape[1]} / {max_length}')
         
         end_mem = torch.cuda.max_memory_allocated()
         elapsed = time.time() - t
@@ -130,6 +135,19 @@ def main(
         if hasattr(m, 'benchmarking'):
             m.benchmarking = use_cache
     
+    if args.trace > 0:
+        requests = synthetic_trace(
+            num_requests=args.trace,
+            request_rate=args.request_rate,
+            prompt_length=(16, args.max_seq_len // 2),
+            new_tokens=(16, args.max_seq_len // 2),
+            vocab_size=model.config.vocab_size,
+            temperature=0.95,
+        )
+        engine = GenerationEngine(model, max_batch_size=args.max_batch_size)
+        print(format_summary(engine.run(requests)))
+        return
+    
     _, ids, generated_text = generate(sample_text)
     print('sample:', sample_text)
     print('generated:', generated_text, f'[{ids.shape[-1]}]')
@@ -159,6 +177,9 @@ if __name__ == '__main__':
     parser.add_argument('--model', type=str, default='opt-350m')
     parser.add_argument('--max-seq-len', type=int, default=768)
     parser.add_argument('--interactive', action='store_true')
+    parser.add_argument('--trace', type=int, default=0, help='number of requests of synthetic trace, runs continuous batching benchmark')
+    parser.add_argument('--request-rate', type=float, default=4.0)
+    parser.add_argument('--max-batch-size', type=int, default=16)
     add_perlin_model_options(
         parser, 
         nbf=8.0,
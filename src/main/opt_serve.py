@@ -0,0 +1,329 @@
+"""
+Serve perlin opt with continuous batching over local TCP socket.
+
+Protocol is JSON lines. Client sends one request per line,
+    {"input_ids": [...], "max_new_tokens": 64, "temperature": 0.0}
+    or {"prompt": "...", ...} when server has tokenizer,
+and server streams one line per generated token,
+    {"id": 0, "token": 1234, "text": "..."}
+and then the last line,
+    {"id": 0, "done": true, "tokens": 64, "ttft": 0.012, "elapsed": 0.5}
+Requests of a connection are served one by one, use many connections for concurrency.
+Invalid requests (empty input_ids, token ids out of vocab, max_new_tokens <= 0) are answered with
+    {"error": "..."}
+and requests of a failed decode step get {"id": 0, "error": "..."} instead of the done line. Requests
+of a disconnected client are dropped from the engine.
+
+Scheduling: requests are queued and admitted to GenerationEngine between decode steps. When the engine
+is idle, the scheduler waits `--batch-wait` ms to coalesce concurrent requests into a micro batch.
+When tokens reserved by queued and running requests exceed the KV budget (`--max-kv-tokens`), new
+requests wait before being queued, so clients see backpressure instead of unbounded queue.
+
+Usage: python -m src.main.opt_serve --tiny --port 8765
+       python -m src.main.opt_serve --model opt-125m --checkpoint ./saves/.../checkpoint.pth --port 8765
+"""
+
+import os
+import time
+import json
+import asyncio
+import argparse
+from typing import List
+
+import torch
+
+from ..models.perlin_opt.engine import GenerationEngine, GenerationRequest
+from ..models.perlin_opt.prefix_cache import PrefixCache
+
+class InferenceServer:
+    def __init__(
+        self,
+        model,
+        tokenizer=None,
+        max_batch_size: int = 16,
+        max_kv_tokens: int = 16384,
+        batch_wait: float = 0.005,
+        eos_token_id: int = None,
+        prefix_cache: PrefixCache = None,
+    ):
+        self.engine = GenerationEngine(
+            model,
+            max_batch_size=max_batch_size,
+            max_kv_tokens=max_kv_tokens,
+            eos_token_id=eos_token_id,
+            prefix_cache=prefix_cache,
+        )
+        self.tokenizer = tokenizer
+        self.max_kv_tokens = max_kv_tokens
+        self.batch_wait = batch_wait
+
+        self.pending = [] # type: List[GenerationRequest]
+        self.streams = {} # request_id -> (asyncio.Queue, number of streamed tokens)
+        self.cancelled = set() # request_id of disconnected clients, dropped by scheduler
+        config = getattr(model, 'config', None)
+        self.vocab_size = getattr(config, 'vocab_size', None)
+        self.next_request_id = 0
+        self.wakeup = None # type: asyncio.Event
+        self.capacity = None # type: asyncio.Condition
+        self.server = None
+        self.scheduler = None
+
+    def reserved_kv_tokens(self):
+        return self.engine.reserved_kv_tokens() +\
+            sum([req.max_length for req in self.engine.waiting]) +\
+            sum([req.max_length for req in self.pending])
+
+    def validate(self, req: GenerationRequest):
+        # NOTE: invalid requests would fail inside the scheduler, which serves every client
+        if len(req.input_ids) == 0:
+            raise Exception('input_ids is empty')
+        if req.max_new_tokens <= 0:
+            raise Exception(f'max_new_tokens should be positive, got {req.max_new_tokens}')
+        if req.temperature < 0 or req.top_k < 0:
+            raise Exception('temperature and top_k should not be negative')
+        if self.vocab_size is not None:
+            bad = [t for t in req.input_ids if t < 0 or t >= self.vocab_size]
+            if len(bad) > 0:
+                raise Exception(f'token ids out of vocab (size {self.vocab_size}): {bad[:8]}')
+
+    async def submit(self, req: GenerationRequest):
+        """
+        returns queue of streamed tokens. waits while KV budget is exhausted.
+        queue yields token ids, an Exception if generation failed, and then None.
+        """
+        self.validate(req)
+        if self.max_kv_tokens is not None:
+            if req.max_length > self.max_kv_tokens:
+                raise Exception(f'request is longer than kv budget, {req.max_length} > {self.max_kv_tokens}')
+            async with self.capacity:
+                await self.capacity.wait_for(
+                    lambda: (self.reserved_kv_tokens() + req.max_length) <= self.max_kv_tokens
+                )
+        req.request_id = self.next_request_id
+        self.next_request_id += 1
+        req.arrival_time = time.time()
+        queue = asyncio.Queue()
+        self.streams[req.request_id] = [queue, 0]
+        self.pending.append(req)
+        self.wakeup.set()
+        return queue
+
+    def flush_streams(self, requests: List[GenerationRequest]):
+        for req in requests:
+            stream = self.streams.get(req.request_id, None)
+            if stream is None:
+                continue
+            queue, sent = stream
+            for token in req.output_ids[sent:]:
+                queue.put_nowait(token)
+            stream[1] = len(req.output_ids)
+            if req.finished:
+                queue.put_nowait(None)
+                del self.streams[req.request_id]
+
+    def fail_streams(self, requests: List[GenerationRequest], ex: Exception):
+        for req in requests:
+            stream = self.streams.pop(req.request_id, None)
+            if stream is None:
+                continue
+            stream[0].put_nowait(Exception(f'generation failed: {ex}'))
+            stream[0].put_nowait(None)
+
+    def cancel(self, req: GenerationRequest):
+        """
+        drops request of disconnected client. engine is touched only by scheduler, so it is dropped there
+        """
+        self.streams.pop(req.request_id, None)
+        self.cancelled.add(req.request_id)
+        self.wakeup.set()
+
+    async def schedule(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self.engine.has_work():
+                if len(self.pending) == 0:
+                    self.wakeup.clear()
+                    await self.wakeup.wait()
+                # NOTE: coalesce concurrent requests into one micro batch
+                await asyncio.sleep(self.batch_wait)
+
+            # NOTE: engine is touched only here, model runs in executor without racing with submits
+            released = False
+            if len(self.cancelled) > 0:
+                self.pending = [req for req in self.pending if req.request_id not in self.cancelled]
+                released = len(self.engine.cancel(self.cancelled)) > 0
+                self.cancelled = set()
+            for req in self.pending:
+                self.engine.add_request(req)
+            self.pending = []
+            running = list(self.engine.running) + list(self.engine.waiting)
+
+            try:
+                await loop.run_in_executor(None, self.engine.step)
+                self.flush_streams(running)
+            except Exception as ex:
+                # NOTE: requests of the failed step are dropped, others keep being served
+                print(f'decode step failed ({len(running)} requests dropped): {ex!r}', flush=True)
+                self.fail_streams(running, ex)
+                self.engine.cancel([req.request_id for req in running])
+                released = True
+            if len(self.engine.finished) > 0:
+                self.engine.finished = []
+                released = True
+            if released:
+                async with self.capacity:
+                    self.capacity.notify_all()
+
+    def parse_request(self, line: bytes):
+        body = json.loads(line)
+        if 'input_ids' in body:
+            input_ids = [int(t) for t in body['input_ids']]
+        elif ('prompt' in body) and (self.tokenizer is not None):
+            input_ids = self.tokenizer(body['prompt']).input_ids
+        else:
+            raise Exception('request should have input_ids (or prompt if server has tokenizer)')
+        return GenerationRequest(
+            input_ids=input_ids,
+            max_new_tokens=int(body.get('max_new_tokens', 64)),
+            temperature=float(body.get('temperature', 0.0)),
+            top_k=int(body.get('top_k', 0)),
+        )
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        def send(obj):
+            writer.write((json.dumps(obj) + '\n').encode())
+        # NOTE: request which is being streamed, dropped when client disconnects
+        active = None
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if len(line.strip()) == 0:
+                    continue
+                try:
+                    req = self.parse_request(line)
+                    queue = await self.submit(req)
+                except Exception as ex:
+                    send({'error': str(ex)})
+                    await writer.drain()
+                    continue
+                active = req
+
+                failed = False
+                while True:
+                    token = await queue.get()
+                    if token is None:
+                        break
+                    if isinstance(token, Exception):
+                        send({'id': req.request_id, 'error': str(token)})
+                        await writer.drain()
+                        failed = True
+                        continue
+                    msg = {'id': req.request_id, 'token': token}
+                    if self.tokenizer is not None:
+                        msg['text'] = self.tokenizer.decode([token])
+                    send(msg)
+                    await writer.drain()
+                active = None
+                if failed:
+                    continue
+                send({
+                    'id': req.request_id,
+                    'done': True,
+                    'tokens': len(req.output_ids),
+                    'ttft': req.first_token_time - req.arrival_time,
+                    'elapsed': req.finish_time - req.arrival_time,
+                })
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            if active is not None and not active.finished:
+                self.cancel(active)
+            writer.close()
+
+    async def start(self, host: str = '127.0.0.1', port: int = 8765):
+        self.wakeup = asyncio.Event()
+        self.capacity = asyncio.Condition()
+        self.scheduler = asyncio.create_task(self.schedule())
+        self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        self.scheduler.cancel()
+
+def load_model(args):
+    if args.tiny:
+        from .tests.tiny_opt import build_tiny_model
+        model = build_tiny_model(args.method, device=args.device)
+        return model, None, None
+
+    from ..models import perlin_attention
+    from ..models.perlin_attention import modules as pmodules
+    from ..trainer.perlin_trainer import OptTrainer, parse_perlin_model_options
+    pmodules.BENCHMARKING = True
+    kwargs = parse_perlin_model_options(args)
+    trainer = OptTrainer(
+        subset=args.dataset,
+        model=args.model,
+        max_seq_len=args.max_seq_len,
+        skip_init_loaders=True,
+        **kwargs,
+    )
+    trainer.device = args.device
+    if args.checkpoint is None:
+        trainer.load()
+    else:
+        trainer.load(path=args.checkpoint)
+    model = trainer.model.to(trainer.device).eval()
+    perlin_attention.get_default_config().use_cache = True
+    for m in model.modules():
+        if hasattr(m, 'benchmarking'):
+            m.benchmarking = True
+    return model, trainer.tokenizer, trainer.tokenizer.eos_token_id
+
+def add_server_options(parser: argparse.ArgumentParser):
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--tiny', action='store_true', help='randomly initialized tiny perlin_opt on cpu')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--max-batch-size', type=int, default=16)
+    parser.add_argument('--max-kv-tokens', type=int, default=16384)
+    parser.add_argument('--batch-wait', type=float, default=5.0, help='ms')
+    parser.add_argument('--prefix-cache-mb', type=int, default=0, help='0 disables prefix cache')
+
+async def serve(args):
+    model, tokenizer, eos_token_id = load_model(args)
+    server = InferenceServer(
+        model,
+        tokenizer=tokenizer,
+        max_batch_size=args.max_batch_size,
+        max_kv_tokens=args.max_kv_tokens,
+        batch_wait=args.batch_wait / 1000,
+        eos_token_id=eos_token_id,
+        prefix_cache=PrefixCache(max_bytes=args.prefix_cache_mb * 1024 * 1024) if args.prefix_cache_mb > 0 else None,
+    )
+    port = await server.start(args.host, args.port)
+    print(f'serving on {args.host}:{port}', flush=True)
+    await server.server.serve_forever()
+
+if __name__ == '__main__':
+    from ..utils import seed
+    from ..trainer.perlin_trainer import add_perlin_model_options
+    seed()
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // 2))
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', type=str, default='wikitext2')
+    parser.add_argument('--checkpoint', type=str, default=None)
+    parser.add_argument('--model', type=str, default='opt-125m')
+    parser.add_argument('--max-seq-len', type=int, default=2048)
+    add_server_options(parser)
+    add_perlin_model_options(parser, context_output_method='mix', predictor_length=64, k=64)
+    args = parser.parse_args()
+    print(args)
+
+    asyncio.run(serve(args))
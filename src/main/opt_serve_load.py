@@ -0,0 +1,122 @@
+"""
+Load generator for opt_serve. Sends synthetic trace (poisson arrivals, random prompt and
+generation lengths) over concurrent connections, and reports client side throughput,
+time-to-first-token and time-per-output-token.
+
+With `--spawn-tiny`, server with tiny random perlin_opt on cpu is started in this process,
+so the whole path (socket, micro batching, backpressure, streaming) is tested end to end.
+
+Usage: python -m src.main.opt_serve_load --spawn-tiny --requests 32 --request-rate 16
+       python -m src.main.opt_serve_load --port 8765 --requests 64 --request-rate 4
+"""
+
+import time
+import json
+import asyncio
+import argparse
+
+from ..models.perlin_opt.engine import synthetic_trace, GenerationRequest
+
+async def send_request(host: str, port: int, req: GenerationRequest, t_start: float):
+    await asyncio.sleep(max(0, t_start + req.arrival_time - time.time()))
+    t_send = time.time()
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write((json.dumps({
+        'input_ids': req.input_ids,
+        'max_new_tokens': req.max_new_tokens,
+        'temperature': req.temperature,
+    }) + '\n').encode())
+    await writer.drain()
+
+    result = {'ttft': None, 'tokens': 0, 'error': None}
+    while True:
+        line = await reader.readline()
+        if not line:
+            result['error'] = 'connection closed'
+            break
+        msg = json.loads(line)
+        if 'error' in msg:
+            result['error'] = msg['error']
+            break
+        if msg.get('done', False):
+            assert msg['tokens'] == result['tokens'], msg
+            break
+        if result['ttft'] is None:
+            result['ttft'] = time.time() - t_send
+        result['tokens'] += 1
+    result['elapsed'] = time.time() - t_send
+    writer.close()
+    return result
+
+async def run_load(args):
+    server = None
+    host, port = args.host, args.port
+    if args.spawn_tiny:
+        from .opt_serve import InferenceServer
+        from .tests.tiny_opt import build_tiny_model
+        server = InferenceServer(
+            build_tiny_model(args.method),
+            max_batch_size=args.max_batch_size,
+            max_kv_tokens=args.max_kv_tokens,
+            batch_wait=args.batch_wait / 1000,
+        )
+        port = await server.start(host, 0)
+
+    requests = synthetic_trace(
+        num_requests=args.requests,
+        request_rate=args.request_rate,
+        prompt_length=(args.min_prompt, args.max_prompt),
+        new_tokens=(args.min_new_tokens, args.max_new_tokens),
+        vocab_size=args.vocab_size,
+        seed=args.seed,
+    )
+    t_start = time.time()
+    results = await asyncio.gather(*[send_request(host, port, req, t_start) for req in requests])
+    elapsed = time.time() - t_start
+
+    if server is not None:
+        await server.stop()
+
+    errors = [r for r in results if r['error'] is not None]
+    ok = [r for r in results if r['error'] is None]
+    for req, r in zip(requests, results):
+        if r['error'] is None:
+            assert r['tokens'] == req.max_new_tokens, (r, req.max_new_tokens)
+    ttfts = sorted([r['ttft'] for r in ok])
+    tpots = [(r['elapsed'] - r['ttft']) / (r['tokens'] - 1) for r in ok if r['tokens'] > 1]
+    num_tokens = sum([r['tokens'] for r in ok])
+    p = lambda q: ttfts[min(len(ttfts) - 1, int(q * len(ttfts)))] * 1000 if len(ttfts) > 0 else float('nan')
+    print(
+        f'{len(ok)}/{len(results)} requests ok, {num_tokens} tokens in {elapsed:.2f} s, '
+        f'{num_tokens / elapsed:.1f} tokens/s, '
+        f'TTFT mean {sum(ttfts) / max(len(ttfts), 1) * 1000:.1f} ms (p50 {p(0.5):.1f}, p90 {p(0.9):.1f}), '
+        f'TPOT mean {sum(tpots) / max(len(tpots), 1) * 1000:.2f} ms'
+    )
+    for r in errors[:5]:
+        print('error:', r['error'])
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--requests', type=int, default=32)
+    parser.add_argument('--request-rate', type=float, default=8.0)
+    parser.add_argument('--min-prompt', type=int, default=16)
+    parser.add_argument('--max-prompt', type=int, default=128)
+    parser.add_argument('--min-new-tokens', type=int, default=16)
+    parser.add_argument('--max-new-tokens', type=int, default=64)
+    parser.add_argument('--vocab-size', type=int, default=512)
+    parser.add_argument('--seed', type=int, default=42)
+
+    # for --spawn-tiny
+    parser.add_argument('--spawn-tiny', action='store_true')
+    parser.add_argument('--method', type=str, default='perlin')
+    parser.add_argument('--max-batch-size', type=int, default=16)
+    parser.add_argument('--max-kv-tokens', type=int, default=2048)
+    parser.add_argument('--batch-wait', type=float, default=5.0, help='ms')
+
+    args = parser.parse_args()
+    print(args)
+
+    asyncio.run(run_load(args))
@@ -0,0 +1,85 @@
+"""
+Validate that bad requests, failed decode steps and disconnected clients of opt_serve do not stop
+the server for other clients.
+
+Usage: python -m src.main.tests.test_opt_serve
+"""
+
+import json
+import asyncio
+from ...utils import seed
+from ..opt_serve import InferenceServer
+from .tiny_opt import build_tiny_model
+
+async def request(port: int, body: dict):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write((json.dumps(body) + '\n').encode())
+    await writer.drain()
+    lines = []
+    while True:
+        msg = json.loads(await asyncio.wait_for(reader.readline(), timeout=60))
+        lines.append(msg)
+        if 'done' in msg or 'error' in msg:
+            break
+    writer.close()
+    return lines
+
+async def wait_idle(server: InferenceServer):
+    for _ in range(6000):
+        if not server.engine.has_work() and len(server.pending) == 0:
+            return
+        await asyncio.sleep(0.01)
+    raise Exception('engine is still running')
+
+async def run():
+    seed()
+    model = build_tiny_model('perlin')
+    server = InferenceServer(model, max_batch_size=4, max_kv_tokens=4096)
+    port = await server.start(port=0)
+    good = {'input_ids': [5, 6, 7, 8], 'max_new_tokens': 4}
+
+    # invalid requests are rejected before scheduling
+    for body in [
+        {'input_ids': [], 'max_new_tokens': 4},
+        {'input_ids': [5, 6], 'max_new_tokens': 0},
+        {'input_ids': [5, model.config.vocab_size], 'max_new_tokens': 4},
+        {'input_ids': [5, -1], 'max_new_tokens': 4},
+        {'input_ids': 'abc'},
+    ]:
+        lines = await request(port, body)
+        assert len(lines) == 1 and 'error' in lines[0], lines
+    lines = await request(port, good)
+    assert lines[-1]['done'] and lines[-1]['tokens'] == 4, lines
+
+    # failed step ends requests of the step with error, and the scheduler keeps running
+    decode = server.engine.decode
+    def failing_decode(requests):
+        server.engine.decode = decode
+        raise RuntimeError('injected failure')
+    server.engine.decode = failing_decode
+    lines = await request(port, good)
+    assert 'error' in lines[-1] and 'injected failure' in lines[-1]['error'], lines
+    await wait_idle(server)
+    lines = await request(port, good)
+    assert lines[-1]['done'] and lines[-1]['tokens'] == 4, lines
+
+    # request of disconnected client is dropped from the engine
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write((json.dumps({'input_ids': [5, 6, 7, 8], 'max_new_tokens': 512}) + '\n').encode())
+    await writer.drain()
+    await asyncio.wait_for(reader.readline(), timeout=60)
+    req = (list(server.engine.running) + list(server.engine.waiting))[0]
+    writer.close()
+    await wait_idle(server)
+    assert len(req.output_ids) < req.max_new_tokens and req.past_key_values is None, len(req.output_ids)
+    assert req.request_id not in server.streams
+    print(f'disconnected request is dropped after {len(req.output_ids)} tokens')
+
+    await server.stop()
+    print('opt_serve passed')
+
+def main():
+    asyncio.run(run())
+
+if __name__ == '__main__':
+    main()
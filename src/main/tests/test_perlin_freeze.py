@@ -0,0 +1,72 @@
+"""
+Validate inference freezing pass (`perlin_attention.freeze_for_inference`) of perlin_opt.
+
+Tiny random perlin_opt with LoRA is copied and frozen. Prefill and cached decoding of frozen copy
+should be same with the original, and latency per decoding step and per layer is compared on cpu.
+
+Usage: python -m src.main.tests.test_perlin_freeze
+"""
+
+import copy
+import time
+import torch
+from ...utils import seed
+from ...models import perlin_attention
+from ...models.perlin_attention.attention import ModuleBenchmark
+from ...models.perlin_attention.modules import CausalConv2d
+from .tiny_opt import build_tiny_model
+
+def decode(model, input_ids: torch.Tensor, steps: int):
+    with torch.no_grad():
+        output = model(input_ids=input_ids, use_cache=True)
+        logits = [output.logits]
+        past_key_values = output.past_key_values
+        for i in range(steps):
+            token = torch.argmax(logits[-1][:, -1:], dim=-1)
+            output = model(input_ids=token, past_key_values=past_key_values, use_cache=True)
+            logits.append(output.logits)
+            past_key_values = output.past_key_values
+    return torch.cat(logits, dim=1)
+
+def build(num_layers: int):
+    seed()
+    model = build_tiny_model('perlin', num_layers=num_layers, lora_enabled=True)
+    # NOTE: lora_b is zero initialized
+    for name, p in model.named_parameters():
+        if name.endswith('lora_b'):
+            torch.nn.init.normal_(p, std=0.02)
+    return model
+
+def test_correctness(T=96, steps=16):
+    model = build(2)
+    frozen = perlin_attention.freeze_for_inference(copy.deepcopy(model))
+    assert not any([isinstance(m, ModuleBenchmark) for m in frozen.modules()])
+    convs = [m for m in frozen.modules() if isinstance(m, CausalConv2d) and m.causal]
+    assert len(convs) > 0 and all([m.weight_mask_folded for m in convs])
+    assert all([not p.requires_grad for p in frozen.parameters()])
+    # idempotent
+    perlin_attention.freeze_for_inference(frozen)
+
+    input_ids = torch.randint(4, model.config.vocab_size, (1, T))
+    truth = decode(model, input_ids, steps)
+    output = decode(frozen, input_ids, steps)
+    assert torch.allclose(output, truth, atol=1e-4, rtol=1e-4), (output - truth).abs().max()
+    print('correctness passed', (output - truth).abs().max().item())
+
+def test_speed(T=256, steps=32, num_layers=4):
+    model = build(num_layers)
+    frozen = perlin_attention.freeze_for_inference(copy.deepcopy(model))
+    input_ids = torch.randint(4, model.config.vocab_size, (1, T))
+    for name, m in [('original', model), ('frozen', frozen)]:
+        decode(m, input_ids, 2)
+        t = time.time()
+        decode(m, input_ids, steps)
+        elapsed = (time.time() - t) * 1000
+        print(f'[{name}] {elapsed / (steps + 1):.3f} ms/step, {elapsed / (steps + 1) / num_layers:.3f} ms/step/layer')
+
+def main():
+    test_correctness()
+    test_speed()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+"""
+Validate forking of decoding states (copy-on-write PerlinAttentionState).
+
+Prefix is decoded with cache, then two branches are decoded from the same past, one of them
+from `fork_past_key_values(past)`. Each branch should be same with decoding prefix+branch from
+scratch, and close to the non-cached output.
+
+Beam reordering (`OPTForCausalLM._reorder_cache`) of a batch of pasts should be same with decoding
+the selected sequences alone.
+
+Usage: python -m src.main.tests.test_perlin_opt_fork --k 32 --predictor-length 64
+            ^ put proper k and predictor length
+"""
+
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL']="2"
+import torch
+from .common_opt import init
+from ...models import perlin_attention
+from ...models.perlin_attention.attention_state import PerlinAttentionState
+from ...models.perlin_opt.kv_cache import fork_past_key_values
+
+torch.backends.cuda.matmul.allow_tf32 = False
+torch.set_float32_matmul_precision('highest')
+
+MAX_SEQ_LEN = 128
+
+def test_state_fork():
+    N, H, T, HID = 1, 2, 8, 4
+    v_a = torch.randn((N, H, T, HID))
+    v_b = v_a.clone()
+    v_b[:, :, T//2:] = torch.randn((N, H, T - T//2, HID))
+    def cumavg(v):
+        return v.cumsum(-2) / torch.arange(1, T+1).view(1, 1, T, 1)
+
+    state = PerlinAttentionState(None)
+    for i in range(T//2):
+        state.advance(i, 1)
+        PerlinAttentionState.stateful_cumavg(state, 'cumavg', v_a[:, :, :i+1], 1)
+    forked = state.fork()
+    sub_state = state.states['cumavg']
+    assert forked.states['cumavg'] is sub_state
+
+    outs_a, outs_b = [], []
+    for i in range(T//2, T):
+        state.advance(i, 1)
+        returned, out = PerlinAttentionState.stateful_cumavg(state, 'cumavg', v_a[:, :, :i+1], 1)
+        assert returned is state
+        outs_a.append(out)
+        forked.advance(i, 1)
+        _, out = PerlinAttentionState.stateful_cumavg(forked, 'cumavg', v_b[:, :, :i+1], 1)
+        outs_b.append(out)
+    # copied once on first write, and then updated in place
+    assert state.states['cumavg'] is not sub_state
+    assert forked.states['cumavg'] is not state.states['cumavg']
+    assert len(state.shared) == 0 and len(forked.shared) == 0
+
+    assert torch.allclose(torch.cat(outs_a, dim=-2), cumavg(v_a)[:, :, T//2:], atol=1e-5)
+    assert torch.allclose(torch.cat(outs_b, dim=-2), cumavg(v_b)[:, :, T//2:], atol=1e-5)
+
+    try:
+        state.advance(T//2, 1)
+        raise Exception('stale state should be detected')
+    except Exception as ex:
+        assert 'fork()' in str(ex), ex
+    print('state fork passed')
+
+def test_state_index_select():
+    N, H, T, HID = 3, 2, 4, 4
+    v = torch.randn((N, H, T, HID))
+    state = PerlinAttentionState(None)
+    for i in range(T):
+        state.advance(i, 1)
+        PerlinAttentionState.stateful_cumavg(state, 'cumavg', v[:, :, :i+1], 1)
+    
+    # keeping rows in place shares sub-states
+    same = state.index_select(0, torch.arange(N))
+    assert same.states['cumavg'] is state.states['cumavg'] and 'cumavg' in same.shared
+
+    beam_idx = torch.tensor([2, 2, 0])
+    reordered = state.index_select(0, beam_idx)
+    assert reordered.length == state.length and len(reordered.shared) == 0
+    assert torch.equal(reordered.states['cumavg'].cumsum, state.states['cumavg'].cumsum[beam_idx])
+    # reordered state is independent from the original
+    reordered.advance(T, 1)
+    PerlinAttentionState.stateful_cumavg(reordered, 'cumavg', v[beam_idx], 1)
+    assert state.states['cumavg'].prev_len == T
+    print('state index_select passed')
+
+def test_beam_reorder(method='perlin', T=24, T_DECODE=8):
+    from ...utils import seed
+    from .tiny_opt import build_tiny_model
+    seed()
+    model = build_tiny_model(method)
+    vocab_size = model.config.vocab_size
+    prompts = torch.randint(4, vocab_size, (2, T))
+    tokens = torch.randint(4, vocab_size, (3, T_DECODE))
+    beam_idx = torch.tensor([1, 1, 0])
+
+    def decode(ids, past_key_values):
+        logits = []
+        for i in range(ids.shape[-1]):
+            with torch.no_grad():
+                output = model(input_ids=ids[:, i:i+1], past_key_values=past_key_values, use_cache=True)
+            past_key_values = output.past_key_values
+            logits.append(output.logits)
+        return torch.cat(logits, dim=-2), past_key_values
+
+    with torch.no_grad():
+        past_key_values = model(input_ids=prompts, use_cache=True).past_key_values
+    # beams are expanded from two sequences, and the expanded batch is reordered
+    expanded = model._reorder_cache(past_key_values, torch.tensor([0, 1, 1]))
+    reordered = model._reorder_cache(expanded, torch.tensor([2, 1, 0]))
+    logits, _ = decode(tokens, reordered)
+    for i in range(3):
+        with torch.no_grad():
+            truth_past = model(input_ids=prompts[beam_idx[i]:beam_idx[i]+1], use_cache=True).past_key_values
+        truth, _ = decode(tokens[i:i+1], truth_past)
+        assert torch.allclose(logits[i:i+1], truth, atol=1e-4), (logits[i:i+1] - truth).abs().max()
+    print(f'[{method}] beam reorder passed')
+
+def main():
+    test_state_fork()
+    test_state_index_select()
+    test_beam_reorder('none')
+    test_beam_reorder('perlin')
+
+    trainer, model, tokenizer = init(skip_init_loaders=True)
+    model.eval()
+
+    input_ids = tokenizer(
+        "Famitsu enjoyed the story , and were particularly pleased with the improvements to gameplay . Japanese gaming site Game Watch <unk> , despite negatively noting its pacing and elements recycled from previous games , was generally positive about its story and characters , and found its gameplay entertaining despite off @-@ putting difficulty spikes . <unk> writer <unk> <unk> , in a Play Test article based on the game 's <unk> demo , felt that Valkyria Chronicles III provided a profound feeling of closure for the Valkyria Chronicles series .",
+        return_tensors="pt"
+    ).input_ids.to(trainer.device) # type: torch.Tensor
+    input_ids = input_ids[:,:min(input_ids.shape[-1], MAX_SEQ_LEN)]
+    T_PREFIX = input_ids.shape[-1] // 2
+    prefix = input_ids[:, :T_PREFIX]
+    branches = [input_ids[:, T_PREFIX:], torch.flip(input_ids[:, T_PREFIX:], dims=(-1,))]
+
+    # non cached
+    perlin_attention.get_default_config().use_cache = False
+    truths = []
+    with torch.no_grad():
+        for branch in branches:
+            output = model(torch.cat([prefix, branch], dim=-1))
+            truths.append(output.logits[:, T_PREFIX:])
+
+    # cached
+    perlin_attention.get_default_config().use_cache = True
+    def decode(ids, past_key_values):
+        logits = []
+        for i in range(ids.shape[-1]):
+            with torch.no_grad():
+                output = model(
+                    input_ids=ids[:, i:i+1],
+                    past_key_values=past_key_values,
+                    use_cache=True,
+                )
+            past_key_values = output.past_key_values
+            logits.append(output.logits)
+        return torch.cat(logits, dim=-2), past_key_values
+
+    _, past_key_values = decode(prefix, None)
+    forked_past_key_values = fork_past_key_values(past_key_values)
+    logits_a, _ = decode(branches[0], past_key_values)
+    logits_b, _ = decode(branches[1], forked_past_key_values)
+
+    try:
+        decode(branches[1], past_key_values)
+        raise Exception('decoding advanced past without fork should fail')
+    except Exception as ex:
+        assert 'fork()' in str(ex), ex
+
+    for branch, logits, truth in zip(branches, [logits_a, logits_b], truths):
+        scratch, _ = decode(torch.cat([prefix, branch], dim=-1), None)
+        scratch = scratch[:, T_PREFIX:]
+        assert torch.allclose(logits, scratch, atol=1e-4), (logits - scratch).abs().max()
+
+        accuracy = (torch.argmax(logits, dim=-1) == torch.argmax(truth, dim=-1)).float().mean().item()
+        error = (logits.double() - truth.double()).abs().sum(-1).log10()
+        print(f'accuracy {accuracy:.4f}, ERROR=(x-y).abs().sum().log10() mean {error.mean().item():.4f}, max {error.max().item():.4f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""
+Perplexity vs KV memory of estimated-attention-driven KV eviction (KVRetention) on wikitext2.
+
+Each sample is prefilled with EVICT_PREFILL tokens, and then the rest is decoded token by token
+with the cache, so the eviction policy runs on every step. For each cap of cached tokens, prints
+streaming perplexity and peak bytes of KV caches, and saves the curve.
+
+EVICT_CAPS: comma separated caps of cached tokens, 0 is no eviction (default 0,1024,768,512,384)
+EVICT_SAMPLES: number of wikitext2 samples (default 4)
+EVICT_PREFILL: tokens of prefill (default 128)
+EVICT_SPILL: 'none' (default) drops evicted blocks, 'host' or 'mmap' spills them into host tier and
+    fetches them back, then hit rate and latency of host tier are printed per layer
+EVICT_BENCHMARKING: '1' runs perlin modules in benchmarking mode with sparse partial masks,
+    '0' (default) keeps dense partial masks
+
+Usage: EVICT_CAPS=0,512,384 python -m src.main.tests.test_perlin_opt_kv_evict --k 64 --predictor-length 128 --max-seq-len 2048
+            ^ put proper k and predictor length
+"""
+
+import os
+import json
+import math
+os.environ['TF_CPP_MIN_LOG_LEVEL']="2"
+import tqdm
+import torch
+import torch.nn.functional as F
+from .common_opt import init
+from ...models import perlin_attention
+from ...models.perlin_opt import kv_cache as kv_cache_module
+from ...models.perlin_opt.kv_cache import KVCache
+
+CAPS = [int(c) for c in os.environ.get('EVICT_CAPS', '0,1024,768,512,384').split(',')]
+SAMPLES = int(os.environ.get('EVICT_SAMPLES', '4'))
+PREFILL = int(os.environ.get('EVICT_PREFILL', '128'))
+SPILL = os.environ.get('EVICT_SPILL', 'none')
+BENCHMARKING = os.environ.get('EVICT_BENCHMARKING', '0') == '1'
+
+def kv_bytes(past_key_values):
+    total = 0
+    for layer_past in past_key_values:
+        for item in layer_past:
+            if isinstance(item, KVCache):
+                total += item.key_storage.numel() * item.key_storage.element_size() * 2
+    return total
+
+def streaming_nll(model, input_ids: torch.Tensor):
+    """
+    returns (sum of nll, number of tokens, peak KV bytes)
+    """
+    with torch.no_grad():
+        output = model(input_ids=input_ids[:, :PREFILL], use_cache=True)
+        nll = F.cross_entropy(
+            output.logits[0, :-1].float(), input_ids[0, 1:PREFILL], reduction='sum'
+        ).item()
+        logits = output.logits[:, -1]
+        past_key_values = output.past_key_values
+        peak = kv_bytes(past_key_values)
+        for i in range(PREFILL, input_ids.shape[-1]):
+            nll += F.cross_entropy(logits.float(), input_ids[:, i], reduction='sum').item()
+            output = model(input_ids=input_ids[:, i:i+1], past_key_values=past_key_values, use_cache=True)
+            logits = output.logits[:, -1]
+            past_key_values = output.past_key_values
+            peak = max(peak, kv_bytes(past_key_values))
+    return nll, input_ids.shape[-1] - 1, peak
+
+def main():
+    trainer, model, tokenizer = init(skip_init_loaders=False)
+    model.eval()
+    perlin_attention.get_default_config().use_cache = True
+    for m in model.modules():
+        if hasattr(m, 'benchmarking'):
+            m.benchmarking = BENCHMARKING
+
+    samples = []
+    for batch in trainer.valid_loader:
+        samples.append(batch['input_ids'][:1].to(trainer.device))
+        if len(samples) >= SAMPLES:
+            break
+
+    kv_cache_module.KV_SPILL = SPILL
+    results = []
+    for cap in CAPS:
+        kv_cache_module.KV_EVICT_MAX_TOKENS = cap
+        for _, stats in kv_cache_module.collect_kv_tier_stats(model):
+            stats.reset()
+        nll_sum = 0
+        count = 0
+        peak = 0
+        for input_ids in tqdm.tqdm(samples, dynamic_ncols=True, desc=f'cap={cap}'):
+            nll, n, p = streaming_nll(model, input_ids)
+            nll_sum += nll
+            count += n
+            peak = max(peak, p)
+        ppl = math.exp(nll_sum / count)
+        results.append({'cap': cap, 'ppl': ppl, 'kv_mb': peak / 1024 / 1024})
+        print(f'cap={cap if cap > 0 else "none"}, ppl={ppl:.4f}, peak kv={peak / 1024 / 1024:.2f} MB')
+        if SPILL != 'none' and cap > 0:
+            for name, stats in kv_cache_module.collect_kv_tier_stats(model):
+                print(f'  {name}: {stats.strify()}')
+            total = kv_cache_module.KVTierStats()
+            for _, stats in kv_cache_module.collect_kv_tier_stats(model):
+                total.merge(stats)
+            results[-1]['tier_hit_rate'] = total.hit_rate
+            results[-1]['tier_fetch_ms_per_step'] = total.fetch_seconds * 1000 / max(total.steps, 1)
+
+    os.makedirs('./plots/exp_kv_evict', exist_ok=True)
+    with open(f'./plots/exp_kv_evict/data{"" if SPILL == "none" else "_" + SPILL}.json', 'w') as f:
+        json.dump(results, f, indent=2)
+
+    import matplotlib.pyplot as plt
+    plt.plot([r['kv_mb'] for r in results], [r['ppl'] for r in results], marker='o')
+    for r in results:
+        plt.annotate(str(r['cap'] if r['cap'] > 0 else 'none'), (r['kv_mb'], r['ppl']))
+    plt.xlabel('peak KV cache (MB)')
+    plt.ylabel('PPL (wikitext2)')
+    plt.grid()
+    plt.savefig('./plots/exp_kv_evict/ppl_vs_memory.png', dpi=200)
+    print('saved ./plots/exp_kv_evict')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+Validate streaming causal cnn of attention predictor against full forward, and compare
+per-token cost with previous window based StatefulCausalCNN.
+
+Usage: python -m src.main.tests.test_perlin_streaming_cnn
+"""
+
+import time
+import torch
+from torch import nn
+from ...utils import seed
+from ...models.perlin_attention.attention import ModuleBenchmark
+from ...models.perlin_attention.attention_state import PerlinAttentionState, StatefulCausalCNN
+from ...models.perlin_attention.modules import (
+    KeepRes,
+    CausalConv2d,
+    UpsampleFP32,
+    is_streamable,
+    stream_forward,
+)
+
+def build_cnn(H=12, inner_ch=2, predictor_length=128, deeper=False):
+    # same with attention_predictor_cnn of causal PerlinAttention
+    convs = [
+        CausalConv2d(inner_ch*H, inner_ch*H, 3, padding=2, dilation=2, stride=(1, 1), causal=True),
+        nn.ReLU(),
+        CausalConv2d(inner_ch*H, inner_ch*H, 3, padding=2, dilation=2, stride=(1, 1), causal=True),
+        nn.ReLU(),
+    ]
+    if deeper:
+        convs += [
+            CausalConv2d(inner_ch*H, inner_ch*H, 3, padding=2, dilation=2, stride=(1, 1), causal=True),
+            nn.ReLU(),
+        ]
+    return nn.Sequential(
+        ModuleBenchmark('cnn.lnorm1', nn.LayerNorm(predictor_length // 4)),
+        ModuleBenchmark('cnn.keepres', KeepRes(
+            *convs,
+            UpsampleFP32((1, 4), torch.float16),
+            CausalConv2d(inner_ch*H, H, 1, padding=1, causal=True),
+            output_width=predictor_length
+        )),
+        ModuleBenchmark('cnn.lnorm2', nn.LayerNorm(predictor_length)),
+    )
+
+def test_config(T=100, H=4, inner_ch=2, predictor_length=32, deeper=False):
+    seed()
+    cnn = build_cnn(H, inner_ch, predictor_length, deeper).eval()
+    assert is_streamable(cnn)
+    x = torch.randn((2, inner_ch*H, T, predictor_length // 4))
+
+    with torch.no_grad():
+        truth = cnn(x)
+
+        # one row per step
+        buffers = {}
+        ys = [stream_forward(cnn, x[:, :, i:i+1], buffers) for i in range(T)]
+        assert torch.allclose(torch.cat(ys, dim=-2), truth, atol=1e-5), (torch.cat(ys, dim=-2) - truth).abs().max()
+
+        # prefill and chunks
+        buffers = {}
+        ys = [
+            stream_forward(cnn, x[:, :, :T//2], buffers),
+            stream_forward(cnn, x[:, :, T//2:T//2+3], buffers),
+            stream_forward(cnn, x[:, :, T//2+3:], buffers),
+        ]
+        assert torch.allclose(torch.cat(ys, dim=-2), truth, atol=1e-5)
+
+        # through state, with fork
+        state = PerlinAttentionState(None)
+        ys = []
+        for i in range(T//2):
+            _, y = PerlinAttentionState.stateful_causal_cnn_op(state, 'cnn', cnn, x[:, :, i:i+1], 1)
+            ys.append(y)
+        assert state.states['cnn'].streaming
+        forked = state.fork()
+        x_branch = torch.randn_like(x[:, :, T//2:])
+        for i in range(T//2, T):
+            _, y = PerlinAttentionState.stateful_causal_cnn_op(state, 'cnn', cnn, x[:, :, i:i+1], 1)
+            ys.append(y)
+            PerlinAttentionState.stateful_causal_cnn_op(forked, 'cnn', cnn, x_branch[:, :, i-T//2:i-T//2+1], 1)
+        assert torch.allclose(torch.cat(ys, dim=-2), truth, atol=1e-5)
+
+def test_speed(T=2048, H=12, inner_ch=2, predictor_length=128):
+    seed()
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    cnn = build_cnn(H, inner_ch, predictor_length).eval().to(device)
+    x = torch.randn((1, inner_ch*H, T, predictor_length // 4), device=device)
+    def sync():
+        if device == 'cuda':
+            torch.cuda.synchronize()
+
+    for streaming in [False, True]:
+        state = PerlinAttentionState(None)
+        sub_state = StatefulCausalCNN(state, cnn)
+        sub_state.streaming = streaming
+        state.states['cnn'] = sub_state
+        with torch.no_grad():
+            sync()
+            t = time.time()
+            for i in range(T):
+                PerlinAttentionState.stateful_causal_cnn_op(state, 'cnn', cnn, x[:, :, i:i+1], 1)
+            sync()
+            elapsed = time.time() - t
+        print(f'[{"streaming" if streaming else "window"}] {elapsed / T * 1000:.3f} ms/token')
+
+def test_main():
+    test_config()
+    test_config(T=37, deeper=True)
+    test_speed()
+
+if __name__ == '__main__':
+    test_main()
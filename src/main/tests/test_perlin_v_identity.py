@@ -0,0 +1,79 @@
+"""
+Validate closed form V identity (hat function) of non causal PerlinAttention against bilinear
+grid_sample on eye matrix, and compare latency of both on cpu and cuda (when available).
+
+Usage: python -m src.main.tests.test_perlin_v_identity
+"""
+
+import time
+import torch
+from ...utils import seed
+from ...models.perlin_attention.attention import grid_sample_bf16, v_identity_hat
+
+def v_identity_grid_sample(zero_one_attention_mask: torch.Tensor, H: int, HID: int, dtype: torch.dtype):
+    # previous vmask stage of PerlinAttention
+    N = zero_one_attention_mask.shape[0]
+    T = zero_one_attention_mask.shape[-1]
+    device = zero_one_attention_mask.device
+    zero_one_attention_mask_cumsum = zero_one_attention_mask.cumsum(-1)
+    zero_one_attention_mask_sum = zero_one_attention_mask.sum(-1)
+    v_for_atten_identity = torch.eye(n=HID, dtype=dtype, device=device).view(1, 1, HID, HID).expand(N, H, HID, HID)
+    token_index_y = ((zero_one_attention_mask_cumsum - 1.0) / ((zero_one_attention_mask_sum - 1.0).view(N, 1, 1, 1) + 1e-8) * 2 - 1)\
+        .view(N, T, 1, 1)\
+        .expand(N, T, HID, 1)
+    token_index_x = (torch.arange(HID, dtype=torch.long, device=device) / (HID - 1) * 2 - 1).view(1, 1, HID, 1)
+    token_index_x = token_index_x.expand(N, T, HID, 1)
+    token_index = torch.cat([token_index_x, token_index_y], dim=-1)
+    return grid_sample_bf16(
+        input=v_for_atten_identity,
+        grid=token_index.to(v_for_atten_identity.dtype),
+        mode='bilinear',
+        align_corners=True,
+    )
+
+def make_mask(lengths, T, device='cpu'):
+    return (torch.arange(T).view(1, T) < torch.tensor(lengths).view(-1, 1)).float().view(len(lengths), 1, 1, T).to(device)
+
+def test_correctness(H=12, HID=64, T=128):
+    masks = [
+        make_mask([T, T], T),
+        make_mask([T, 77, 77, 3, 1], T),
+        # not right padded
+        (torch.rand((3, 1, 1, T)) > 0.3).float(),
+    ]
+    masks[2][:, :, :, 0] = 1
+    for mask in masks:
+        N = mask.shape[0]
+        truth = v_identity_grid_sample(mask, H, HID, torch.float32)
+        output = v_identity_hat(mask.cumsum(-1).view(N, T), mask.sum(-1).view(N), HID)
+        assert output.shape == (N, T, HID)
+        assert torch.allclose(output.unsqueeze(1).expand_as(truth), truth, atol=1e-5), (output.unsqueeze(1) - truth).abs().max()
+    print('correctness passed')
+
+def test_speed(N=32, H=12, HID=64, T=512, n=20, device='cpu'):
+    lengths = [T if i % 2 == 0 else T // 2 for i in range(N)]
+    mask = make_mask(lengths, T, device)
+    def sync():
+        if device == 'cuda':
+            torch.cuda.synchronize()
+    for name, fn in [
+        ('grid_sample', lambda: v_identity_grid_sample(mask, H, HID, torch.float32)),
+        ('hat', lambda: v_identity_hat(mask.view(N, T).cumsum(-1), mask.view(N, T).sum(-1), HID)),
+    ]:
+        fn()
+        sync()
+        t = time.time()
+        for _ in range(n):
+            fn()
+        sync()
+        print(f'[{name}, {device}] N={N}, H={H}, T={T}, HID={HID}: {(time.time() - t) / n * 1000:.3f} ms')
+
+def main():
+    seed()
+    test_correctness()
+    test_speed()
+    if torch.cuda.is_available():
+        test_speed(device='cuda')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""
+Randomly initialized tiny perlin_opt for testing decoding machinery on cpu, without checkpoints.
+
+PerlinAttentionConfig of the model is kept by its modules. Default config and DEFAULT_METHOD of
+the process are restored after building, so other models of the same process are not affected.
+"""
+
+def build_tiny_model(
+    method: str = 'perlin',
+    vocab_size: int = 512,
+    hidden_size: int = 64,
+    num_layers: int = 2,
+    num_heads: int = 4,
+    max_length: int = 1024,
+    k: int = 16,
+    predictor_length: int = 32,
+    device: str = 'cpu',
+    lora_enabled: bool = False,
+    benchmarking: bool = True,
+):
+    """
+    benchmarking: sets `benchmarking` of perlin modules, which keeps sparse partial attention masks
+    """
+    from transformers import OPTConfig
+    from ...models import perlin_attention
+    from ...models.perlin_opt import perlin_opt
+
+    default_config = perlin_attention.get_default_config()
+    default_method = perlin_opt.DEFAULT_METHOD
+    # NOTE: modules read these globals in __init__
+    perlin_attention.register_default_config(perlin_attention.PerlinAttentionConfig(
+        k=k,
+        attention_predictor_length=predictor_length,
+        causal=True,
+        use_cache=True,
+        lora_enabled=lora_enabled,
+    ))
+    perlin_opt.DEFAULT_METHOD = method
+    try:
+        model = perlin_opt.OPTForCausalLM(OPTConfig(
+            vocab_size=vocab_size,
+            hidden_size=hidden_size,
+            num_hidden_layers=num_layers,
+            ffn_dim=hidden_size * 4,
+            num_attention_heads=num_heads,
+            max_position_embeddings=max_length,
+            word_embed_proj_dim=hidden_size,
+        ))
+    finally:
+        perlin_attention.register_default_config(default_config)
+        perlin_opt.DEFAULT_METHOD = default_method
+
+    for m in model.modules():
+        if hasattr(m, 'benchmarking'):
+            m.benchmarking = benchmarking
+    return model.to(device).eval()
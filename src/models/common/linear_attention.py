@@ -0,0 +1,178 @@
+"""
+Chunked causal linear attention, shared by performer (FastAttention, StatefulCausalPerformer) and cosformer.
+
+    out_i = (q_i . sum_{j<=i} k_j v_j^T) / normalizer(q_i . sum_{j<=i} k_j)
+
+Rows are split into chunks of C rows. Inside a chunk, masked quadratic (C x C) products are used,
+and sums of previous chunks are carried as state (k_sum: D, kv_sum: D x E). Peak memory is
+O(C*C + C*(D+E) + D*E) per batch and head, instead of O(T*D*E) of cumsum over outer products.
+Products are computed in dtype of q, and carried state is accumulated in `acc_dtype`.
+
+PERLIN_LINEAR_ATTENTION_CHUNK: rows per chunk (default 64)
+PERLIN_LINEAR_ATTENTION_ACC: accumulator dtype of carried state, 'float64' (default), 'float32'
+
+Usage: python -m src.models.common.linear_attention
+"""
+
+import os
+import time
+import torch
+
+LINEAR_ATTENTION_CHUNK = int(os.environ.get('PERLIN_LINEAR_ATTENTION_CHUNK', '64'))
+LINEAR_ATTENTION_ACC = os.environ.get('PERLIN_LINEAR_ATTENTION_ACC', 'float64')
+
+_causal_masks = {}
+
+def causal_chunk_mask(size: int, device: torch.device):
+    key = (size, str(device))
+    if key not in _causal_masks:
+        _causal_masks[key] = torch.ones((size, size), dtype=torch.bool, device=device).tril()
+    return _causal_masks[key]
+
+def causal_linear_attention(
+    q: torch.Tensor,
+    k: torch.Tensor,
+    v: torch.Tensor,
+    k_sum: torch.Tensor = None,
+    kv_sum: torch.Tensor = None,
+    chunk_size: int = None,
+    acc_dtype: torch.dtype = None,
+    eps: float = 1e-6,
+    normalize: str = 'performer',
+):
+    """
+    q, k: ..., T, D. v: ..., T, E
+    k_sum: ..., D and kv_sum: ..., D, E are sums over previous tokens, or None at the start of sequence
+    normalize: 'performer' divides by q.(k_sum + eps), 'clamp' divides by max(q.k_sum, eps) (cosformer)
+    returns (out (..., T, E), k_sum, kv_sum). sums include this call, so next call continues the sequence
+    """
+    assert q.shape[-2] == k.shape[-2] == v.shape[-2], f"{q.shape}, {k.shape}, {v.shape}"
+    assert normalize in ['performer', 'clamp'], normalize
+    C = LINEAR_ATTENTION_CHUNK if chunk_size is None else chunk_size
+    acc_dtype = getattr(torch, LINEAR_ATTENTION_ACC) if acc_dtype is None else acc_dtype
+    T, D = q.shape[-2:]
+    E = v.shape[-1]
+    dtype = q.dtype
+    k = k.to(dtype)
+    v = v.to(dtype)
+    if k_sum is None:
+        k_sum = torch.zeros(q.shape[:-2] + (D,), dtype=acc_dtype, device=q.device)
+    if kv_sum is None:
+        kv_sum = torch.zeros(q.shape[:-2] + (D, E), dtype=acc_dtype, device=q.device)
+    k_sum = k_sum.to(acc_dtype)
+    kv_sum = kv_sum.to(acc_dtype)
+
+    outs = []
+    for start in range(0, T, C):
+        qc = q[..., start:start+C, :]
+        kc = k[..., start:start+C, :]
+        vc = v[..., start:start+C, :]
+        L = qc.shape[-2]
+        # intra chunk, quadratic
+        scores = torch.matmul(qc, kc.transpose(-1, -2)).masked_fill(~causal_chunk_mask(L, q.device), 0)
+        numer = torch.matmul(scores, vc) + torch.matmul(qc, kv_sum.to(dtype))
+        denom = scores.sum(-1) + (qc * k_sum.to(dtype).unsqueeze(-2)).sum(-1)
+        if normalize == 'performer':
+            denom = denom + eps * qc.sum(-1)
+        else:
+            denom = torch.clamp_min(denom, eps)
+        outs.append(numer / denom.unsqueeze(-1))
+        # inter chunk, carried state
+        k_sum = k_sum + kc.sum(-2, dtype=acc_dtype)
+        kv_sum = kv_sum + torch.matmul(kc.transpose(-1, -2).to(acc_dtype), vc.to(acc_dtype))
+
+    out = torch.cat(outs, dim=-2) if len(outs) > 0 else q.new_zeros(q.shape[:-1] + (E,))
+    return out, k_sum, kv_sum
+
+def causal_linear_attention_fn(q: torch.Tensor, k: torch.Tensor, v: torch.Tensor):
+    """
+    drop-in for `FastAttention.causal_linear_fn`
+    """
+    out, _, _ = causal_linear_attention(q, k, v, eps=1e-6, normalize='performer')
+    return out
+
+def causal_linear_attention_reference(q, k, v, eps=1e-6, normalize='performer'):
+    """
+    cumsum over outer products (previous implementation of performer and cosformer), for tests
+    """
+    k_cumsum = k.cumsum(dim=-2, dtype=torch.float64)
+    context_cumsum = torch.einsum('...nd,...ne->...nde', k, v).cumsum(dim=-3, dtype=torch.float64)
+    if normalize == 'performer':
+        D_inv = 1. / torch.einsum('...nd,...nd->...n', q, k_cumsum.type_as(q) + eps)
+    else:
+        D_inv = 1. / torch.clamp_min(torch.einsum('...nd,...nd->...n', q, k_cumsum.type_as(q)), eps)
+    return torch.einsum('...nde,...nd,...n->...ne', context_cumsum.type_as(q), q, D_inv)
+
+def test_parity(N=2, H=3, T=203, D=16, E=24):
+    q = torch.rand((N, H, T, D))
+    k = torch.rand((N, H, T, D))
+    v = torch.randn((N, H, T, E))
+    for normalize in ['performer', 'clamp']:
+        truth = causal_linear_attention_reference(q, k, v, normalize=normalize)
+        for chunk_size in [1, 16, 64, 512]:
+            for acc_dtype in [torch.float64, torch.float32]:
+                out, _, _ = causal_linear_attention(q, k, v, chunk_size=chunk_size, acc_dtype=acc_dtype, normalize=normalize)
+                assert out.shape == truth.shape and out.dtype == q.dtype
+                assert torch.allclose(out, truth, atol=1e-4, rtol=1e-4), (normalize, chunk_size, acc_dtype, (out - truth).abs().max())
+
+    # carried state continues the sequence
+    out, k_sum, kv_sum = causal_linear_attention(q[..., :100, :], k[..., :100, :], v[..., :100, :], chunk_size=16)
+    for i in range(100, T):
+        o, k_sum, kv_sum = causal_linear_attention(q[..., i:i+1, :], k[..., i:i+1, :], v[..., i:i+1, :], k_sum, kv_sum)
+        out = torch.cat([out, o], dim=-2)
+    assert torch.allclose(out, causal_linear_attention_reference(q, k, v), atol=1e-4, rtol=1e-4)
+    print('parity passed')
+
+def test_cosformer(T=50):
+    from ..cosformer import CosformerAttention
+    model = CosformerAttention(embed_dim=64, num_heads=4, causal=True)
+    mask = (torch.triu(torch.ones(T, T)) == 1).transpose(0, 1)
+    mask = mask.float().masked_fill(mask == 0, float('-inf'))
+    x = torch.rand(T, 2, 64)
+    assert torch.allclose(model(x, x, x), model.left_product(x, x, x, mask), atol=1e-4)
+    print('cosformer passed')
+
+def test_performer(T=300):
+    from performer_pytorch import FastAttention
+    performer = FastAttention(dim_heads=16, nb_features=32, causal=True, generalized_attention=True)
+    q, k, v = [torch.randn((1, 2, T, 16)) for _ in range(3)]
+    truth = performer(q, k, v)
+    performer.causal_linear_fn = causal_linear_attention_fn
+    out = performer(q, k, v)
+    assert torch.allclose(out, truth, atol=1e-4, rtol=1e-4), (out - truth).abs().max()
+    print('performer passed')
+
+def test_memory(N=1, H=4, T=2048, D=32, E=96, chunk_size=64):
+    """
+    peak memory and latency against cumsum over outer products
+    """
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    q = torch.rand((N, H, T, D), device=device)
+    k = torch.rand((N, H, T, D), device=device)
+    v = torch.randn((N, H, T, E), device=device)
+    for name, fn in [
+        ('reference', lambda: causal_linear_attention_reference(q, k, v)),
+        ('chunked', lambda: causal_linear_attention(q, k, v, chunk_size=chunk_size)[0]),
+    ]:
+        if device == 'cuda':
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            base = torch.cuda.max_memory_allocated()
+        t = time.time()
+        fn()
+        if device == 'cuda':
+            torch.cuda.synchronize()
+            peak = f'{(torch.cuda.max_memory_allocated() - base) / 1024 / 1024:.1f} MB'
+        else:
+            peak = f'{N * H * T * D * E * 8 / 1024 / 1024:.1f} MB (estimated)' if name == 'reference' else \
+                f'{N * H * (chunk_size * chunk_size + D * E) * 8 / 1024 / 1024:.1f} MB (estimated)'
+        print(f'[{name}] T={T}, {(time.time() - t) * 1000:.1f} ms, peak {peak}')
+
+def test_main():
+    test_parity()
+    test_cosformer()
+    test_performer()
+    test_memory()
+
+if __name__ == '__main__':
+    test_main()
@@ -10,16 +10,34 @@ class LoraLinear(nn.Module):
         self.lora_a = nn.Parameter(torch.zeros((dim_r, inch)))
         self.lora_b = nn.Parameter(torch.zeros((outch, dim_r)))
         torch.nn.init.kaiming_uniform_(self.lora_a, a=math.sqrt(5))
+        
+        # lora_b @ lora_a, computed once by freeze_for_inference
+        self.register_buffer('frozen_weight', None, persistent=False)
+        # delta is merged into weight of base linear, see lora_forward
+        self.merged = False
+    
+    def freeze_for_inference(self):
+        self.frozen_weight = torch.mm(self.lora_b, self.lora_a).detach()
+    
+    def merge_into(self, linear: nn.Linear):
+        """
+        adds delta into weight of base linear. only for lora_forward, which computes linear(x) + lora(x)
+        """
+        if self.merged:
+            return
+        linear.weight.data.add_(torch.mm(self.lora_b.float(), self.lora_a.float()).to(linear.weight.dtype))
+        self.merged = True
     
     def forward(self, x: torch.Tensor):
-        x = F.linear(x, torch.mm(self.lora_b, self.lora_a))
+        weight = self.frozen_weight if self.frozen_weight is not None else torch.mm(self.lora_b, self.lora_a)
+        x = F.linear(x, weight)
         # x = F.linear(x, self.lora_b)
         # print(x[0,0,0])
         return x
 
 # fused
 def lora_forward(linear: nn.Linear, lora: LoraLinear, x: torch.Tensor, enabled: bool):
-    if not enabled:
+    if not enabled or lora.merged:
         return linear(x)
     assert linear.bias.ndim == 1
     assert x.ndim == 3
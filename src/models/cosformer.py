@@ -6,6 +6,8 @@ from torch import Tensor
 from typing import Optional
 from torch import nn
 
+from .common.linear_attention import causal_linear_attention
+
 class CosformerAttention(nn.Module):
     """
     cosformer attention in "cosFormer: Rethinking Softmax In Attention"
@@ -112,19 +114,10 @@ class CosformerAttention(nn.Module):
         k_ = torch.cat([k * torch.sin(weight_index[:, :src_len, :] / m), k * torch.cos(weight_index[:, :src_len, :] / m)], dim=-1)
 
         if self.causal:
-            ## Need to improve speed!
-            # (N * h, L, 2 * d) (N * h, L, d) -> (N * h, L, h, 2 * d, d)
-            kv_ = torch.einsum("nld,nlm->nldm", k_, v)
-            # (N * h, L, 2 * d, d) -> (N * h, L, 2 * d, d)
-            kv_cum = torch.cumsum(kv_, dim=1)
-            # (N * h, L, 2 * d) (N * h, L, 2 * d, d) -> (N * h, L, d)
-            qkv = torch.einsum("nld,nldm->nlm", q_, kv_cum)
-            # (N * h, L, 2 * d) -> (N * h, L, 2 * d)
-            k_cum = torch.cumsum(k_, dim=1)
-            # (N * h, L, 2 * d) (N * h, L, 2 * d) -> (N * h, L)
-            denom = torch.clamp_min(torch.einsum("nlm,nlm->nl", q_, k_cum), eps)
-            # (N * h, L, d) (N * h, L, 1) -> (N * h, L, d)
-            attn_output = qkv / denom.unsqueeze(-1)
+            # chunked, peak memory is O(C * C + C * (D + E) + D * E) with D = 2 * d, E = d and C rows per chunk,
+            # instead of O(L * 2 * d * d) of cumsum over outer products
+            # (N * h, L, 2 * d) (N * h, L, 2 * d) (N * h, L, d) -> (N * h, L, d)
+            attn_output, _, _ = causal_linear_attention(q_, k_, v, eps=eps, normalize='clamp')
             # (N * h, L, d) -> (L, N * h, d) -> (L, N, E)
             attn_output = attn_output.transpose(0, 1).contiguous().view(tgt_len, bsz, -1)
         else:
@@ -1,3 +1,4 @@
 from .config import PerlinAttentionConfig, get_default_config, register_default_config
 from .self_attention import PerlinSelfAttention
-from .attention import PerlinAttention, PerlinAttentionOutput
\ No newline at end of file
+from .attention import PerlinAttention, PerlinAttentionOutput
+from .freeze import freeze_for_inference
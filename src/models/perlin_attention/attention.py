@@ -20,6 +20,7 @@ from torch import nn, optim
 from ...utils import batch_to, get_bench, Metric
 from ..common.kl_div_for_atten import kl_div_attention
 from ..common.performer import ProjectionUpdater
+from ..common.linear_attention import causal_linear_attention_fn
 from ..hf_bert import BertConfig
 from .config import PerlinAttentionConfig, get_default_config
 from ...utils import raise_if_nan, strify
@@ -29,7 +30,15 @@ from .modules import (
     KeepRes,
     CausalConv2d,
     UpsampleFP32,
-    interpolate
+    interpolate,
+    is_streamable,
+    stream_forward,
+)
+from .ops import (
+    use_threshold_select,
+    topk_threshold_mask,
+    token_index_m,
+    bucket_sum_m,
 )
 from math import ceil, floor
 # NOTE comment below to debug NaN
@@ -59,6 +68,22 @@ def grid_sample_bf16(input, grid, mode='nearest', align_corners=False, padding_m
         y = y.to(input_dtype)
     return y
 
+# 'hat': closed form of V identity, 'grid_sample': bilinear sampling of eye matrix
+V_IDENTITY = os.environ.get('PERLIN_V_IDENTITY', 'hat')
+# 'compressed': average context in T_M with bucketed V sums, 'resize': resize probs to T
+AVG_POOL = os.environ.get('PERLIN_AVG_POOL', 'compressed')
+
+def v_identity_hat(mask_cumsum: torch.Tensor, mask_sum: torch.Tensor, HID: int):
+    """
+    closed form of bilinear grid_sample (align_corners, zero padding) on HID x HID identity, at row
+    (cumsum - 1) / (sum - 1) * (HID - 1) and column j. that is hat function max(0, 1 - |row - j|).
+    mask_cumsum: N, T. mask_sum: N. returns N, T, HID in float32
+    """
+    N, T = mask_cumsum.shape
+    row = (mask_cumsum.float() - 1.0) / (mask_sum.float().view(N, 1) - 1.0 + 1e-8) * (HID - 1)
+    col = torch.arange(HID, device=row.device, dtype=row.dtype)
+    return torch.clamp_min(1 - (row.unsqueeze(-1) - col).abs(), 0)
+
 def softmax_bf16(input, dim=-1, training=True):
     if not training:
         return torch.softmax(input, dim=dim)
@@ -119,6 +144,16 @@ class ModuleBenchmark(nn.Module):
         else:
             with timer(self.name):
                 return self.module(x)
+    
+    def streamable(self):
+        return is_streamable(self.module)
+    
+    def forward_stream(self, x, buffers):
+        if self.disabled:
+            return stream_forward(self.module, x, buffers)
+        else:
+            with timer(self.name):
+                return stream_forward(self.module, x, buffers)
 
 class ChannelSplit(nn.Module):
     def __init__(self, split):
@@ -162,6 +197,11 @@ class PerlinAttention(nn.Module):
             causal=self.pconfig.causal,
             generalized_attention=self.pconfig.causal,
         )
+        causal_linear_fn = getattr(self.performer.causal_linear_fn, 'func', self.performer.causal_linear_fn) if self.pconfig.causal else None
+        if os.environ.get('PERLIN_LINEAR_ATTENTION', 'chunked') == 'chunked' and \
+            getattr(causal_linear_fn, '__name__', None) == 'causal_linear_attention_noncuda':
+            # NOTE: non cuda version of performer_pytorch takes O(T*D*E) memory for cumsum over outer products
+            self.performer.causal_linear_fn = causal_linear_attention_fn
         self.performer_proj_updater = ProjectionUpdater(
             self.performer,
             1000,
@@ -437,6 +477,9 @@ class PerlinAttention(nn.Module):
             last_state = PerlinAttentionState(self)
         if not use_cache:
             last_state = None
+        if last_state is not None:
+            # NOTE: decode steps update state in place
+            last_state.advance(k.shape[-2] - q.shape[-2], q.shape[-2])
         
         # print('state', use_cache, strify(last_state), strify(q), strify(k), strify(v))
         
@@ -459,7 +502,16 @@ class PerlinAttention(nn.Module):
             N, H, T, HID = q.shape
             with timer("vmask"):
                 # if not causal, we just use Eye matrix for V_identity
-                if not self.pconfig.causal:
+                if not self.pconfig.causal and V_IDENTITY == 'hat':
+                    with timer("vmask.hat"):
+                        # NOTE: computed on device from the mask, without syncing valid lengths to host
+                        v_for_atten_identity = v_identity_hat(
+                            zero_one_attention_mask_cumsum.view(N, T), 
+                            zero_one_attention_mask_sum.view(N), 
+                            HID,
+                        ).to(v.dtype)
+                        v_for_atten_identity = v_for_atten_identity.unsqueeze(1).expand(N, v_for_atten.shape[1], T, HID)
+                elif not self.pconfig.causal:
                     with timer("vmaks.eye"):
                         # E_N = min(T, HID)
                         E_N = HID
@@ -772,188 +824,242 @@ class PerlinAttention(nn.Module):
             # return DUMMY_OUTPUT #1518
             
             with timer("mask"):
-                # TODO: perform this with states
-                
-                if not not_padded:
-                    estimated_attention_probs = estimated_attention_probs * (dst_attention_mask > -1)
-                
                 N, H, T, T_M = estimated_attention_probs.shape
-                assert T == T_DST, f"{T}=={T_DST}, {estimated_attention_probs.shape} {not_padded}"
-                token_length = (attention_mask > -1).long().sum(-1).view(N, -1)
-                top_k = min(max(int(round(self.pconfig.k * (T_M / torch.min(token_length).item()))), 1), T_M)
-                k_flatten = self.pconfig.k_flatten
-                k_flatten_dim = self.pconfig.k_flatten_dim
-                if not k_flatten:
-                    k_flatten = True
-                    k_flatten_dim = 'query'
-                
-                if not k_flatten:
-                    raise Exception()
-                    with timer("mask.topk"):
-                        _, indices = torch.topk(
-                            estimated_attention_probs, # estimation gradient is cut here
-                            k=top_k, 
-                            dim=-1, 
-                            sorted=True,
+                sparse_mask_format = os.environ.get('PERLIN_SPARSE_MASK_FORMAT', 'flat_csr')
+                from .ops import use_decode_row_mask
+                if self.benchmarking and\
+                    use_cache and\
+                    self.pconfig.causal and\
+                    T_DST == 1 and\
+                    self.pconfig.k_flatten and self.pconfig.k_flatten_dim == 'causal_batch' and\
+                    sparse_mask_format in ['flat_csr', 'binary', 'block_run'] and\
+                    use_decode_row_mask():
+                    # NOTE: decoding single row with cache. select top-k of the row, and emit its columns directly
+                    with timer("mask.decode_row"):
+                        from .ops import decode_row_sparse_mask
+                        partial_attention_mask = decode_row_sparse_mask(
+                            estimated_attention_probs,
+                            k=self.pconfig.k,
+                            target_width=T_SRC,
+                            k_oversample=self.pconfig.k_oversample,
+                            dst_alive=~(dst_attention_mask < -1).view(N),
+                            mask_format=sparse_mask_format,
                         )
-                    with timer("mask.empty"):
-                        partial_attention_mask = torch.empty(
-                            (N, H, T, T_M),
-                            dtype=q_for_score.dtype,
-                            device=q_for_score.device,
-                        )
-                    with timer("mask.fill"):
-                        partial_attention_mask.fill_(FP_MIN)
-                    with timer("mask.scatter"):
-                        partial_attention_mask.scatter_(dim=-1, index=indices, value=0)
-                    with timer("mask.mask_per_item"):
-                        per_item_top_k = token_length * H * (self.pconfig.k * T_M / token_length)
                 else:
-                    top_k_elems = None
-                    per_item_top_k = None 
-                    assert k_flatten_dim in ['head', 'batch', 'causal_batch', 'query']
-                    with timer("mask.view"):
-                        masked_estimated_attention_probs = (estimated_attention_probs * (dst_attention_mask > -1))
+                    # TODO: perform this with states
+                
+                    if not not_padded:
+                        estimated_attention_probs = estimated_attention_probs * (dst_attention_mask > -1)
+                
+                    N, H, T, T_M = estimated_attention_probs.shape
+                    assert T == T_DST, f"{T}=={T_DST}, {estimated_attention_probs.shape} {not_padded}"
+                    token_length = (attention_mask > -1).long().sum(-1).view(N, -1)
+                    top_k = min(max(int(round(self.pconfig.k * (T_M / torch.min(token_length).item()))), 1), T_M)
+                    k_flatten = self.pconfig.k_flatten
+                    k_flatten_dim = self.pconfig.k_flatten_dim
+                    if not k_flatten:
+                        k_flatten = True
+                        k_flatten_dim = 'query'
+                
+                    if not k_flatten:
+                        raise Exception()
+                        with timer("mask.topk"):
+                            _, indices = torch.topk(
+                                estimated_attention_probs, # estimation gradient is cut here
+                                k=top_k, 
+                                dim=-1, 
+                                sorted=True,
+                            )
+                        with timer("mask.empty"):
+                            partial_attention_mask = torch.empty(
+                                (N, H, T, T_M),
+                                dtype=q_for_score.dtype,
+                                device=q_for_score.device,
+                            )
+                        with timer("mask.fill"):
+                            partial_attention_mask.fill_(FP_MIN)
+                        with timer("mask.scatter"):
+                            partial_attention_mask.scatter_(dim=-1, index=indices, value=0)
+                        with timer("mask.mask_per_item"):
+                            per_item_top_k = token_length * H * (self.pconfig.k * T_M / token_length)
+                    else:
+                        top_k_elems = None
+                        per_item_top_k = None 
+                        assert k_flatten_dim in ['head', 'batch', 'causal_batch', 'query']
+                        with timer("mask.view"):
+                            masked_estimated_attention_probs = (estimated_attention_probs * (dst_attention_mask > -1))
                         
-                        get_bench().register_temp_buffer('masked_estimated_attention_probs', masked_estimated_attention_probs)
+                            get_bench().register_temp_buffer('masked_estimated_attention_probs', masked_estimated_attention_probs)
                         
-                        # return DUMMY_OUTPUT
+                            # return DUMMY_OUTPUT
                     
-                        if not self.pconfig.causal:
-                            token_length = (attention_mask > -1).long().sum(-1).view(N, -1)
-                        else:
-                            # _causal_token_length = (causal_attention_mask > -1).long().sum(-1).view(N, 1, T_DST, 1)
-                            causal_token_length = torch.arange(1, T_DST+1, dtype=torch.long, device=attention_mask.device).view(1, 1, T_DST, 1).expand(N, 1, T_DST, 1)
-                            # print(_causal_token_length)
-                            # print(causal_token_length)
-                            # assert ((_causal_token_length - causal_token_length).abs().sum().item() < 1e-4), (_causal_token_length - causal_token_length).abs().sum().item()
-                        
-                        # return DUMMY_OUTPUT
-                        
-                        if k_flatten_dim == 'batch':
-                            assert not self.pconfig.causal
-                            t = masked_estimated_attention_probs.view(N, H*T*T_M)
-                            # top_k_elems = top_k*T*H
-                            per_item_top_k = token_length * H * (self.pconfig.k * self.pconfig.k_oversample * T_M / token_length)
-                        elif k_flatten_dim == 'head':
-                            assert not self.pconfig.causal
-                            t = masked_estimated_attention_probs.view(N, H, T*T_M)
-                            # top_k_elems = top_k*T
-                            per_item_top_k = (token_length * (self.pconfig.k * self.pconfig.k_oversample * T_M / token_length)).view(N, 1, 1)
-                        elif k_flatten_dim == 'causal_batch':
-                            t = masked_estimated_attention_probs.transpose(1, 2).reshape(N, T, H*T_M)
                             if not self.pconfig.causal:
-                                per_item_top_k = (H * (self.pconfig.k * self.pconfig.k_oversample * T_M / token_length)).view(N, 1, 1)
+                                token_length = (attention_mask > -1).long().sum(-1).view(N, -1)
                             else:
-                                # NOTE consider causal token length
-                                per_item_top_k = (H * (self.pconfig.k * self.pconfig.k_oversample * T_M / causal_token_length.squeeze(0))).view(N, T_DST, 1) #, 1, H*T_M)
-                        elif k_flatten_dim == 'query':
-                            assert not self.pconfig.causal
-                            t = masked_estimated_attention_probs.view(N, H, T, T_M)
-                            per_item_top_k = (self.pconfig.k * self.pconfig.k_oversample * T_M / token_length).view(N, 1, 1, 1)
-                        else: raise Exception()
+                                # _causal_token_length = (causal_attention_mask > -1).long().sum(-1).view(N, 1, T_DST, 1)
+                                # NOTE: with cache, query rows are the last T_DST rows of T_SRC
+                                causal_token_length = torch.arange(T_SRC-T_DST+1, T_SRC+1, dtype=torch.long, device=attention_mask.device).view(1, 1, T_DST, 1).expand(N, 1, T_DST, 1)
+                                # print(_causal_token_length)
+                                # print(causal_token_length)
+                                # assert ((_causal_token_length - causal_token_length).abs().sum().item() < 1e-4), (_causal_token_length - causal_token_length).abs().sum().item()
                         
-                        per_item_top_k = torch.round(per_item_top_k)
+                            # return DUMMY_OUTPUT
                         
-                        # per_item_top_k_rounded = torch.round(per_item_top_k)
-                        # per_item_top_k_floored = torch.floor(per_item_top_k)
-                        # per_item_top_k_ceil_prob = per_item_top_k - per_item_top_k_floored
-                        # per_item_top_k_prob_rounded = per_item_top_k_floored + (torch.rand_like(per_item_top_k_ceil_prob) < per_item_top_k_ceil_prob) * 1
-                        # per_item_top_k = per_item_top_k_prob_rounded
-                        # per_item_top_k = per_item_top_k_rounded * (per_item_top_k_rounded >= 1) + per_item_top_k_lower * (per_item_top_k_rounded < 1)
+                            if k_flatten_dim == 'batch':
+                                assert not self.pconfig.causal
+                                t = masked_estimated_attention_probs.view(N, H*T*T_M)
+                                # top_k_elems = top_k*T*H
+                                per_item_top_k = token_length * H * (self.pconfig.k * self.pconfig.k_oversample * T_M / token_length)
+                            elif k_flatten_dim == 'head':
+                                assert not self.pconfig.causal
+                                t = masked_estimated_attention_probs.view(N, H, T*T_M)
+                                # top_k_elems = top_k*T
+                                per_item_top_k = (token_length * (self.pconfig.k * self.pconfig.k_oversample * T_M / token_length)).view(N, 1, 1)
+                            elif k_flatten_dim == 'causal_batch':
+                                t = masked_estimated_attention_probs.transpose(1, 2).reshape(N, T, H*T_M)
+                                if not self.pconfig.causal:
+                                    per_item_top_k = (H * (self.pconfig.k * self.pconfig.k_oversample * T_M / token_length)).view(N, 1, 1)
+                                else:
+                                    # NOTE consider causal token length
+                                    per_item_top_k = (H * (self.pconfig.k * self.pconfig.k_oversample * T_M / causal_token_length.squeeze(0))).view(N, T_DST, 1) #, 1, H*T_M)
+                            elif k_flatten_dim == 'query':
+                                assert not self.pconfig.causal
+                                t = masked_estimated_attention_probs.view(N, H, T, T_M)
+                                per_item_top_k = (self.pconfig.k * self.pconfig.k_oversample * T_M / token_length).view(N, 1, 1, 1)
+                            else: raise Exception()
                         
-                        # NOTE to prevent 0 top-k when large T and small T_m, we take care of lower bound in kernel implemenation.
-                        per_item_top_k = torch.clamp_min(per_item_top_k, 1)
+                            per_item_top_k = torch.round(per_item_top_k)
                         
-                        top_k_elems = min(int(math.ceil(torch.max(per_item_top_k).item())), t.shape[-1])
-                        get_bench().register_temp_buffer('per_item_top_k', per_item_top_k)
-                        get_bench().register_temp_buffer('top_k_elems', None, lazy=lambda: torch.tensor(top_k_elems, dtype=torch.float64))
-                    with timer("mask.topk"):
-                        if top_k_elems < t.shape[-1] * 0.9:
-                            _, indices = torch.topk(
-                                input=t,
-                                k=top_k_elems, 
-                                dim=-1, 
-                                sorted=True #sorted true is important
-                            )
-                        else:
-                            _, indices = torch.sort(
-                                t,
-                                dim=-1,
-                                descending=True,
-                                stable=False,
-                            )
-                            indices = indices[...,:top_k_elems]
-                        get_bench().register_temp_buffer('topk_indices', indices.double())
-                    with timer("mask.empty"):
-                        partial_attention_mask = torch.empty(
-                            t.shape, 
-                            dtype=torch.long, 
-                            device=attention_mask.device,
-                        )
-                    with timer("mask.fill"):
-                        partial_attention_mask.fill_(t.shape[-1])
-                    with timer("mask.scatter"):
-                        partial_attention_mask.scatter_(
-                            dim=-1,
-                            index=indices,
-                            src=torch.arange(
-                                top_k_elems, 
-                                dtype=torch.long,
-                                device=attention_mask.device, 
-                            )\
-                                .view((1, -1) if t.ndim == 2 else (1, 1, -1))\
-                                .expand(indices.shape)
-                        )
-                    with timer("mask.masked_fill"):
-                        if not self.benchmarking:
-                            t_dead_mask = partial_attention_mask >= per_item_top_k
-                            # partial_attention_mask.fill_(FP_MIN)
-                            # partial_attention_mask.masked_fill_(t_alive_mask, value=0)
-                            get_bench().register_temp_buffer('t_dead_mask', None, lambda: t_dead_mask.float())
-                            partial_attention_mask = t_dead_mask.to(q.dtype) * FP_MIN
+                            # per_item_top_k_rounded = torch.round(per_item_top_k)
+                            # per_item_top_k_floored = torch.floor(per_item_top_k)
+                            # per_item_top_k_ceil_prob = per_item_top_k - per_item_top_k_floored
+                            # per_item_top_k_prob_rounded = per_item_top_k_floored + (torch.rand_like(per_item_top_k_ceil_prob) < per_item_top_k_ceil_prob) * 1
+                            # per_item_top_k = per_item_top_k_prob_rounded
+                            # per_item_top_k = per_item_top_k_rounded * (per_item_top_k_rounded >= 1) + per_item_top_k_lower * (per_item_top_k_rounded < 1)
+                        
+                            # NOTE to prevent 0 top-k when large T and small T_m, we take care of lower bound in kernel implemenation.
+                            per_item_top_k = torch.clamp_min(per_item_top_k, 1)
+                        
+                            top_k_elems = min(int(math.ceil(torch.max(per_item_top_k).item())), t.shape[-1])
+                            get_bench().register_temp_buffer('per_item_top_k', per_item_top_k)
+                            get_bench().register_temp_buffer('top_k_elems', None, lazy=lambda: torch.tensor(top_k_elems, dtype=torch.float64))
+                        sparse_mask_format = os.environ.get('PERLIN_SPARSE_MASK_FORMAT', 'flat_csr')
+                        from .ops import use_fused_topk_mask
+                        if self.benchmarking and\
+                            k_flatten_dim == 'causal_batch' and\
+                            sparse_mask_format in ['flat_csr', 'binary', 'block_run'] and\
+                            use_fused_topk_mask(t):
+                            # NOTE: select top-k and emit interpolated sparse mask directly, without dense compressed mask
+                            with timer("mask.topk_sparse"):
+                                from .ops import topk_sparse_mask
+                                partial_attention_mask = topk_sparse_mask(
+                                    t,
+                                    per_item_top_k,
+                                    H=H,
+                                    k=self.pconfig.k,
+                                    target_width=T_SRC,
+                                    dst_alive=~(dst_attention_mask < -1).expand(N, 1, T_DST, 1).reshape(N, T_DST),
+                                    is_causal=self.pconfig.causal,
+                                    top_k_elems=top_k_elems,
+                                    mask_format=sparse_mask_format,
+                                )
                         else:
-                            t_alive_mask = partial_attention_mask < per_item_top_k
-                            partial_attention_mask = t_alive_mask.float()
+                            if use_threshold_select(t):
+                                # NOTE: only membership of top-k is used, select with per-row threshold without sorting
+                                with timer("mask.threshold"):
+                                    t_alive_mask = topk_threshold_mask(t, per_item_top_k)
+                            else:
+                                with timer("mask.topk"):
+                                    if top_k_elems < t.shape[-1] * 0.9:
+                                        _, indices = torch.topk(
+                                            input=t,
+                                            k=top_k_elems, 
+                                            dim=-1, 
+                                            sorted=True #sorted true is important
+                                        )
+                                    else:
+                                        _, indices = torch.sort(
+                                            t,
+                                            dim=-1,
+                                            descending=True,
+                                            stable=False,
+                                        )
+                                        indices = indices[...,:top_k_elems]
+                                    get_bench().register_temp_buffer('topk_indices', indices.double())
+                                with timer("mask.empty"):
+                                    partial_attention_mask = torch.empty(
+                                        t.shape, 
+                                        dtype=torch.long, 
+                                        device=attention_mask.device,
+                                    )
+                                with timer("mask.fill"):
+                                    partial_attention_mask.fill_(t.shape[-1])
+                                with timer("mask.scatter"):
+                                    partial_attention_mask.scatter_(
+                                        dim=-1,
+                                        index=indices,
+                                        src=torch.arange(
+                                            top_k_elems, 
+                                            dtype=torch.long,
+                                            device=attention_mask.device, 
+                                        )\
+                                            .view((1, -1) if t.ndim == 2 else (1, 1, -1))\
+                                            .expand(indices.shape)
+                                    )
+                                t_alive_mask = partial_attention_mask < per_item_top_k
+                            with timer("mask.masked_fill"):
+                                if not self.benchmarking:
+                                    t_dead_mask = ~t_alive_mask
+                                    # partial_attention_mask.fill_(FP_MIN)
+                                    # partial_attention_mask.masked_fill_(t_alive_mask, value=0)
+                                    get_bench().register_temp_buffer('t_dead_mask', None, lambda: t_dead_mask.float())
+                                    partial_attention_mask = t_dead_mask.to(q.dtype) * FP_MIN
+                                else:
+                                    partial_attention_mask = t_alive_mask.float()
                     
-                    if k_flatten_dim == 'causal_batch':
-                        # need to mask time dimension
-                        partial_attention_mask = partial_attention_mask.view(N, T, H, T_M).transpose(1, 2)
-                        if not self.benchmarking:
-                            partial_attention_mask.masked_fill_(
-                                mask=dst_attention_mask < -1,
-                                value=FP_MIN
-                            )
-                        else:
-                            partial_attention_mask.masked_fill_(
-                                mask=dst_attention_mask < -1,
-                                value=0
-                            )
-                    elif k_flatten_dim == 'query':
-                        partial_attention_mask = partial_attention_mask.view(N, H, T, T_M)
-                        if not self.benchmarking:
-                            partial_attention_mask.masked_fill_(
-                                mask=dst_attention_mask < -1,
-                                value=FP_MIN
-                            )
-                        else:
-                            partial_attention_mask.masked_fill_(
-                                mask=dst_attention_mask < -1,
-                                value=0
-                            )
-                    elif k_flatten_dim in ['batch', 'head']:
-                        pass
-                    else: raise Exception()
-                    partial_attention_mask = partial_attention_mask.view(N, H, T, T_M)
+                            if k_flatten_dim == 'causal_batch':
+                                # need to mask time dimension
+                                partial_attention_mask = partial_attention_mask.view(N, T, H, T_M).transpose(1, 2)
+                                if not self.benchmarking:
+                                    partial_attention_mask.masked_fill_(
+                                        mask=dst_attention_mask < -1,
+                                        value=FP_MIN
+                                    )
+                                else:
+                                    partial_attention_mask.masked_fill_(
+                                        mask=dst_attention_mask < -1,
+                                        value=0
+                                    )
+                            elif k_flatten_dim == 'query':
+                                partial_attention_mask = partial_attention_mask.view(N, H, T, T_M)
+                                if not self.benchmarking:
+                                    partial_attention_mask.masked_fill_(
+                                        mask=dst_attention_mask < -1,
+                                        value=FP_MIN
+                                    )
+                                else:
+                                    partial_attention_mask.masked_fill_(
+                                        mask=dst_attention_mask < -1,
+                                        value=0
+                                    )
+                            elif k_flatten_dim in ['batch', 'head']:
+                                pass
+                            else: raise Exception()
+                            partial_attention_mask = partial_attention_mask.view(N, H, T, T_M)
             
             # return DUMMY_OUTPUT #1518
             
-            get_bench().register_temp_buffer('partial_attention_mask_before_interp', partial_attention_mask)
+            from .ops import is_sparse_mask
+            if not is_sparse_mask(partial_attention_mask):
+                get_bench().register_temp_buffer('partial_attention_mask_before_interp', partial_attention_mask)
             
             with timer("interp"):
-                # NOTE: partial attention mask should be filled with 0 and -inf only.
-                raise_if_nan(partial_attention_mask)
-                if not self.benchmarking:
+                if is_sparse_mask(partial_attention_mask):
+                    # NOTE: already interpolated by topk_sparse_mask
+                    pass
+                elif not self.benchmarking:
+                    # NOTE: partial attention mask should be filled with 0 and -inf only.
+                    raise_if_nan(partial_attention_mask)
                     with timer("interp.resize"):
                         # TODO Fix this function to return COO tensor
                         # print('resize', strify(partial_attention_mask))
@@ -961,6 +1067,7 @@ class PerlinAttention(nn.Module):
                         if self.pconfig.causal:
                             partial_attention_mask.masked_fill_(causal_attention_mask < -1, FP_MIN)
                 else:
+                    raise_if_nan(partial_attention_mask)
                     if not self.pconfig.causal:
                         def resize_width(img: torch.Tensor, scale: float):
                             N, H, W = img.shape
@@ -1018,13 +1125,25 @@ class PerlinAttention(nn.Module):
                         # partial_attention_mask_original = resize_from_m_to_t(partial_attention_mask, FP_MIN if not self.benchmarking else 0).view(N*H, T, T).to_sparse_coo()
                         
                         # optimized
-                        SPARSITY_TYPE = 'flat_csr'
+                        SPARSITY_TYPE = os.environ.get('PERLIN_SPARSE_MASK_FORMAT', 'flat_csr')
                         if SPARSITY_TYPE == 'flat_csr':
                             with timer("interp.csr"):
                                 from .ops import resize_from_m_to_t_csr
                                 partial_attention_mask = resize_from_m_to_t_csr(
                                     partial_attention_mask, 0, k=self.pconfig.k, target_width=T_SRC, is_causal=False, benchmarking=True, oversampled=self.pconfig.k_oversample
                                 )
+                        elif SPARSITY_TYPE == 'binary':
+                            with timer("interp.binary"):
+                                from .ops import resize_from_m_to_t_csr
+                                partial_attention_mask = resize_from_m_to_t_csr(
+                                    partial_attention_mask, 0, k=self.pconfig.k, target_width=T_SRC, is_causal=False, benchmarking=True, oversampled=self.pconfig.k_oversample, binary=True
+                                )
+                        elif SPARSITY_TYPE == 'block_run':
+                            with timer("interp.block_run"):
+                                from .ops import resize_from_m_to_t_block_run
+                                partial_attention_mask = resize_from_m_to_t_block_run(
+                                    partial_attention_mask, 0, k=self.pconfig.k, target_width=T_SRC, is_causal=False, oversampled=self.pconfig.k_oversample
+                                )
                         elif SPARSITY_TYPE == 'coo':
                             with timer("interp.coo"):
                                 partial_attention_mask = partial_attention_mask.reshape(N*H, T, T_M).to_sparse_coo()
@@ -1033,23 +1152,34 @@ class PerlinAttention(nn.Module):
                             raise Exception()
                     else:
                         # TODO support causal sparse masking
-                        SPARSITY_TYPE = 'flat_csr'
+                        SPARSITY_TYPE = os.environ.get('PERLIN_SPARSE_MASK_FORMAT', 'flat_csr')
                         
                         if SPARSITY_TYPE == 'flat_csr':
                             from .ops import resize_from_m_to_t_csr
                             partial_attention_mask = resize_from_m_to_t_csr(
                                 partial_attention_mask, 0, k=self.pconfig.k, target_width=T_SRC, oversampled=self.pconfig.k_oversample
                             )
+                        elif SPARSITY_TYPE == 'binary':
+                            from .ops import resize_from_m_to_t_csr
+                            partial_attention_mask = resize_from_m_to_t_csr(
+                                partial_attention_mask, 0, k=self.pconfig.k, target_width=T_SRC, oversampled=self.pconfig.k_oversample, binary=True
+                            )
+                        elif SPARSITY_TYPE == 'block_run':
+                            from .ops import resize_from_m_to_t_block_run
+                            partial_attention_mask = resize_from_m_to_t_block_run(
+                                partial_attention_mask, 0, k=self.pconfig.k, target_width=T_SRC, oversampled=self.pconfig.k_oversample
+                            )
                         elif SPARSITY_TYPE == 'coo':
                             partial_attention_mask = resize_from_m_to_t(partial_attention_mask, FP_MIN if not self.benchmarking else 0).view(N*H, T, T).to_sparse_coo()
                         else:
                             raise Exception()
                 
-                raise_if_nan(partial_attention_mask)
+                if isinstance(partial_attention_mask, torch.Tensor):
+                    raise_if_nan(partial_attention_mask)
             
             # return DUMMY_OUTPUT #1686
             
-            if partial_attention_mask.is_sparse_csr:
+            if is_sparse_mask(partial_attention_mask):
                 from .ops import flat_csr_to_dense
                 get_bench().register_temp_buffer('partial_attention_mask', None, lazy=lambda: flat_csr_to_dense(partial_attention_mask, T_SRC, H))
             else:
@@ -1148,29 +1278,42 @@ class PerlinAttention(nn.Module):
                     N, H, T, HEAD_H = q_for_score.shape
                     # print((partial_attention_mask > -1).sum(), (partial_attention_mask > -1).sum() / partial_attention_mask.numel())
                     with mem("attention"):
-                        if partial_attention_mask.is_sparse_csr:
+                        if is_sparse_mask(partial_attention_mask):
                             from .ops import (
                                 flat_csr_masked_bmm,
                                 flat_csr_softmax,
                                 flat_csr_elmul,
                                 flat_csr_sdbmm,
+                                flat_csr_fused_attention,
+                                use_fused_attention,
                             )
-                            with timer('attention.sparse.maksed_bmm'):
-                                partial_attention_scores = flat_csr_masked_bmm(
-                                    q_for_score, k_for_score, partial_attention_mask
-                                )
-                            with timer('attention.sparse.softmax'):
-                                partial_attention_probs = flat_csr_softmax(
-                                    partial_attention_scores, H, T_SRC
-                                )
-                            with timer('attention.sparse.scaler'):
-                                estimated_scales = self.attention_predictor_dec_scaler(t_attention_predictor)
-                            with timer('attention.sparse.elmul'):
-                                if self.pconfig.partial_attention_scaler:
-                                    row_scaler = torch.sigmoid(estimated_scales[..., 0]).view(N, H, T_DST, 1).expand(N, H, T_DST, T_SRC)
-                                    partial_attention_probs = flat_csr_elmul(partial_attention_probs, row_scaler)
-                            with timer('attention.sparse.sdbmm'):
-                                partial_context_layer = flat_csr_sdbmm(partial_attention_probs, v, T_M)
+                            if use_fused_attention(q_for_score):
+                                with timer('attention.sparse.scaler'):
+                                    estimated_scales = self.attention_predictor_dec_scaler(t_attention_predictor)
+                                    row_scaler = None
+                                    if self.pconfig.partial_attention_scaler:
+                                        row_scaler = torch.sigmoid(estimated_scales[..., 0]).view(N, H, T_DST)
+                                with timer('attention.sparse.fused'):
+                                    partial_context_layer = flat_csr_fused_attention(
+                                        q_for_score, k_for_score, v, partial_attention_mask, row_scaler, T_M, fused=True
+                                    )
+                            else:
+                                with timer('attention.sparse.maksed_bmm'):
+                                    partial_attention_scores = flat_csr_masked_bmm(
+                                        q_for_score, k_for_score, partial_attention_mask
+                                    )
+                                with timer('attention.sparse.softmax'):
+                                    partial_attention_probs = flat_csr_softmax(
+                                        partial_attention_scores, H, T_SRC
+                                    )
+                                with timer('attention.sparse.scaler'):
+                                    estimated_scales = self.attention_predictor_dec_scaler(t_attention_predictor)
+                                with timer('attention.sparse.elmul'):
+                                    if self.pconfig.partial_attention_scaler:
+                                        row_scaler = torch.sigmoid(estimated_scales[..., 0]).view(N, H, T_DST, 1).expand(N, H, T_DST, T_SRC)
+                                        partial_attention_probs = flat_csr_elmul(partial_attention_probs, row_scaler)
+                                with timer('attention.sparse.sdbmm'):
+                                    partial_context_layer = flat_csr_sdbmm(partial_attention_probs, v, T_M)
                         else:
                             with timer("attention.coo"), mem("attention.coo"):
                                 if not partial_attention_mask.is_sparse:
@@ -1206,7 +1349,15 @@ class PerlinAttention(nn.Module):
                 # return DUMMY_OUTPUT #2782
                 
                 with timer("attention.avg_pool"):
-                    if not self.pconfig.causal:
+                    if not self.pconfig.causal and AVG_POOL == 'compressed':
+                        # NOTE: sum over T of V weighted by resized probs is dot product with bucketed V sums in T_M
+                        T_M = estimated_attention_probs.shape[-1]
+                        v_bucketed = bucket_sum_m(v, token_index_m(attention_mask, T_M), T_M)
+                        average_context_layer = torch.matmul(
+                            estimated_attention_probs.mean(-2, keepdim=True).to(v_bucketed.dtype), 
+                            v_bucketed,
+                        ).to(v.dtype)
+                    elif not self.pconfig.causal:
                         average_context_layer = (
                             v *\
                             (dst_attention_mask > -1).to(v.dtype) *\
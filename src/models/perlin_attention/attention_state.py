@@ -1,4 +1,5 @@
 import copy
+import os
 import math
 import random
 import time
@@ -26,6 +27,7 @@ from ..common.lora import (
     lora_forward_lora
 )
 from ..common.performer import ProjectionUpdater
+from ..common.linear_attention import causal_linear_attention
 from ..hf_bert import BertConfig
 from .config import PerlinAttentionConfig, get_default_config
 from ...utils import raise_if_nan, strify
@@ -35,11 +37,21 @@ from .modules import (
     KeepRes,
     CausalConv2d,
     UpsampleFP32,
-    interpolate
+    interpolate,
+    is_streamable,
+    stream_forward,
 )
 from math import ceil, floor
 timer = lambda name: get_bench().region(name)
 
+def index_select_batch(t, index: torch.Tensor):
+    """
+    selects rows of batch (dim 0) of sub-state tensor. non tensor values (e.g. initial zero) are shared
+    """
+    if not isinstance(t, torch.Tensor):
+        return t
+    return t.index_select(0, index.to(t.device))
+
 class StatefulCausalPerformer:
     def __init__(self, parent: "PerlinAttentionState", performer: FastAttention):
         self.parent = parent
@@ -77,25 +89,18 @@ class StatefulCausalPerformer:
         # # context = self.performer(q, k, v)
         # # return context
         
-        last_k_cumsum = 0
-        last_context_cumsum = 0
-        outs = []
-        
-        chunk_size = min(q.shape[-2], 16)
-
-        for q, k, v in zip(*map(lambda t: t.chunk(chunk_size, dim = -2), (q, k[...,-q.shape[-2]:, :], v[...,-q.shape[-2]:, :]))):
-            k_cumsum = self.last_k_cumsum + k.cumsum(dim=-2, dtype=torch.float64)
-
-            D_inv = 1. / torch.einsum('...nd,...nd->...n', q, k_cumsum.type_as(q) + 1e-12)
-            context = torch.einsum('...nd,...ne->...nde', k, v)
-            context_cumsum = self.last_context_cumsum + context.cumsum(dim=-3, dtype=torch.float64)
-            out = torch.einsum('...nde,...nd,...n->...ne', context_cumsum.type_as(q), q, D_inv)
-
-            self.last_k_cumsum = k_cumsum[:, :, -1:]
-            self.last_context_cumsum = context_cumsum[:, :, -1:]
-            outs.append(out)
-
-        return torch.cat(outs, dim = -2)
+        # NOTE: sums are kept as (..., 1, D) and (..., 1, D, E), same layout with cumsum implementation
+        T = q.shape[-2]
+        out, k_sum, kv_sum = causal_linear_attention(
+            q, k[...,-T:,:], v[...,-T:,:],
+            k_sum=self.last_k_cumsum[...,0,:] if isinstance(self.last_k_cumsum, torch.Tensor) else None,
+            kv_sum=self.last_context_cumsum[...,0,:,:] if isinstance(self.last_context_cumsum, torch.Tensor) else None,
+            eps=1e-12,
+            normalize='performer',
+        )
+        self.last_k_cumsum = k_sum.unsqueeze(-2)
+        self.last_context_cumsum = kv_sum.unsqueeze(-3)
+        return out
 
     def _causal_linear_attention_noncuda_stateful(
         self, q, k, v, chunk_size = None, eps = 1e-6
@@ -139,16 +144,35 @@ class StatefulCausalPerformer:
         new.qs = list([q for q in self.qs])
         return new
 
+    def index_select(self, parent: "PerlinAttentionState", index: torch.Tensor):
+        new = StatefulCausalPerformer(parent, self.performer)
+        new.seq_index = self.seq_index
+        new.last_k_cumsum = index_select_batch(self.last_k_cumsum, index)
+        new.last_context_cumsum = index_select_batch(self.last_context_cumsum, index)
+        new.qs = [index_select_batch(q, index) for q in self.qs]
+        return new
+
+STREAMING_CNN = os.environ.get('PERLIN_STREAMING_CNN', '1') == '1'
+
 class StatefulCausalCNN:
-    def __init__(self, parent: "PerlinAttentionState"):
+    def __init__(self, parent: "PerlinAttentionState", cnn: torch.nn.Module = None):
         self.parent = parent
         self.max_seq_len = self.parent.max_seq_length
         self.window_size = 24
         self.window_align = 1
         self.xs = []
         self.xs_len = 0
+        
+        # if every layer is row-wise or causal conv, only new rows are computed with per-layer history buffers.
+        # otherwise, the cnn runs on window of last rows.
+        self.streaming = STREAMING_CNN and (cnn is not None) and is_streamable(cnn)
+        self.buffers = {}
     
     def __call__(self, cnn: torch.nn.Module, x: torch.Tensor, x_len: int):
+        if self.streaming and x.shape[-2] == x_len:
+            return stream_forward(cnn, x, self.buffers)
+        assert not self.streaming, "query skips are not supported by streaming cnn"
+        
         # assert x.shape[-2] == x_len, f"{x.shape}[-2] == {x_len}"
         # x = x[...,-x_len:,:]
         
@@ -188,6 +212,8 @@ class StatefulCausalCNN:
     
     def strify(self):
         return strify({
+            'streaming': int(self.streaming),
+            'buffers': list(self.buffers.values()),
             'ws': self.window_size,
             'wa': self.window_align,
             'xs': self.xs,
@@ -200,6 +226,19 @@ class StatefulCausalCNN:
         new.window_size = self.window_size
         new.xs_len = self.xs_len
         new.xs = list([it for it in self.xs]) # shallow copy
+        new.streaming = self.streaming
+        # history buffers are replaced, not modified in place
+        new.buffers = dict(self.buffers)
+        return new
+
+    def index_select(self, parent: "PerlinAttentionState", index: torch.Tensor):
+        new = StatefulCausalCNN(parent)
+        new.window_align = self.window_align
+        new.window_size = self.window_size
+        new.xs_len = self.xs_len
+        new.xs = [index_select_batch(x, index) for x in self.xs]
+        new.streaming = self.streaming
+        new.buffers = {key: index_select_batch(buffer, index) for key, buffer in self.buffers.items()}
         return new
 
 class StatefulCumAvg:
@@ -235,21 +274,52 @@ class StatefulCumAvg:
         new.prev_len = self.prev_len
         return new
 
+    def index_select(self, parent: "PerlinAttentionState", index: torch.Tensor):
+        new = StatefulCumAvg(parent)
+        new.cumsum = index_select_batch(self.cumsum, index)
+        new.prev_len = self.prev_len
+        return new
+
 class PerlinAttentionState:
+    """
+    decoding state of perlin attention layer.
+    
+    decode steps update sub-states in place. sub-states are copied only when they are
+    shared with other state by `fork()` (copy-on-write), therefore branching operations
+    (e.g. beam search) should fork the state before the branches are decoded.
+    `length` counts consumed tokens, and detects states which are advanced by other branch.
+    """
     def __init__(self, parent: "PerlinAttention"):
         if parent is not None:
             self.num_heads = parent.num_attention_heads
             self.head_dim = parent.attention_head_size
             self.embd_dim = parent.all_head_size
+        else:
+            self.num_heads = self.head_dim = self.embd_dim = None
         self.max_seq_length = 768
         
+        self.length = 0
+        # tokens evicted from KV cache, past has `length - evicted` tokens
+        self.evicted = 0
         self.states = {}
+        # names of sub-states which are referenced by forked states too
+        self.shared = set()
     
-    def get_cloned_state(self, name: str, initializer=None):
+    def advance(self, past_length: int, length: int):
+        if past_length + self.evicted != self.length:
+            raise Exception(
+                f'state consumed {self.length} tokens, but past has {past_length} (+{self.evicted} evicted) tokens. '
+                'state is advanced by other branch, fork() it before branching'
+            )
+        self.length += length
+    
+    def get_state(self, name: str, initializer=None):
         if name in self.states:
-            new_state = self.states[name].clone()
-            self.states[name] = new_state
-            return new_state
+            if name in self.shared:
+                with timer(name+'.cow'):
+                    self.states[name] = self.states[name].clone()
+                self.shared.discard(name)
+            return self.states[name]
         else:
             state = initializer()
             self.states[name] = state
@@ -266,8 +336,6 @@ class PerlinAttentionState:
         if state is None:
             return None, func(x)
         else:
-            with timer(name+'.clone'):
-                state = state.clone()
             return state, state.forward_causal_cnn_op(name, func, x, x_len)
     
     def forward_causal_cnn_op(
@@ -277,7 +345,7 @@ class PerlinAttentionState:
         x: torch.Tensor,
         x_len: int,
     ):
-        state = self.get_cloned_state(name, lambda: StatefulCausalCNN(self))
+        state = self.get_state(name, lambda: StatefulCausalCNN(self, func))
         return state(func, x, x_len)
     
     @staticmethod
@@ -290,8 +358,6 @@ class PerlinAttentionState:
         v: torch.Tensor,
     ):
         if state is not None:
-            with timer(name+'.clone'):
-                state = state.clone()
             return state, state.forward_performer(
                 name=name,
                 performer=performer,
@@ -308,7 +374,7 @@ class PerlinAttentionState:
         k: torch.Tensor,
         v: torch.Tensor,
     ):
-        state = self.get_cloned_state(
+        state = self.get_state(
             name, 
             lambda: StatefulCausalPerformer(self, performer)
         )
@@ -327,8 +393,6 @@ class PerlinAttentionState:
         q_len: int,
     ):
         if state is not None:
-            with timer(name+'.clone'):
-                state = state.clone()
             return state, state.forward_cumsum(
                 name=name,
                 v=v, q_len=q_len
@@ -343,19 +407,61 @@ class PerlinAttentionState:
         q_len: int,
     ):
         N, H, T_SRC, D = v.shape
-        state = self.get_cloned_state(name, lambda: StatefulCumAvg(self))
+        state = self.get_state(name, lambda: StatefulCumAvg(self))
         
         return state(v=v, q_len=q_len)
     
     def strify(self):
-        return f"State({strify(self.states)})"
+        return f"State({self.length}, {strify(self.states)})"
     
-    def clone(self):
+    def fork(self):
+        """
+        returns new state which decodes independently. O(1), sub-states are copied on next write.
+        """
+        new = self.new_like()
+        new.states = dict(self.states)
+        self.shared.update(self.states.keys())
+        new.shared = set(self.states.keys())
+        return new
+    
+    def new_like(self):
+        """
+        state at same position without sub-states
+        """
         new = PerlinAttentionState(None)
         new.num_heads = self.num_heads
         new.head_dim = self.head_dim
         new.embd_dim = self.embd_dim
         new.max_seq_length = self.max_seq_length
-        new.states = {k: v for k, v in self.states.items()}
+        new.length = self.length
+        new.evicted = self.evicted
         return new
-
+    
+    def index_select(self, dim: int, index: torch.Tensor):
+        """
+        reorders batch of every sub-state (e.g. beams by `_reorder_cache`), and returns new state.
+        if index keeps every row in place, sub-states are shared by `fork()` without copy.
+        """
+        assert dim == 0
+        if torch.equal(index.cpu(), torch.arange(index.shape[0])) and self.batch_size() in [None, index.shape[0]]:
+            return self.fork()
+        new = self.new_like()
+        new.states = {name: state.index_select(new, index) for name, state in self.states.items()}
+        return new
+    
+    def batch_size(self):
+        """
+        batch size of sub-state tensors, None if nothing is consumed yet
+        """
+        for state in self.states.values():
+            for t in vars(state).values():
+                if isinstance(t, torch.Tensor):
+                    return t.shape[0]
+                if isinstance(t, dict):
+                    t = list(t.values())
+                if isinstance(t, list) and len(t) > 0 and isinstance(t[0], torch.Tensor):
+                    return t[0].shape[0]
+        return None
+    
+    def clone(self):
+        return self.fork()
@@ -0,0 +1,43 @@
+"""
+Inference freezing pass of PerlinAttention models.
+
+Training-time modules redo constant work on every forward call: CausalConv2d masks its weight,
+LoraLinear multiplies lora_b @ lora_a, perlin_opt.OPTAttention creates scaling tensors and
+multiplies them into queries, and ModuleBenchmark wraps every CNN module with a timer.
+`freeze_for_inference` folds them into plain weights once, in place. Modules opt in by defining
+`freeze_for_inference(self)`.
+
+Frozen model is only for inference. Do not train it or save it as a training checkpoint, because
+folded weights are not the original parameters anymore. Freeze after moving model to device and dtype.
+"""
+
+from torch import nn
+
+from .attention import ModuleBenchmark
+
+def unwrap_benchmarks(model: nn.Module):
+    """
+    replaces ModuleBenchmark with its wrapped module. returns number of unwrapped modules
+    """
+    count = 0
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            unwrapped = child
+            while isinstance(unwrapped, ModuleBenchmark):
+                unwrapped = unwrapped.module
+                count += 1
+            if unwrapped is not child:
+                setattr(module, name, unwrapped)
+    return count
+
+def freeze_for_inference(model: nn.Module):
+    """
+    folds constant per-call work into weights, in place. returns model
+    """
+    model.eval()
+    model.requires_grad_(False)
+    unwrap_benchmarks(model)
+    for module in model.modules():
+        if hasattr(module, 'freeze_for_inference'):
+            module.freeze_for_inference()
+    return model
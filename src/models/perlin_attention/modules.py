@@ -30,6 +30,32 @@ def interpolate(x: torch.Tensor, size, interp_mode: str = None):
     
     return x
 
+ROW_WISE_MODULES = (nn.ReLU, nn.LayerNorm, nn.Identity)
+
+def is_streamable(module: nn.Module):
+    """
+    True if `stream_forward` can run the module. every op should be row-wise on time axis (dim -2),
+    or causal convolution.
+    """
+    if isinstance(module, nn.Sequential):
+        return all([is_streamable(m) for m in module])
+    if hasattr(module, 'streamable'):
+        return module.streamable()
+    return isinstance(module, ROW_WISE_MODULES)
+
+def stream_forward(module: nn.Module, x: torch.Tensor, buffers: dict):
+    """
+    computes only new rows x (N, C, T_NEW, W) of causal stack. history rows which are needed by
+    causal convolutions are kept in buffers, keyed by module.
+    """
+    if isinstance(module, nn.Sequential):
+        for m in module:
+            x = stream_forward(m, x, buffers)
+        return x
+    if hasattr(module, 'forward_stream'):
+        return module.forward_stream(x, buffers)
+    return module(x)
+
 class Residual(nn.Module):
     def __init__(self, *args) -> None:
         super().__init__()
@@ -53,6 +79,18 @@ class KeepRes(nn.Module):
         else:
             x = interpolate(x, (x_shape[-2], self.output_width))
         return x
+    
+    def streamable(self):
+        return is_streamable(self.net)
+    
+    def forward_stream(self, x, buffers):
+        x_shape = x.shape
+        x = stream_forward(self.net, x, buffers)
+        if self.output_width is None:
+            x = interpolate(x, x_shape[-2:])
+        else:
+            x = interpolate(x, (x_shape[-2], self.output_width))
+        return x
 
 class ResBlock(nn.Module):
     def __init__(self, ch, padding=1, lnorm_size=None, padding_mode='zeros', causal=False, dilation=1):
@@ -91,6 +129,10 @@ class UpsampleFP32(nn.Module):
                 x = x.to(x_type)
         return x
     
+    def streamable(self):
+        # row-wise only if time axis is not scaled
+        return isinstance(self.scale, (tuple, list)) and self.scale[0] == 1
+    
 CAUSAL_CONV_FORCE_NON_CAUSAL = False
     
 class CausalConv2d(nn.Module):
@@ -118,6 +160,8 @@ class CausalConv2d(nn.Module):
         self.padding = (padding, padding)
         self.padding_mode = padding_mode
         self.dilation = dilation
+        # causal mask is applied to weight once by freeze_for_inference
+        self.weight_mask_folded = False
         
         # to follow pytorch initializer
         conv2d = nn.Conv2d(in_channels, out_channels, kernel_size)
@@ -170,7 +214,7 @@ class CausalConv2d(nn.Module):
         )
     
     def forward(self, x: torch.Tensor):
-        w = self.weight.masked_fill(self.weight_mask == 0, 0) if self.causal else self.weight
+        w = self.weight.masked_fill(self.weight_mask == 0, 0) if self.causal and not self.weight_mask_folded else self.weight
         
         # if w.shape[0] == w.shape[1]:
         #     return x
@@ -190,3 +234,33 @@ class CausalConv2d(nn.Module):
         # print(time.time()-t)
         
         return y
+    
+    def streamable(self):
+        return self.causal and self.padding_mode == 'zeros' and self.stride in [1, (1, 1)]
+    
+    def freeze_for_inference(self):
+        if self.causal and not self.weight_mask_folded:
+            self.weight.data.masked_fill_(self.weight_mask.to(self.weight.device) == 0, 0)
+            self.weight_mask_folded = True
+    
+    def forward_stream(self, x: torch.Tensor, buffers: dict):
+        # NOTE: output row t reads input rows t-(k-1)*d, ..., t-d, t. keep last (k-1)*d input rows
+        d = self.dilation if isinstance(self.dilation, (int, float)) else self.dilation[0]
+        history = (self.kernel_size - 1) * d
+        if history > 0:
+            past = buffers.get(id(self), None)
+            if past is None:
+                # same with zero padding of first rows
+                past = torch.zeros(x.shape[:-2] + (history, x.shape[-1]), dtype=x.dtype, device=x.device)
+            x = torch.cat([past, x], dim=-2)
+            buffers[id(self)] = x[..., -history:, :].contiguous()
+        
+        return F.conv2d(
+            input=x,
+            weight=self.weight[:, :, :self.kernel_size, :],
+            bias=self.bias,
+            stride=1,
+            padding=(0, self.padding[1]),
+            dilation=self.dilation,
+            groups=1,
+        )
@@ -1,7 +1,23 @@
-from .kernels.resize_m_to_t import resize_from_m_to_t
-from .kernels.causal_resize_m_to_t import resize_from_m_to_t_csr
-from .kernels.flat_csr_elmul import flat_csr_elmul
-from .kernels.flat_csr_masked_bmm import flat_csr_masked_bmm
-from .kernels.flat_csr_sdbmm import flat_csr_sdbmm
-from .kernels.flat_csr_softmax import flat_csr_softmax
-from .kernels.flat_csr_to_dense import flat_csr_to_dense
\ No newline at end of file
+from .kernels.resize_m_to_t import resize_from_m_to_t, token_index_m, bucket_sum_m
+from .kernels.flat_csr_to_dense import flat_csr_to_dense
+from .dispatch import (
+    TRITON_AVAILABLE,
+    resize_from_m_to_t_csr,
+    flat_csr_elmul,
+    flat_csr_masked_bmm,
+    flat_csr_sdbmm,
+    flat_csr_softmax,
+)
+from .kernels.flat_csr_fused_attention import flat_csr_fused_attention, use_fused_attention
+from .kernels.flat_csr_cpu import is_sparse_mask, mask_row_entries
+from .kernels.block_run_mask import BlockRunMask, resize_from_m_to_t_block_run
+from .kernels.binary_csr_mask import BinaryCSRMask
+from .kernels.topk_sparse_mask import topk_sparse_mask, causal_topk_sparse_masking, use_fused_topk_mask, decode_row_sparse_mask, use_decode_row_mask
+from .kernels.topk_select import topk_threshold_mask, topk_alive_mask, use_threshold_select
+from .kernels.flat_csr_autograd import (
+    flat_csr_masked_bmm_autograd,
+    flat_csr_softmax_autograd,
+    flat_csr_elmul_autograd,
+    flat_csr_sdbmm_autograd,
+    flat_csr_attention_autograd,
+)
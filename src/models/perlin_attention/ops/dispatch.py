@@ -0,0 +1,62 @@
+"""
+Device dispatch of flat CSR ops.
+
+CUDA tensors are handled by triton kernels, other devices (or hosts without triton)
+are handled by torch implementations in `kernels/flat_csr_cpu.py`.
+BlockRunMask is always handled by torch implementations.
+"""
+
+import torch
+
+try:
+    import triton
+    TRITON_AVAILABLE = True
+except ImportError:
+    TRITON_AVAILABLE = False
+
+from .kernels import flat_csr_cpu
+from .kernels.block_run_mask import BlockRunMask, block_run_masked_bmm, block_run_sdbmm
+
+def use_triton(t: torch.Tensor, mask=None):
+    if mask is not None and not isinstance(mask, torch.Tensor):
+        return False
+    return TRITON_AVAILABLE and t.is_cuda
+
+def resize_from_m_to_t_csr(x: torch.Tensor, *args, **kwargs):
+    if use_triton(x):
+        from .kernels.causal_resize_m_to_t import resize_from_m_to_t_csr as impl
+    else:
+        impl = flat_csr_cpu.resize_from_m_to_t_csr_cpu
+    return impl(x, *args, **kwargs)
+
+def flat_csr_masked_bmm(a: torch.Tensor, b: torch.Tensor, mask: torch.Tensor, max_z_per_row: int=None):
+    if isinstance(mask, BlockRunMask):
+        return block_run_masked_bmm(a, b, mask)
+    if use_triton(a):
+        from .kernels.flat_csr_masked_bmm import flat_csr_masked_bmm as impl
+    else:
+        impl = flat_csr_cpu.flat_csr_masked_bmm_cpu
+    return impl(a, b, mask, max_z_per_row)
+
+def flat_csr_softmax(scores: torch.Tensor, H: int, T_SRC: int, max_z_per_row: int=None):
+    if use_triton(scores, scores):
+        from .kernels.flat_csr_softmax import flat_csr_softmax as impl
+    else:
+        impl = flat_csr_cpu.flat_csr_softmax_cpu
+    return impl(scores, H, T_SRC, max_z_per_row)
+
+def flat_csr_elmul(probs: torch.Tensor, dense: torch.Tensor, max_z_per_row: int=None):
+    if use_triton(probs, probs):
+        from .kernels.flat_csr_elmul import flat_csr_elmul as impl
+    else:
+        impl = flat_csr_cpu.flat_csr_elmul_cpu
+    return impl(probs, dense, max_z_per_row)
+
+def flat_csr_sdbmm(scores: torch.Tensor, value_layer: torch.Tensor, T_M: int, max_z_per_row: int=None, benchmarking: bool=False):
+    if isinstance(scores, BlockRunMask):
+        return block_run_sdbmm(scores, value_layer, T_M)
+    if use_triton(scores):
+        from .kernels.flat_csr_sdbmm import flat_csr_sdbmm as impl
+    else:
+        impl = flat_csr_cpu.flat_csr_sdbmm_cpu
+    return impl(scores, value_layer, T_M, max_z_per_row, benchmarking)
@@ -0,0 +1,164 @@
+"""
+Compact binary flat csr mask.
+
+Masks from `resize_from_m_to_t_csr` are always ones, so values are implicit. Indices are
+stored with narrowest dtype which fits H*T_SRC (int16 or int32), and crow_indices are not
+stored when every row has the same number of elements (shared crow offsets).
+"""
+
+import torch
+from .flat_csr_cpu import row_entries
+
+def narrow_col_dtype(max_value: int):
+    if max_value < 2**15:
+        return torch.int16
+    assert max_value < 2**31
+    return torch.int32
+
+class BinaryCSRMask:
+    """
+    crow_indices: N, T_DST+1 int32 (None if row_nnz is given)
+    row_nnz: int, number of elements of every row (only if crow_indices is None)
+    col_indices: N, Z int16 or int32. flatten column index (head * T_SRC + col)
+    """
+
+    is_sparse_csr = False
+    values = None
+
+    def __init__(
+        self,
+        crow_indices: torch.Tensor,
+        col_indices: torch.Tensor,
+        shape,
+        row_nnz: int = None,
+        dtype: torch.dtype = torch.float32,
+    ):
+        assert (crow_indices is None) != (row_nnz is None)
+        self._crow_indices = crow_indices
+        self.col_indices = col_indices
+        self.row_nnz = row_nnz
+        self.shape = torch.Size(shape)
+        self.dtype = dtype
+
+    @property
+    def device(self):
+        return self.col_indices.device
+
+    @property
+    def nnz(self):
+        return self.col_indices.shape[-1]
+
+    @property
+    def is_shared_crow(self):
+        return self._crow_indices is None
+
+    def crow_indices(self):
+        if self._crow_indices is not None:
+            return self._crow_indices
+        N, T_DST, _ = self.shape
+        return (torch.arange(T_DST + 1, dtype=torch.int32, device=self.device) * self.row_nnz)\
+            .view(1, T_DST + 1).expand(N, T_DST + 1)
+
+    def index_nbytes(self):
+        nbytes = self.col_indices.numel() * self.col_indices.element_size()
+        if self._crow_indices is not None:
+            nbytes += self._crow_indices.numel() * self._crow_indices.element_size()
+        return nbytes
+
+    def row_entries(self, n: int, r0: int, r1: int):
+        if self.is_shared_crow:
+            e0 = r0 * self.row_nnz
+            e1 = r1 * self.row_nnz
+            rows = torch.arange(r0, r1, device=self.device).repeat_interleave(self.row_nnz)
+            return e0, e1, rows, self.col_indices[n, e0:e1].long()
+        return row_entries(self._crow_indices, self.col_indices, n, r0, r1)
+
+    def with_values(self, values: torch.Tensor):
+        # NOTE: torch csr requires same dtype of crow and col indices
+        return torch.sparse_csr_tensor(
+            crow_indices=self.crow_indices().contiguous(),
+            col_indices=self.col_indices.to(torch.int32),
+            values=values,
+            size=self.shape,
+        )
+
+    def to_dense(self, T_SRC: int, H: int, rows=None, heads=None):
+        """
+        densify window of mask. returns N, len(heads), len(rows), T_SRC
+        """
+        from .flat_csr_to_dense import flat_csr_to_dense
+        return flat_csr_to_dense(self, T_SRC, H, rows=rows, heads=heads)
+
+    def to_flat_csr(self):
+        return self.with_values(torch.ones(self.col_indices.shape, dtype=self.dtype, device=self.device))
+
+    @staticmethod
+    def from_flat_csr(csr: torch.Tensor):
+        assert csr.is_sparse_csr
+        return BinaryCSRMask.from_indices(
+            csr.crow_indices(),
+            csr.col_indices(),
+            csr.shape,
+            dtype=csr.values().dtype,
+        )
+
+    @staticmethod
+    def from_indices(crow_indices: torch.Tensor, col_indices: torch.Tensor, shape, dtype=torch.float32):
+        N, T_DST, HT_SRC = shape
+        col_indices = col_indices.to(narrow_col_dtype(HT_SRC))
+        row_counts = crow_indices[:, 1:] - crow_indices[:, :-1]
+        row_nnz = int(row_counts[0, 0].item()) if row_counts.numel() > 0 else 0
+        if row_counts.numel() > 0 and bool((row_counts == row_nnz).all()):
+            return BinaryCSRMask(None, col_indices, shape, row_nnz=row_nnz, dtype=dtype)
+        return BinaryCSRMask(crow_indices.to(torch.int32), col_indices, shape, dtype=dtype)
+
+def test_main():
+    from .....utils import seed
+    from .causal_topk_masking import causal_topk_masking
+    from .flat_csr_cpu import resize_from_m_to_t_csr_cpu, flat_csr_masked_bmm_cpu
+    from .flat_csr_to_dense import flat_csr_to_dense
+
+    seed()
+
+    N, H, T, T_DST, T_M, K, HID = 2, 4, 1024, 1024, 32, 8, 64
+    FP_MIN = torch.finfo(torch.float16).min * 0.5
+    device = 'cpu'
+
+    for is_causal in [True, False]:
+        estimated_probs = torch.softmax(torch.randn((N, H, T_DST, T_M), device=device), dim=-1)
+        causal_attention_mask = ((torch.arange(T, device=device).view(1, T) > torch.arange(T, device=device).view(T, 1)) * FP_MIN).view(1, 1, T, T)
+        causal_attention_mask = causal_attention_mask[:, :, -T_DST:, :]
+        compressed_mask = causal_topk_masking(
+            estimated_probs,
+            k=K,
+            attention_mask=causal_attention_mask[:,:,-1:,:],
+            dst_attention_mask=causal_attention_mask[:,:,:,:1],
+            causal_attention_mask=causal_attention_mask,
+            is_causal=is_causal,
+        )
+        csr_mask = resize_from_m_to_t_csr_cpu(compressed_mask, 0, K, target_width=T, is_causal=is_causal)
+        binary_mask = resize_from_m_to_t_csr_cpu(compressed_mask, 0, K, target_width=T, is_causal=is_causal, binary=True)
+        assert isinstance(binary_mask, BinaryCSRMask)
+
+        csr_nbytes = sum([t.numel() * t.element_size() for t in [csr_mask.crow_indices(), csr_mask.col_indices(), csr_mask.values()]])
+        print(f'mask memory: csr {csr_nbytes / 1024:.1f}KB, binary {binary_mask.index_nbytes() / 1024:.1f}KB')
+
+        assert torch.equal(flat_csr_to_dense(csr_mask, T, H), flat_csr_to_dense(binary_mask, T, H))
+
+        query_layer = torch.randn((N, H, T_DST, HID), device=device)
+        key_layer = torch.randn((N, H, T, HID), device=device)
+        scores = flat_csr_masked_bmm_cpu(query_layer, key_layer, csr_mask)
+        scores_binary = flat_csr_masked_bmm_cpu(query_layer, key_layer, binary_mask)
+        max_error = (flat_csr_to_dense(scores, T, H) - flat_csr_to_dense(scores_binary, T, H)).abs().max().item()
+        print('masked_bmm', max_error)
+        assert max_error < 1e-5
+
+    # shared crow offsets
+    crow = (torch.arange(5) * 3).view(1, 5).expand(2, 5)
+    col = torch.randint(0, 16, (2, 12))
+    mask = BinaryCSRMask.from_indices(crow, col, (2, 4, 16))
+    assert mask.is_shared_crow
+    assert torch.equal(mask.crow_indices().long(), crow)
+
+if __name__ == '__main__':
+    test_main()
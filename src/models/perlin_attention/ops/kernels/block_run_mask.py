@@ -0,0 +1,427 @@
+"""
+Block run encoding of interpolated SEA masks.
+
+`resize_from_m_to_t_csr` expands each selected compressed cell into `count` target columns.
+BlockRunMask stores one run per selected cell instead, (start, span, count), and columns of
+the run are `start + span - 1 - floor(i * span / count)` for i in [0, count). This is exactly
+the same column order as flat csr mask, so values of both formats are interchangeable.
+When count == span (not clamped by k), run is contiguous range [start, start + span).
+
+Masked bmm and sdbmm consume runs directly by slicing K/V windows of `max_span` rows.
+"""
+
+import os
+import torch
+from .flat_csr_cpu import parallel_for, row_blocks, partition_rows, acc_dtype
+from .binary_csr_mask import narrow_col_dtype
+
+BLOCK_RUN_BLOCK_Z = int(os.environ.get('PERLIN_BLOCK_RUN_BLOCK_Z', '65536'))
+
+def expand_runs(counts: torch.Tensor):
+    """
+    returns (owner, i). owner is run index of each entry, i is index of entry inside of run
+    """
+    counts = counts.long()
+    owner = torch.repeat_interleave(torch.arange(counts.shape[0], device=counts.device), counts)
+    offsets = counts.cumsum(0) - counts
+    i = torch.arange(owner.shape[0], device=counts.device) - offsets[owner]
+    return owner, i
+
+def run_offsets(spans: torch.Tensor, counts: torch.Tensor, owner: torch.Tensor, i: torch.Tensor):
+    # offset of each entry from start of its run. float32 math is same with scan_col kernel
+    step = spans.float() / counts.float().clamp_min(1)
+    return spans.long()[owner] - (i * step[owner]).to(torch.int32).long() - 1
+
+class BlockRunMask:
+    """
+    crow_indices: N, T_DST+1. cumulative number of runs per row
+    entry_crow_indices: N, T_DST+1. cumulative number of entries per row (same with flat csr crow_indices)
+    run_starts: N, Z_RUN. flatten start column (head * T_SRC + col)
+    run_spans: N, Z_RUN. width of run in target columns
+    run_counts: N, Z_RUN. number of selected columns in run (<= span)
+    values: N, Z. optional, same layout with values of flat csr
+    """
+
+    is_sparse_csr = False
+
+    def __init__(
+        self,
+        crow_indices: torch.Tensor,
+        entry_crow_indices: torch.Tensor,
+        run_starts: torch.Tensor,
+        run_spans: torch.Tensor,
+        run_counts: torch.Tensor,
+        shape,
+        H: int,
+        max_span: int,
+        values: torch.Tensor = None,
+        dtype: torch.dtype = torch.float32,
+    ):
+        self.crow_indices = crow_indices
+        self.entry_crow_indices = entry_crow_indices
+        self.run_starts = run_starts
+        self.run_spans = run_spans
+        self.run_counts = run_counts
+        self.shape = torch.Size(shape)
+        self.H = H
+        self.T_SRC = self.shape[-1] // H
+        self.max_span = max_span
+        self.values = values
+        self.dtype = dtype if values is None else values.dtype
+
+    @property
+    def device(self):
+        return self.run_starts.device
+
+    @property
+    def nnz(self):
+        return int(self.entry_crow_indices[:, -1].max().item())
+
+    def with_values(self, values: torch.Tensor):
+        return BlockRunMask(
+            self.crow_indices,
+            self.entry_crow_indices,
+            self.run_starts,
+            self.run_spans,
+            self.run_counts,
+            self.shape,
+            self.H,
+            self.max_span,
+            values=values,
+        )
+
+    def index_nbytes(self):
+        return sum([
+            t.numel() * t.element_size() for t in [
+                self.crow_indices,
+                self.entry_crow_indices,
+                self.run_starts,
+                self.run_spans,
+                self.run_counts
+            ]
+        ])
+
+    def runs(self, n: int, r0: int, r1: int):
+        """
+        returns (q0, q1, run_rows, starts, spans, counts) of rows [r0, r1) in batch n
+        """
+        crow = self.crow_indices[n, r0:r1+1].long()
+        q0 = int(crow[0])
+        q1 = int(crow[-1])
+        run_rows = torch.repeat_interleave(
+            torch.arange(r0, r1, device=crow.device),
+            crow[1:] - crow[:-1]
+        )
+        return (
+            q0, q1, run_rows,
+            self.run_starts[n, q0:q1].long(),
+            self.run_spans[n, q0:q1].long(),
+            self.run_counts[n, q0:q1].long(),
+        )
+
+    def row_entries(self, n: int, r0: int, r1: int):
+        """
+        returns (entry_start, entry_end, rows, cols) same with flat csr row_entries
+        """
+        e0 = int(self.entry_crow_indices[n, r0])
+        e1 = int(self.entry_crow_indices[n, r1])
+        _, _, run_rows, starts, spans, counts = self.runs(n, r0, r1)
+        owner, i = expand_runs(counts)
+        cols = starts[owner] + run_offsets(spans, counts, owner, i)
+        return e0, e1, run_rows[owner], cols
+
+    def to_dense(self, T_SRC: int, H: int, rows=None, heads=None):
+        """
+        densify window of mask. returns N, len(heads), len(rows), T_SRC
+        """
+        from .flat_csr_to_dense import flat_csr_to_dense
+        assert T_SRC == self.T_SRC and H == self.H
+        return flat_csr_to_dense(self, T_SRC, H, rows=rows, heads=heads)
+
+    def to_flat_csr(self):
+        N, T_DST, _ = self.shape
+        Z = self.nnz if self.values is None else self.values.shape[-1]
+        col_indices = torch.zeros((N, Z), dtype=torch.long, device=self.device)
+
+        def job(n, r0, r1):
+            e0, e1, _, cols = self.row_entries(n, r0, r1)
+            col_indices[n, e0:e1] = cols
+
+        parallel_for(job, row_blocks(N, T_DST))
+
+        values = self.values
+        if values is None:
+            values = torch.ones_like(col_indices, dtype=self.dtype)
+        return torch.sparse_csr_tensor(
+            crow_indices=self.entry_crow_indices.long(),
+            col_indices=col_indices,
+            values=values,
+            size=self.shape,
+        )
+
+def interpolation_ranges(T_DST: int, T_M: int, T_SRC: int, is_causal: bool, device):
+    """
+    returns (v_starts, spans) of each compressed column for each destination row, (T_DST, T_M).
+    same rounding with scan_col.
+    """
+    from .flat_csr_cpu import round_half_away
+
+    if is_causal:
+        widths = torch.arange(1, T_SRC+1, device=device)[-T_DST:]
+    else:
+        widths = torch.full((T_SRC,), T_SRC, device=device)[-T_DST:]
+    scales = (widths / T_M).view(T_DST, 1)
+
+    b = torch.arange(0, T_M, device=device).view(1, T_M)
+    v_starts = round_half_away(b * scales)
+    v_ends = round_half_away((b + 1) * scales)
+    return v_starts, (v_ends - v_starts).to(torch.int32)
+
+def block_run_mask_from_cells(
+    counts: torch.Tensor,
+    pixels: torch.Tensor,
+    v_starts: torch.Tensor,
+    spans: torch.Tensor,
+    H: int,
+    T_M: int,
+    T_SRC: int,
+    dtype: torch.dtype = torch.float32,
+):
+    """
+    counts: N, T_DST, C. number of selected columns of each cell (0 if not selected)
+    pixels: N, T_DST, C. compressed pixel index (head * T_M + col) of each cell, in ascending order per row.
+        None if C == H*T_M and cells are pixels themselves.
+    """
+    N, T_DST, C = counts.shape
+    is_run = counts > 0
+
+    crow_indices = torch.zeros((N, T_DST+1), dtype=torch.int32, device=counts.device)
+    crow_indices[:, 1:] = is_run.sum(-1).cumsum(-1)
+    entry_crow_indices = torch.zeros((N, T_DST+1), dtype=torch.int32, device=counts.device)
+    entry_crow_indices[:, 1:] = counts.sum(-1).cumsum(-1)
+    Z_RUN = int(crow_indices[:, -1].max().item())
+
+    max_span = int(spans.max().item()) if spans.numel() > 0 else 1
+    span_dtype = narrow_col_dtype(max_span)
+    run_starts = torch.zeros((N, Z_RUN), dtype=narrow_col_dtype(H*T_SRC), device=counts.device)
+    run_spans = torch.zeros((N, Z_RUN), dtype=span_dtype, device=counts.device)
+    run_counts = torch.zeros((N, Z_RUN), dtype=span_dtype, device=counts.device)
+
+    is_run = is_run.view(N, -1)
+    idx_n, idx_cell = is_run.nonzero(as_tuple=True)
+    idx_run = (is_run.long().cumsum(-1) - 1)[idx_n, idx_cell]
+    idx_tdst = idx_cell // C
+    if pixels is None:
+        idx_pixel = idx_cell % C
+    else:
+        idx_pixel = pixels.reshape(N, -1)[idx_n, idx_cell].long()
+    idx_h = idx_pixel // T_M
+    idx_tm = idx_pixel % T_M
+
+    run_starts[idx_n, idx_run] = (v_starts[idx_tdst, idx_tm].long() + idx_h * T_SRC).to(run_starts.dtype)
+    run_spans[idx_n, idx_run] = spans[idx_tdst, idx_tm].to(span_dtype)
+    run_counts[idx_n, idx_run] = counts.view(N, -1)[idx_n, idx_cell].to(span_dtype)
+
+    return BlockRunMask(
+        crow_indices=crow_indices,
+        entry_crow_indices=entry_crow_indices,
+        run_starts=run_starts,
+        run_spans=run_spans,
+        run_counts=run_counts,
+        shape=(N, T_DST, H*T_SRC),
+        H=H,
+        max_span=max(1, max_span),
+        dtype=dtype,
+    )
+
+def resize_from_m_to_t_block_run(
+    x: torch.Tensor,
+    masked_fill_value,
+    k,
+    target_width=None,
+    training=False,
+    is_causal=True,
+    oversampled=None,
+):
+    """
+    same arguments with resize_from_m_to_t_csr, returns BlockRunMask
+    """
+    assert not training
+    assert masked_fill_value == 0
+    N, H, T_DST, T_M = x.shape
+    if target_width is not None:
+        T_SRC = target_width
+    else:
+        T_SRC = T_DST
+
+    x = x.transpose(1, 2).reshape(N, T_DST, H*T_M)
+    v_starts, spans = interpolation_ranges(T_DST, T_M, T_SRC, is_causal, x.device)
+
+    n_pixels = spans.view(1, T_DST, 1, T_M) * x.view(N, T_DST, H, T_M).to(torch.int32)
+    n_pixels = n_pixels.clamp(0, k).view(N, T_DST, H*T_M)
+
+    return block_run_mask_from_cells(
+        n_pixels, None, v_starts, spans, H, T_M, T_SRC, dtype=x.dtype
+    )
+
+def __run_chunks(counts: torch.Tensor, max_span: int):
+    # split runs into chunks with bounded window memory
+    runs_per_chunk = max(1, BLOCK_RUN_BLOCK_Z // max_span)
+    entry_offsets = counts.cumsum(0) - counts
+    for j0 in range(0, counts.shape[0], runs_per_chunk):
+        j1 = min(counts.shape[0], j0 + runs_per_chunk)
+        yield j0, j1, int(entry_offsets[j0]) if j0 < counts.shape[0] else 0
+
+def __windows(x_flat: torch.Tensor, starts: torch.Tensor, L: int):
+    """
+    x_flat: (H*T_SRC, HID). returns windows (R_RUN, HID, L) and shift of run start inside of window
+    """
+    window_starts = starts.clamp_max(x_flat.shape[0] - L)
+    windows = x_flat.unfold(0, L, 1).index_select(0, window_starts)
+    return windows, starts - window_starts
+
+def block_run_masked_bmm(a: torch.Tensor, b: torch.Tensor, mask: BlockRunMask):
+    assert isinstance(mask, BlockRunMask)
+    N, H, T_DST, HID = a.shape
+    _, _, T_SRC, _ = b.shape
+    assert mask.shape == (N, T_DST, H*T_SRC)
+
+    L = min(mask.max_span, H*T_SRC)
+    out_values = torch.zeros((N, mask.nnz), dtype=mask.dtype, device=a.device)
+    dtype = acc_dtype(a, b)
+    a_flat = a.reshape(N, H*T_DST, HID)
+    b_flat = b.reshape(N, H*T_SRC, HID)
+
+    def job(n, r0, r1):
+        q0, q1, run_rows, starts, spans, counts = mask.runs(n, r0, r1)
+        if q1 <= q0:
+            return
+        e0 = int(mask.entry_crow_indices[n, r0])
+        for j0, j1, z0 in __run_chunks(counts, L):
+            _starts = starts[j0:j1]
+            _spans = spans[j0:j1]
+            _counts = counts[j0:j1]
+            heads = _starts // T_SRC
+            q = a_flat[n].index_select(0, heads * T_DST + run_rows[j0:j1]).to(dtype)
+            windows, shift = __windows(b_flat[n], _starts, L)
+            scores = torch.bmm(q.unsqueeze(1), windows.to(dtype)).squeeze(1) # R_RUN, L
+            owner, i = expand_runs(_counts)
+            offsets = run_offsets(_spans, _counts, owner, i) + shift[owner]
+            out_values[n, e0+z0:e0+z0+owner.shape[0]] = scores[owner, offsets].to(out_values.dtype)
+
+    parallel_for(job, partition_rows(mask, N, T_DST))
+
+    return mask.with_values(out_values)
+
+def block_run_sdbmm(probs: BlockRunMask, value_layer: torch.Tensor, T_M: int = None):
+    assert isinstance(probs, BlockRunMask)
+    assert probs.values is not None
+    N, H, T_SRC, HID = value_layer.shape
+    _, T_DST, _ = probs.shape
+
+    L = min(probs.max_span, H*T_SRC)
+    dtype = acc_dtype(probs.values, value_layer)
+    output = torch.zeros((N, H, T_DST, HID), dtype=dtype, device=value_layer.device)
+    v_flat = value_layer.reshape(N, H*T_SRC, HID)
+
+    def job(n, r0, r1):
+        q0, q1, run_rows, starts, spans, counts = probs.runs(n, r0, r1)
+        if q1 <= q0:
+            return
+        e0 = int(probs.entry_crow_indices[n, r0])
+        acc = torch.zeros(((r1 - r0) * H, HID), dtype=dtype, device=output.device)
+        for j0, j1, z0 in __run_chunks(counts, L):
+            _starts = starts[j0:j1]
+            _spans = spans[j0:j1]
+            _counts = counts[j0:j1]
+            owner, i = expand_runs(_counts)
+            windows, shift = __windows(v_flat[n], _starts, L)
+            offsets = run_offsets(_spans, _counts, owner, i) + shift[owner]
+            weights = torch.zeros((j1 - j0, L), dtype=dtype, device=output.device)
+            weights[owner, offsets] = probs.values[n, e0+z0:e0+z0+owner.shape[0]].to(dtype)
+            context = torch.bmm(windows.to(dtype), weights.unsqueeze(-1)).squeeze(-1) # R_RUN, HID
+            group = (run_rows[j0:j1] - r0) * H + _starts // T_SRC
+            acc.index_add_(0, group, context)
+        output[n, :, r0:r1] = acc.view(r1 - r0, H, HID).transpose(0, 1)
+
+    parallel_for(job, partition_rows(probs, N, T_DST))
+
+    return output
+
+def test_config(IS_CAUSAL, N, H, T, T_DST, T_M, K, HID):
+    from .....utils import seed
+    from .causal_topk_masking import causal_topk_masking
+    from .flat_csr_cpu import (
+        resize_from_m_to_t_csr_cpu,
+        flat_csr_masked_bmm_cpu,
+        flat_csr_softmax_cpu,
+        flat_csr_sdbmm_cpu,
+    )
+
+    seed()
+
+    FP_MIN = torch.finfo(torch.float16).min * 0.5
+    device = 'cpu'
+
+    estimated_scores = torch.randn((N, H, T_DST, T_M), device=device)
+    estimated_probs = torch.softmax(estimated_scores, dim=-1)
+    causal_attention_mask = ((torch.arange(T, device=device).view(1, T) > torch.arange(T, device=device).view(T, 1)) * FP_MIN).view(1, 1, T, T)
+    causal_attention_mask = causal_attention_mask[:, :, -T_DST:, :]
+    attention_mask = causal_attention_mask[:,:,-1:,:]
+    dst_attention_mask = causal_attention_mask[:,:,:,:1]
+
+    compressed_mask = causal_topk_masking(
+        estimated_probs,
+        k=K,
+        attention_mask=attention_mask,
+        dst_attention_mask=dst_attention_mask,
+        causal_attention_mask=causal_attention_mask,
+        is_causal=IS_CAUSAL,
+    )
+    csr_mask = resize_from_m_to_t_csr_cpu(compressed_mask, 0, K, target_width=T, is_causal=IS_CAUSAL)
+    run_mask = resize_from_m_to_t_block_run(compressed_mask, 0, K, target_width=T, is_causal=IS_CAUSAL)
+
+    csr_index_nbytes = sum([t.numel() * t.element_size() for t in [csr_mask.crow_indices(), csr_mask.col_indices()]])
+    print(f'index memory: csr {csr_index_nbytes / 1024:.1f}KB, block run {run_mask.index_nbytes() / 1024:.1f}KB')
+
+    run_as_csr = run_mask.to_flat_csr()
+    assert torch.equal(run_as_csr.crow_indices(), csr_mask.crow_indices())
+    for n in range(N):
+        z = csr_mask.crow_indices()[n, -1]
+        assert torch.equal(run_as_csr.col_indices()[n, :z], csr_mask.col_indices()[n, :z])
+
+    query_layer = torch.randn((N, H, T_DST, HID), device=device)
+    key_layer = torch.randn((N, H, T, HID), device=device)
+    value_layer = torch.randn((N, H, T, HID), device=device)
+
+    csr_scores = flat_csr_masked_bmm_cpu(query_layer, key_layer, csr_mask)
+    run_scores = block_run_masked_bmm(query_layer, key_layer, run_mask)
+    for n in range(N):
+        z = csr_mask.crow_indices()[n, -1]
+        max_error = (csr_scores.values()[n, :z] - run_scores.values[n, :z]).abs().max().item() if z > 0 else 0
+        print('masked_bmm', max_error)
+        assert max_error < 1e-4
+
+    csr_probs = flat_csr_softmax_cpu(csr_scores, H, T)
+    run_probs = run_scores.with_values(csr_probs.values()[:, :run_scores.values.shape[-1]])
+    csr_context = flat_csr_sdbmm_cpu(csr_probs, value_layer, T_M)
+    run_context = block_run_sdbmm(run_probs, value_layer, T_M)
+    max_error = (csr_context - run_context).abs().max().item()
+    print('sdbmm', max_error)
+    assert max_error < 1e-4
+
+    # float64 inputs keep their precision
+    run_context64 = block_run_sdbmm(run_probs, value_layer.double(), T_M)
+    csr_context64 = flat_csr_sdbmm_cpu(csr_probs, value_layer.double(), T_M)
+    assert run_context64.dtype == torch.float64
+    assert (run_context64 - csr_context64).abs().max().item() < 1e-10
+
+def test_main():
+    for is_causal in [True, False]:
+        test_config(is_causal, 1, 2, 300, 300, 16, 2, 32)
+        test_config(is_causal, 2, 4, 1024, 1024, 32, 8, 64)
+        # clamped runs (T / T_M > K)
+        test_config(is_causal, 1, 4, 4096, 256, 16, 8, 64)
+
+if __name__ == '__main__':
+    test_main()
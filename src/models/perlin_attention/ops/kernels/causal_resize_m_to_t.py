@@ -635,14 +635,16 @@ def scan_col(
     target_width: torch.Tensor, 
     max_col_z: int, 
     max_k: int, 
-    oversampled: float = None
+    oversampled: float = None,
+    binary: bool = False,
+    method: int = None,
 ):
     N, T_DST, H_T = x.shape # N, T_DST, H*T_M
     assert target_width.shape == (T_DST,)
     scales = target_width / original_width
     
     # METHOD = 2 if target_width_max <= 2048 else 1
-    METHOD = 1
+    METHOD = 1 if method is None else method
     
     # for high sparsity
     if METHOD == 1:
@@ -665,9 +667,12 @@ def scan_col(
             M = pixel_indices.shape[-1]
             
             Z = pixel_indices.view(N, T_DST, -1)[:, :, -1].max().item()
-            crow_indices = torch.zeros((N, T_DST+1), dtype=torch.long, device=x.device)
-            col_indices = torch.zeros((N, Z), dtype=torch.long, device=x.device)
-            values = torch.ones_like(col_indices, dtype=x.dtype)
+            # NOTE: binary mask does not need values, and int32 is enough for indices
+            index_dtype = torch.int32 if binary else torch.long
+            crow_indices = torch.zeros((N, T_DST+1), dtype=index_dtype, device=x.device)
+            col_indices = torch.zeros((N, Z), dtype=index_dtype, device=x.device)
+            if not binary:
+                values = torch.ones_like(col_indices, dtype=x.dtype)
             
             crow_indices[:, 1:] = pixel_indices.view(N, T_DST, -1)[:,:,-1]
         
@@ -754,6 +759,12 @@ def scan_col(
             # print(col_indices)
             # exit()
         
+        if binary:
+            from .binary_csr_mask import BinaryCSRMask
+            return BinaryCSRMask.from_indices(
+                crow_indices, col_indices, (N, T_DST, H*target_width_max), dtype=x.dtype
+            )
+        
         return torch.sparse_csr_tensor(
             crow_indices=crow_indices,
             col_indices=col_indices,
@@ -763,6 +774,16 @@ def scan_col(
     elif METHOD == 2:
         # for low sparsity. somehow allow quadratic thread allocation
         
+        # NOTE: count columns of each row before the scan, so the buffer is allocated once with exact width.
+        #       kernel does not check bounds of MAX_Z, so max_col_z from caller is ignored.
+        T_M = original_width
+        H = H_T // T_M
+        b = torch.arange(0, T_M, device=x.device).view(1, T_M)
+        spans = (triton_round((b + 1)*scales.view(T_DST, 1)) - triton_round(b*scales.view(T_DST, 1))).to(torch.int32)
+        ncols_counted = (spans.view(1, T_DST, 1, T_M) * x.view(N, T_DST, H, T_M).to(torch.int32)).view(N, T_DST, -1).sum(-1)
+        ncols_max, z_max = torch.stack([ncols_counted.max(), ncols_counted.sum(-1).max()]).tolist()
+        max_col_z = max(1, ncols_max)
+        
         # npixels_debug = torch.zeros_like(x, dtype=torch.float32)
         ncols = torch.zeros((N, T_DST), dtype=torch.long, device=x.device)
         col_indices = torch.zeros((N, T_DST, max_col_z), device=x.device, dtype=torch.long)
@@ -809,7 +830,7 @@ def scan_col(
         # print('ve', v_ends[7])
         # print('bs', (b*scales.view(T_DST, 1))[7])
         # print('dg', npixels_debug[0, 7])
-        return ncols, col_indices
+        return ncols, col_indices, ncols_max, z_max
         
     raise Exception()
 
@@ -869,14 +890,17 @@ def __compact_cols_compute(
             mask = (tl.arange(0, MAX_NCOLS) < cs_len) & mask_a
         )
 
-def compact_cols(ncols, col_indices: torch.Tensor):
+def compact_cols(ncols, col_indices: torch.Tensor, ncols_max: int = None, z_per_batch: int = None):
     N, A = ncols.shape
     N, A, MZ = col_indices.shape
     ncols_cs = F.pad(ncols.view(1, 1, N, A), pad=(1, 0), mode='constant', value=0).view(N, A+1).cumsum(-1)
-    z_per_batch = ncols_cs[:,-1].max()
-    # print(ncols_cs[:, -1], z_per_batch)
-    if not torch.all(z_per_batch == ncols_cs[:, -1]):
-        warnings.warn(f"all batch should have same number of elements {z_per_batch}=={ncols_cs[:, -1]}")
+    if z_per_batch is None:
+        z_per_batch = ncols_cs[:,-1].max()
+        # print(ncols_cs[:, -1], z_per_batch)
+        if not torch.all(z_per_batch == ncols_cs[:, -1]):
+            warnings.warn(f"all batch should have same number of elements {z_per_batch}=={ncols_cs[:, -1]}")
+    if ncols_max is None:
+        ncols_max = int(torch.max(ncols).item())
     out_col_indices = torch.zeros((N, z_per_batch), dtype=torch.long, device=ncols.device).fill_(-1) # type: torch.Tensor
     
     # print()
@@ -893,7 +917,7 @@ def compact_cols(ncols, col_indices: torch.Tensor):
         col_indices.stride(0), col_indices.stride(1), col_indices.stride(2),
         out_col_indices,
         out_col_indices.stride(0), out_col_indices.stride(1),
-        triton.next_power_of_2(max(1, int(torch.max(ncols).item()))),
+        triton.next_power_of_2(max(1, ncols_max)),
         BLOCK_A,
         # num_warps=num_warps,
     )
@@ -918,6 +942,8 @@ def resize_from_m_to_t_csr(
     max_col_z = None, 
     benchmarking = False,
     oversampled = None,
+    binary = False,
+    method = None,
 ):
     if benchmarking:
         timer = lambda name: get_bench().region(name)
@@ -926,9 +952,6 @@ def resize_from_m_to_t_csr(
     
     with timer("resize_from_m_to_t_csr"):
         with timer("resize_from_m_to_t_csr.setup"):
-            _x = x
-            _target_width = target_width
-            _k = k
             assert not training
             assert masked_fill_value == 0
             N, H, T_DST, T_M = x.shape
@@ -939,16 +962,7 @@ def resize_from_m_to_t_csr(
             
             x = x.transpose(1, 2).reshape(N, T_DST, H*T_M)
             
-            if max_col_z is None:
-                if is_causal:
-                    # max_col_z = H*(k*(max(1, math.ceil(T_SRC / T_M)) + 1))
-                    # t = k + math.ceil(T_SRC / T_M)
-                    # max_col_z = H*t
-                    max_col_z = H*(k + math.ceil(T_SRC / T_M))
-                else:
-                    # max_col_z = H*(k*(max(1, math.ceil(T_SRC / T_M)) + 1))
-                    max_col_z = H*(k + math.ceil(T_SRC / T_M))
-            assert isinstance(max_col_z, (int, float))
+            # NOTE: max_col_z is not needed anymore, scan_col counts columns of each row before allocating buffers.
             
             if is_causal:
                 target_width = torch.arange(1, T_SRC+1, device=x.device)[-T_DST:]
@@ -965,35 +979,23 @@ def resize_from_m_to_t_csr(
                 max_col_z=max_col_z,
                 max_k=k,
                 oversampled=oversampled,
+                binary=binary,
+                method=method,
             )
             if isinstance(ret, torch.Tensor):
                 assert ret.is_sparse_csr
                 return ret
+            if not isinstance(ret, tuple):
+                # BinaryCSRMask
+                return ret
 
-            ncols, _col_indices = ret
+            ncols, _col_indices, ncols_max, z_max = ret
         
-        if need_assert and False:
-            assert ncols.max() < max_col_z, f"{max_col_z}, {H}, {k}, {ncols.max()}"
-        else:
-            ncols_max = ncols.max().item()
-            if ncols_max >= max_col_z:
-                print(f'ncols({ncols_max}) out of range ({max_col_z}), please fix this')
-                del target_width, x, ncols, _col_indices
-                return resize_from_m_to_t_csr(
-                    _x, 
-                    masked_fill_value, 
-                    _k, 
-                    target_width=_target_width, 
-                    training=training, 
-                    need_assert=need_assert, 
-                    is_causal=is_causal, 
-                    max_col_z=ncols_max + 1
-                )
         # print(ncols, _col_indices)
         # print(ncols.shape, _col_indices.shape)
         
         with timer("resize_from_m_to_t_csr.compact_cols"):
-            crows_indices, col_indices = compact_cols(ncols, _col_indices)
+            crows_indices, col_indices = compact_cols(ncols, _col_indices, ncols_max=ncols_max, z_per_batch=z_max)
             # print(crows_indices, col_indices, _col_indices)
         
         with timer("resize_from_m_to_t_csr.csr"):
@@ -1133,7 +1135,70 @@ def test_config(
     if not only_bench:
         bench('naive_convert', bench_naive_convert, t_warmup=0.5, t_sample=3)
 
+def test_regression():
+    """
+    shapes which used to overflow max_col_z heuristic of METHOD 2 and re-run scan_col.
+    scan_col should run exactly once, and both methods should produce same mask when k does not clamp.
+    """
+    import sys
+    from .causal_topk_masking import causal_topk_masking
+    from .flat_csr_to_dense import flat_csr_to_dense
+    
+    module = sys.modules[__name__]
+    scan_col_original = module.scan_col
+    scan_col_calls = [0]
+    def scan_col_counted(*args, **kwargs):
+        scan_col_calls[0] += 1
+        return scan_col_original(*args, **kwargs)
+    module.scan_col = scan_col_counted
+    
+    FP_MIN = torch.finfo(torch.float16).min * 0.5
+    device = 0
+    try:
+        for IS_CAUSAL, N, H, T, T_DST, T_M, K, K_OS in [
+            (True, 1, 1, 32, 32, 2, 4, 1.0),
+            (True, 1, 1, 64, 64, 8, 16, 1.0),
+            (True, 1, 1, 64, 64, 8, 16, 4.0),
+            (True, 2, 4, 1024, 1024, 32, 8, 2.0),
+            (True, 1, 12, 4096, 4096, 128, 32, 1.0),
+            (True, 1, 12, 4096, 4096, 128, 32, 4.0),
+            (True, 1, 12, 4096, 1024, 128, 32, 2.0),
+            (False, 2, 4, 1024, 1024, 32, 8, 4.0),
+        ]:
+            estimated_probs = torch.softmax(torch.randn((N, H, T_DST, T_M), device=device), dim=-1)
+            causal_attention_mask = ((torch.arange(T, device=device).view(1, T) > torch.arange(T, device=device).view(T, 1)) * FP_MIN).view(1, 1, T, T)
+            causal_attention_mask = causal_attention_mask[:, :, -T_DST:, :]
+            compressed_mask = causal_topk_masking(
+                estimated_probs, 
+                k=K * K_OS, 
+                attention_mask=causal_attention_mask[:,:,-1:,:], 
+                dst_attention_mask=causal_attention_mask[:,:,:,:1], 
+                causal_attention_mask=causal_attention_mask,
+                is_causal=IS_CAUSAL
+            )
+            
+            denses = []
+            for method in [1, 2]:
+                scan_col_calls[0] = 0
+                csr = resize_from_m_to_t_csr(
+                    compressed_mask, 0, 
+                    # NOTE: METHOD 2 does not clamp duplication with k
+                    k=math.ceil(T / T_M) if method == 1 else K,
+                    target_width=T, 
+                    is_causal=IS_CAUSAL,
+                    oversampled=K_OS,
+                    method=method,
+                )
+                assert scan_col_calls[0] == 1, scan_col_calls[0]
+                denses.append(flat_csr_to_dense(csr, T, H))
+            assert torch.equal(denses[0], denses[1])
+            print(f'regression passed (causal={IS_CAUSAL}, N={N}, H={H}, T={T}, T_DST={T_DST}, T_M={T_M}, K={K}, K_OS={K_OS})')
+    finally:
+        module.scan_col = scan_col_original
+
 def test_main():
+    test_regression()
+    
     IS_CAUSAL = True
     
     N = 1
@@ -1,4 +1,5 @@
 import torch, math
+from .topk_select import topk_alive_mask
 
 def causal_topk_masking(
     probs, 
@@ -9,8 +10,10 @@ def causal_topk_masking(
     not_padded=True, 
     k_flatten_dim='causal_batch',
     is_causal=True,
+    causal_token_length=None,
 ):
     # attention_mask is always for src
+    # causal_token_length: visible tokens of each dst row (T_DST,), counted from causal_attention_mask when None
     assert k_flatten_dim == 'causal_batch'
     assert not_padded
     
@@ -23,7 +26,9 @@ def causal_topk_masking(
         
     masked_estimated_attention_probs = (probs * (dst_attention_mask > -1))
     
-    causal_token_length = (causal_attention_mask > -1).long().sum(-1).view(1, 1, T_DST, 1)
+    if causal_token_length is None:
+        causal_token_length = (causal_attention_mask > -1).long().sum(-1)
+    causal_token_length = causal_token_length.view(1, 1, T_DST, 1)
     
     t = masked_estimated_attention_probs.transpose(1, 2).reshape(N, T_DST, H*T_M)
     # NOTE consider causal token length
@@ -38,32 +43,8 @@ def causal_topk_masking(
     
     top_k_elems = min(int(math.ceil(torch.max(per_item_top_k).item())), t.shape[-1])
         
-    _, indices = torch.topk(
-        input=t,
-        k=top_k_elems, 
-        dim=-1, 
-        sorted=True #sorted true is important
-    )
-        
-    partial_attention_mask = torch.empty(
-        t.shape, 
-        dtype=torch.long, 
-        device=attention_mask.device,
-    )
-    partial_attention_mask.fill_(t.shape[-1])
-    partial_attention_mask.scatter_(
-        dim=-1,
-        index=indices,
-        src=torch.arange(
-            top_k_elems, 
-            dtype=torch.long,
-            device=attention_mask.device, 
-        )\
-            .view((1, -1) if t.ndim == 2 else (1, 1, -1))\
-            .expand(indices.shape)
-    )
-        
-    t_alive_mask = partial_attention_mask < per_item_top_k
+    # NOTE only membership of top-k is used, see topk_select
+    t_alive_mask = topk_alive_mask(t, per_item_top_k, top_k_elems)
     partial_attention_mask = t_alive_mask.float()
     
     partial_attention_mask = partial_attention_mask.view(N, T_DST, H, T_M).transpose(1, 2)
@@ -0,0 +1,302 @@
+"""
+Autograd functions of flat CSR ops.
+
+Values of torch sparse csr tensors are not differentiable, so functions take and return
+values (N, Z) of given mask structure. Forward is dispatched same as `ops.dispatch`, and
+backward is computed with row-segment torch ops, so saved activations are O(Z) instead of
+dense N x H x T_DST x T_SRC.
+"""
+
+import torch
+from .flat_csr_cpu import (
+    parallel_for,
+    row_blocks,
+    partition_rows,
+    mask_row_entries,
+    mask_values,
+    mask_with_values,
+    acc_dtype,
+)
+
+# NOTE: single underscore, double underscore names are mangled inside of autograd Function classes
+def _batch_row_blocks(mask, n: int, T_DST: int):
+    for _, r0, r1 in row_blocks(1, T_DST):
+        e0, e1, rows, cols = mask_row_entries(mask, n, r0, r1)
+        if e1 > e0:
+            yield e0, e1, rows, cols
+
+class FlatCSRMaskedBmm(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, a: torch.Tensor, b: torch.Tensor, mask):
+        from ..dispatch import flat_csr_masked_bmm
+
+        ctx.mask = mask
+        ctx.save_for_backward(a, b)
+        out_mask = mask_with_values(mask, torch.zeros(mask_values(mask).shape, dtype=a.dtype, device=a.device))
+        return mask_values(flat_csr_masked_bmm(a, b, out_mask))
+
+    @staticmethod
+    def backward(ctx, grad: torch.Tensor):
+        a, b = ctx.saved_tensors
+        mask = ctx.mask
+        N, H, T_DST, HID = a.shape
+        T_SRC = b.shape[2]
+        dtype = acc_dtype(a, b, grad)
+
+        a_flat = a.reshape(N, H*T_DST, HID)
+        b_flat = b.reshape(N, H*T_SRC, HID)
+        grad_a = torch.zeros((N, H*T_DST, HID), dtype=dtype, device=a.device) if ctx.needs_input_grad[0] else None
+        grad_b = torch.zeros((N, H*T_SRC, HID), dtype=dtype, device=b.device) if ctx.needs_input_grad[1] else None
+
+        # NOTE: columns are shared between row blocks, so each job owns whole batch
+        def job(n):
+            for e0, e1, rows, cols in _batch_row_blocks(mask, n, T_DST):
+                g = grad[n, e0:e1].to(dtype)[:, None]
+                q_index = (cols // T_SRC) * T_DST + rows
+                if grad_a is not None:
+                    grad_a[n].index_add_(0, q_index, g * b_flat[n].index_select(0, cols).to(dtype))
+                if grad_b is not None:
+                    grad_b[n].index_add_(0, cols, g * a_flat[n].index_select(0, q_index).to(dtype))
+
+        parallel_for(job, [(n,) for n in range(N)])
+
+        return (
+            grad_a.view(a.shape).to(a.dtype) if grad_a is not None else None,
+            grad_b.view(b.shape).to(b.dtype) if grad_b is not None else None,
+            None,
+        )
+
+class FlatCSRSoftmax(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, values: torch.Tensor, mask, H: int, T_SRC: int):
+        from ..dispatch import flat_csr_softmax
+
+        probs = mask_values(flat_csr_softmax(mask_with_values(mask, values), H, T_SRC))
+        ctx.mask = mask
+        ctx.H = H
+        ctx.T_SRC = T_SRC
+        ctx.save_for_backward(probs)
+        return probs
+
+    @staticmethod
+    def backward(ctx, grad: torch.Tensor):
+        probs, = ctx.saved_tensors
+        mask, H, T_SRC = ctx.mask, ctx.H, ctx.T_SRC
+        N, T_DST, _ = mask.shape
+        dtype = acc_dtype(probs, grad)
+        grad_values = torch.zeros_like(probs)
+
+        def job(n, r0, r1):
+            e0, e1, rows, cols = mask_row_entries(mask, n, r0, r1)
+            if e1 <= e0:
+                return
+            group = (rows - r0) * H + cols // T_SRC
+            p = probs[n, e0:e1].to(dtype)
+            g = grad[n, e0:e1].to(dtype)
+            # dL/ds = p * (g - sum_group(g * p))
+            dot = torch.zeros(((r1 - r0) * H,), dtype=dtype, device=p.device).index_add_(0, group, g * p)
+            grad_values[n, e0:e1] = (p * (g - dot[group])).to(grad_values.dtype)
+
+        parallel_for(job, partition_rows(mask, N, T_DST))
+
+        return grad_values, None, None, None
+
+def _gather_dense(dense: torch.Tensor, n: int, rows, cols, T_SRC: int):
+    # dense: N, H, T_DST, T_SRC or N, H, T_DST, 1 (row scaler)
+    W = dense.shape[-1]
+    return dense[n, cols // T_SRC, rows, (cols % T_SRC) if W > 1 else 0]
+
+class FlatCSRElmul(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, values: torch.Tensor, mask, dense: torch.Tensor):
+        from ..dispatch import flat_csr_elmul
+
+        N, T_DST, HT_SRC = mask.shape
+        _, H, _, _ = dense.shape
+        out = flat_csr_elmul(
+            mask_with_values(mask, values),
+            dense.expand(N, H, T_DST, HT_SRC // H),
+        )
+        ctx.mask = mask
+        ctx.save_for_backward(values, dense)
+        return mask_values(out)
+
+    @staticmethod
+    def backward(ctx, grad: torch.Tensor):
+        values, dense = ctx.saved_tensors
+        mask = ctx.mask
+        N, T_DST, HT_SRC = mask.shape
+        _, H, _, W = dense.shape
+        T_SRC = HT_SRC // H
+        dtype = acc_dtype(values, dense, grad)
+
+        grad_values = torch.zeros_like(values) if ctx.needs_input_grad[0] else None
+        # NOTE: row scaler (W == 1) keeps gradient of dense in O(N*H*T_DST)
+        grad_dense = torch.zeros((N, H*T_DST*W), dtype=dtype, device=dense.device) if ctx.needs_input_grad[2] else None
+
+        def job(n):
+            for e0, e1, rows, cols in _batch_row_blocks(mask, n, T_DST):
+                g = grad[n, e0:e1].to(dtype)
+                if grad_values is not None:
+                    scaler = _gather_dense(dense, n, rows, cols, T_SRC).to(dtype)
+                    grad_values[n, e0:e1] = (g * scaler).to(grad_values.dtype)
+                if grad_dense is not None:
+                    index = ((cols // T_SRC) * T_DST + rows) * W
+                    if W > 1:
+                        index = index + cols % T_SRC
+                    grad_dense[n].index_add_(0, index, g * values[n, e0:e1].to(dtype))
+
+        parallel_for(job, [(n,) for n in range(N)])
+
+        return (
+            grad_values,
+            None,
+            grad_dense.view(dense.shape).to(dense.dtype) if grad_dense is not None else None,
+        )
+
+class FlatCSRSdbmm(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, values: torch.Tensor, mask, value_layer: torch.Tensor, T_M: int):
+        from ..dispatch import flat_csr_sdbmm
+
+        ctx.mask = mask
+        ctx.save_for_backward(values, value_layer)
+        return flat_csr_sdbmm(mask_with_values(mask, values), value_layer, T_M)
+
+    @staticmethod
+    def backward(ctx, grad: torch.Tensor):
+        values, value_layer = ctx.saved_tensors
+        mask = ctx.mask
+        N, H, T_SRC, HID = value_layer.shape
+        T_DST = mask.shape[1]
+        dtype = acc_dtype(values, value_layer, grad)
+
+        v_flat = value_layer.reshape(N, H*T_SRC, HID)
+        grad_flat = grad.reshape(N, H*T_DST, HID)
+        grad_values = torch.zeros_like(values) if ctx.needs_input_grad[0] else None
+        grad_v = torch.zeros((N, H*T_SRC, HID), dtype=dtype, device=value_layer.device) if ctx.needs_input_grad[2] else None
+
+        def job(n):
+            for e0, e1, rows, cols in _batch_row_blocks(mask, n, T_DST):
+                g = grad_flat[n].index_select(0, (cols // T_SRC) * T_DST + rows).to(dtype)
+                if grad_values is not None:
+                    grad_values[n, e0:e1] = (g * v_flat[n].index_select(0, cols).to(dtype)).sum(-1).to(grad_values.dtype)
+                if grad_v is not None:
+                    grad_v[n].index_add_(0, cols, g * values[n, e0:e1].to(dtype)[:, None])
+
+        parallel_for(job, [(n,) for n in range(N)])
+
+        return (
+            grad_values,
+            None,
+            grad_v.view(value_layer.shape).to(value_layer.dtype) if grad_v is not None else None,
+            None,
+        )
+
+def flat_csr_masked_bmm_autograd(a: torch.Tensor, b: torch.Tensor, mask):
+    """
+    returns values (N, Z) of a @ b.T on mask
+    """
+    return FlatCSRMaskedBmm.apply(a, b, mask)
+
+def flat_csr_softmax_autograd(values: torch.Tensor, mask, H: int, T_SRC: int):
+    return FlatCSRSoftmax.apply(values, mask, H, T_SRC)
+
+def flat_csr_elmul_autograd(values: torch.Tensor, mask, dense: torch.Tensor):
+    """
+    dense: N, H, T_DST, T_SRC, or N, H, T_DST, 1 for row scaler
+    """
+    return FlatCSRElmul.apply(values, mask, dense)
+
+def flat_csr_sdbmm_autograd(values: torch.Tensor, mask, value_layer: torch.Tensor, T_M: int = None):
+    return FlatCSRSdbmm.apply(values, mask, value_layer, T_M)
+
+def flat_csr_attention_autograd(
+    q: torch.Tensor,
+    k: torch.Tensor,
+    v: torch.Tensor,
+    mask,
+    row_scaler: torch.Tensor = None,
+    T_M: int = None,
+):
+    """
+    differentiable masked_bmm -> softmax -> elmul(row scaler) -> sdbmm.
+    row_scaler: N, H, T_DST
+    return: N, H, T_DST, HID
+    """
+    N, H, T_DST, _ = q.shape
+    T_SRC = k.shape[2]
+    scores = flat_csr_masked_bmm_autograd(q, k, mask)
+    probs = flat_csr_softmax_autograd(scores, mask, H, T_SRC)
+    if row_scaler is not None:
+        probs = flat_csr_elmul_autograd(probs, mask, row_scaler.view(N, H, T_DST, 1))
+    return flat_csr_sdbmm_autograd(probs, mask, v, T_M)
+
+def test_config(IS_CAUSAL, N, H, T, T_DST, T_M, K, HID):
+    from .....utils import seed
+    from .causal_topk_masking import causal_topk_masking
+    from .flat_csr_cpu import resize_from_m_to_t_csr_cpu
+    from .flat_csr_to_dense import flat_csr_to_dense
+
+    seed()
+
+    FP_MIN = torch.finfo(torch.float16).min * 0.5
+    device = 'cpu'
+    dtype = torch.float64
+
+    estimated_probs = torch.softmax(torch.randn((N, H, T_DST, T_M), device=device), dim=-1)
+    causal_attention_mask = ((torch.arange(T, device=device).view(1, T) > torch.arange(T, device=device).view(T, 1)) * FP_MIN).view(1, 1, T, T)
+    causal_attention_mask = causal_attention_mask[:, :, -T_DST:, :]
+    compressed_mask = causal_topk_masking(
+        estimated_probs,
+        k=K,
+        attention_mask=causal_attention_mask[:,:,-1:,:],
+        dst_attention_mask=causal_attention_mask[:,:,:,:1],
+        causal_attention_mask=causal_attention_mask,
+        is_causal=IS_CAUSAL,
+    )
+    mask = resize_from_m_to_t_csr_cpu(compressed_mask, 0, K, target_width=T, is_causal=IS_CAUSAL)
+    Z = mask.values().shape[-1]
+
+    q = torch.randn((N, H, T_DST, HID), dtype=dtype, requires_grad=True)
+    k = torch.randn((N, H, T, HID), dtype=dtype, requires_grad=True)
+    v = torch.randn((N, H, T, HID), dtype=dtype, requires_grad=True)
+    values = torch.randn((N, Z), dtype=dtype, requires_grad=True)
+    row_scaler = torch.rand((N, H, T_DST, 1), dtype=dtype, requires_grad=True)
+    dense_scaler = torch.rand((N, H, T_DST, T), dtype=dtype, requires_grad=True)
+
+    # NOTE: padding entries after crow_indices[:, -1] are not part of mask, so only valid entries are checked
+    z_valid = mask.crow_indices()[:, -1].view(N, 1) > torch.arange(Z).view(1, Z)
+    def valid(t):
+        return t * z_valid
+
+    assert torch.autograd.gradcheck(lambda a, b: valid(flat_csr_masked_bmm_autograd(a, b, mask)), (q, k))
+    assert torch.autograd.gradcheck(lambda x: valid(flat_csr_softmax_autograd(x, mask, H, T)), (values,))
+    assert torch.autograd.gradcheck(lambda x, d: valid(flat_csr_elmul_autograd(x, mask, d)), (values, row_scaler))
+    assert torch.autograd.gradcheck(lambda x, d: valid(flat_csr_elmul_autograd(x, mask, d)), (values, dense_scaler))
+    assert torch.autograd.gradcheck(lambda x, v: flat_csr_sdbmm_autograd(valid(x), mask, v, T_M), (values, v))
+    assert torch.autograd.gradcheck(
+        lambda q, k, v, s: flat_csr_attention_autograd(q, k, v, mask, s.squeeze(-1), T_M),
+        (q, k, v, row_scaler)
+    )
+
+    # gradients should match dense masked attention
+    dense_mask = flat_csr_to_dense(mask, T, H)
+    output = flat_csr_attention_autograd(q, k, v, mask, row_scaler.squeeze(-1), T_M)
+    grads = torch.autograd.grad(output.square().sum(), (q, k, v, row_scaler))
+    # NOTE: -1e9 instead of -inf, rows without entries should have zero output and gradient
+    scores = torch.matmul(q, k.transpose(-1, -2)).masked_fill(dense_mask == 0, -1e9)
+    truth = torch.matmul(torch.softmax(scores, dim=-1) * dense_mask * row_scaler, v)
+    grads_truth = torch.autograd.grad(truth.square().sum(), (q, k, v, row_scaler))
+    for g, g_truth in zip(grads, grads_truth):
+        max_error = (g - g_truth).abs().max().item()
+        print('grad error', max_error)
+        assert max_error < 1e-8
+
+def test_main():
+    for is_causal in [True, False]:
+        test_config(is_causal, 2, 2, 24, 24, 4, 2, 4)
+        test_config(is_causal, 1, 2, 40, 16, 8, 3, 4)
+
+if __name__ == '__main__':
+    test_main()
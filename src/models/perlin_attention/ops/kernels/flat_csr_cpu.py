@@ -0,0 +1,434 @@
+"""
+CPU implementations of flat CSR ops.
+
+Same inputs and outputs as triton kernels (`flat_csr_masked_bmm`, `flat_csr_softmax`,
+`flat_csr_elmul`, `flat_csr_sdbmm`, `resize_from_m_to_t_csr`), but written with
+vectorized torch row-segment ops. Work is split into (batch, row block) jobs and
+executed on a thread pool, torch releases GIL inside of each op.
+
+PERLIN_CPU_THREADS: number of worker threads (default: os.cpu_count())
+PERLIN_CPU_BLOCK_ROW: number of rows per job (default: 256)
+PERLIN_CPU_PARTITION: 'nnz' (default, row blocks with balanced number of entries), 'rows' (fixed number of rows)
+PERLIN_CPU_BLOCK_NNZ: target number of entries per job of 'nnz' partition (default: 65536)
+
+Jobs are threads of one process, so Q/K/V and masks are shared without copies.
+"""
+
+import os
+import torch
+from concurrent.futures import ThreadPoolExecutor
+
+CPU_NUM_THREADS = int(os.environ.get('PERLIN_CPU_THREADS', '0')) or (os.cpu_count() or 1)
+CPU_BLOCK_ROW = int(os.environ.get('PERLIN_CPU_BLOCK_ROW', '256'))
+CPU_PARTITION = os.environ.get('PERLIN_CPU_PARTITION', 'nnz')
+CPU_BLOCK_NNZ = int(os.environ.get('PERLIN_CPU_BLOCK_NNZ', '65536'))
+
+__executor = None
+
+def get_cpu_executor() -> ThreadPoolExecutor:
+    global __executor
+    if __executor is None:
+        __executor = ThreadPoolExecutor(max_workers=CPU_NUM_THREADS, thread_name_prefix='perlin_cpu')
+    return __executor
+
+def set_cpu_threads(num_threads: int):
+    """
+    changes number of worker threads. previous pool finishes queued jobs before shutdown.
+    """
+    global CPU_NUM_THREADS, __executor
+    if __executor is not None:
+        __executor.shutdown(wait=True)
+        __executor = None
+    CPU_NUM_THREADS = max(1, int(num_threads))
+
+def parallel_for(fn, jobs):
+    jobs = list(jobs)
+    if len(jobs) <= 1 or CPU_NUM_THREADS <= 1:
+        return [fn(*job) for job in jobs]
+    return list(get_cpu_executor().map(lambda job: fn(*job), jobs))
+
+def row_blocks(N: int, R: int, block_row: int = None):
+    if block_row is None:
+        block_row = CPU_BLOCK_ROW
+    for n in range(N):
+        for r0 in range(0, R, block_row):
+            yield (n, r0, min(R, r0 + block_row))
+
+def nnz_row_blocks(crow_indices: torch.Tensor, block_nnz: int = None, min_blocks: int = None):
+    """
+    splits rows of each batch into contiguous blocks with similar number of entries.
+    crow_indices: N, T_DST+1 (cumulative entries)
+    yields (n, r0, r1) same with row_blocks. a row is never split, so one heavy row can be a block alone.
+    """
+    if block_nnz is None:
+        block_nnz = CPU_BLOCK_NNZ
+    if min_blocks is None:
+        min_blocks = CPU_NUM_THREADS
+    crow = crow_indices.long().cpu()
+    N = crow.shape[0]
+    T_DST = crow.shape[1] - 1
+    if T_DST <= 0:
+        return
+    min_blocks_per_batch = -(-min_blocks // max(1, N))
+    for n in range(N):
+        start = int(crow[n, 0])
+        total = int(crow[n, -1]) - start
+        parts = min(T_DST, max(1, -(-total // block_nnz), min_blocks_per_batch))
+        if parts <= 1 or total <= 0:
+            yield (n, 0, T_DST)
+            continue
+        targets = start + torch.div(torch.arange(1, parts) * total, parts, rounding_mode='floor')
+        # first row which starts at or after each target
+        bounds = torch.searchsorted(crow[n].contiguous(), targets).clamp(0, T_DST)
+        bounds = torch.cat([torch.zeros((1,), dtype=torch.long), bounds, torch.full((1,), T_DST)])
+        bounds = torch.unique_consecutive(bounds).tolist()
+        for r0, r1 in zip(bounds[:-1], bounds[1:]):
+            yield (n, r0, r1)
+
+def mask_entry_crow_indices(mask):
+    if isinstance(mask, torch.Tensor):
+        return mask.crow_indices()
+    if hasattr(mask, 'entry_crow_indices'):
+        # BlockRunMask, crow_indices are offsets of runs
+        return mask.entry_crow_indices
+    return mask.crow_indices()
+
+def partition_rows(mask, N: int, T_DST: int):
+    """
+    jobs (n, r0, r1) over rows of sparse mask, by PERLIN_CPU_PARTITION
+    """
+    if CPU_PARTITION == 'nnz':
+        return nnz_row_blocks(mask_entry_crow_indices(mask))
+    if CPU_PARTITION == 'rows':
+        return row_blocks(N, T_DST)
+    raise Exception(CPU_PARTITION)
+
+def row_entries(crow_indices: torch.Tensor, col_indices: torch.Tensor, n: int, r0: int, r1: int):
+    """
+    returns (entry_start, entry_end, rows, cols) of rows [r0, r1) in batch n.
+    cols are flatten column index (head * T_SRC + col)
+    """
+    crow = crow_indices[n, r0:r1+1].long()
+    e0 = int(crow[0])
+    e1 = int(crow[-1])
+    rows = torch.repeat_interleave(
+        torch.arange(r0, r1, device=crow.device),
+        crow[1:] - crow[:-1]
+    )
+    cols = col_indices[n, e0:e1].long()
+    return e0, e1, rows, cols
+
+def is_sparse_mask(mask):
+    """
+    flat csr tensor, or other mask format which implements `row_entries` (e.g. BlockRunMask)
+    """
+    if isinstance(mask, torch.Tensor):
+        return mask.is_sparse_csr
+    return hasattr(mask, 'row_entries')
+
+def mask_row_entries(mask, n: int, r0: int, r1: int):
+    if isinstance(mask, torch.Tensor):
+        return row_entries(mask.crow_indices(), mask.col_indices(), n, r0, r1)
+    return mask.row_entries(n, r0, r1)
+
+def mask_values(mask):
+    if isinstance(mask, torch.Tensor):
+        return mask.values()
+    if mask.values is None:
+        return torch.ones((mask.shape[0], mask.nnz), dtype=mask.dtype, device=mask.device)
+    return mask.values
+
+def mask_with_values(mask, values: torch.Tensor):
+    if isinstance(mask, torch.Tensor):
+        return torch.sparse_csr_tensor(
+            crow_indices=mask.crow_indices(),
+            col_indices=mask.col_indices(),
+            values=values,
+            size=mask.shape,
+        )
+    return mask.with_values(values)
+
+def acc_dtype(*tensors):
+    # accumulate in float32, float64 inputs (e.g. gradcheck) keep their precision
+    if any(t.dtype == torch.float64 for t in tensors):
+        return torch.float64
+    return torch.float32
+
+def round_half_away(x: torch.Tensor):
+    # same as tl.math.round for non negative inputs
+    return torch.floor(x + 0.5)
+
+def resize_from_m_to_t_csr_cpu(
+    x,
+    masked_fill_value,
+    k,
+    target_width=None,
+    training=False,
+    need_assert=False,
+    is_causal=True,
+    max_col_z = None,
+    benchmarking = False,
+    oversampled = None,
+    binary = False,
+    method = None,
+):
+    # NOTE: max_col_z and method are accepted for compatibility with triton version, columns are always counted first.
+    assert not training
+    assert masked_fill_value == 0
+    N, H, T_DST, T_M = x.shape
+    if target_width is not None:
+        T_SRC = target_width
+    else:
+        T_SRC = T_DST
+
+    x = x.transpose(1, 2).reshape(N, T_DST, H*T_M)
+
+    if is_causal:
+        widths = torch.arange(1, T_SRC+1, device=x.device)[-T_DST:]
+    else:
+        widths = torch.full((T_SRC,), T_SRC, device=x.device)[-T_DST:]
+    scales = (widths / T_M).view(T_DST, 1)
+
+    b = torch.arange(0, T_M, device=x.device).view(1, T_M)
+    v_starts = round_half_away(b * scales)
+    v_ends = round_half_away((b + 1) * scales)
+
+    n_pixels = (v_ends - v_starts).view(1, T_DST, 1, T_M).to(torch.int32) * x.view(N, T_DST, H, T_M).to(torch.int32)
+    torch.clamp_max(n_pixels, k, out=n_pixels)
+    n_pixels = n_pixels.view(N, -1)
+
+    if binary:
+        from .binary_csr_mask import narrow_col_dtype
+        index_dtype = torch.int32
+        col_dtype = narrow_col_dtype(H*T_SRC)
+    else:
+        index_dtype = col_dtype = torch.long
+    crow_indices = torch.zeros((N, T_DST+1), dtype=index_dtype, device=x.device)
+    crow_indices[:, 1:] = n_pixels.view(N, T_DST, -1).sum(-1).cumsum(-1)
+    Z = int(crow_indices[:, -1].max().item())
+    col_indices = torch.zeros((N, Z), dtype=col_dtype, device=x.device)
+
+    def job(n):
+        counts = n_pixels[n].long()
+        idx_pixel = counts.nonzero().squeeze(-1)
+        if idx_pixel.numel() == 0:
+            return
+        lengths = counts[idx_pixel]
+        idx_tdst = idx_pixel // (H*T_M)
+        idx_h = (idx_pixel % (H*T_M)) // T_M
+        idx_tm = idx_pixel % T_M
+
+        range_start = v_starts[idx_tdst, idx_tm] + idx_h * T_SRC
+        range_end = v_ends[idx_tdst, idx_tm] + idx_h * T_SRC
+        step = (range_end - range_start) / lengths
+
+        owner = torch.repeat_interleave(torch.arange(idx_pixel.numel(), device=x.device), lengths)
+        offsets = lengths.cumsum(0) - lengths
+        total = int(offsets[-1] + lengths[-1])
+        i = torch.arange(total, device=x.device) - offsets[owner]
+        # NOTE: columns are written from the end of the range, and evenly strided if the range is clamped by k.
+        cols = range_end[owner] - (i * step[owner]).to(torch.int32) - 1
+        col_indices[n, :total] = cols.to(col_dtype)
+
+    parallel_for(job, [(n,) for n in range(N)])
+
+    if binary:
+        from .binary_csr_mask import BinaryCSRMask
+        return BinaryCSRMask.from_indices(crow_indices, col_indices, (N, T_DST, H*T_SRC), dtype=x.dtype)
+
+    return torch.sparse_csr_tensor(
+        crow_indices=crow_indices,
+        col_indices=col_indices,
+        values=torch.ones_like(col_indices, dtype=x.dtype),
+        size=(N, T_DST, H*T_SRC)
+    )
+
+def flat_csr_masked_bmm_cpu(a: torch.Tensor, b: torch.Tensor, mask: torch.Tensor, max_z_per_row: int=None):
+    assert is_sparse_mask(mask)
+    assert a.ndim == b.ndim
+    assert a.ndim == 4
+    N, H, T_DST, HID = a.shape
+    assert b.shape[:2] == (N, H)
+    _, _, T_SRC, HID = b.shape
+    assert mask.shape == (N, T_DST, H*T_SRC)
+
+    out_values = mask_values(mask).clone()
+    dtype = acc_dtype(a, b)
+
+    a_flat = a.reshape(N, H*T_DST, HID)
+    b_flat = b.reshape(N, H*T_SRC, HID)
+
+    def job(n, r0, r1):
+        e0, e1, rows, cols = mask_row_entries(mask, n, r0, r1)
+        if e1 <= e0:
+            return
+        heads = cols // T_SRC
+        q = a_flat[n].index_select(0, heads * T_DST + rows).to(dtype)
+        k = b_flat[n].index_select(0, cols).to(dtype)
+        out_values[n, e0:e1] = (q * k).sum(-1).to(out_values.dtype)
+
+    parallel_for(job, partition_rows(mask, N, T_DST))
+
+    return mask_with_values(mask, out_values)
+
+def flat_csr_softmax_cpu(scores: torch.Tensor, H:int, T_SRC:int, max_z_per_row:int=None):
+    assert is_sparse_mask(scores)
+    in_values = mask_values(scores)
+    out_values = in_values.clone()
+    dtype = acc_dtype(in_values)
+    N, T_DST, _ = scores.shape
+
+    def job(n, r0, r1):
+        e0, e1, rows, cols = mask_row_entries(scores, n, r0, r1)
+        if e1 <= e0:
+            return
+        # softmax is computed per (row, head) segment
+        group = (rows - r0) * H + cols // T_SRC
+        G = (r1 - r0) * H
+        s = in_values[n, e0:e1].to(dtype)
+        g_max = torch.full((G,), -float('inf'), dtype=dtype, device=s.device)\
+            .scatter_reduce(0, group, s, reduce='amax', include_self=True)
+        e = torch.exp(s - g_max[group])
+        g_sum = torch.zeros((G,), dtype=dtype, device=s.device).index_add_(0, group, e)
+        out_values[n, e0:e1] = (e / g_sum[group]).to(out_values.dtype)
+
+    parallel_for(job, partition_rows(scores, N, T_DST))
+
+    return mask_with_values(scores, out_values)
+
+def flat_csr_elmul_cpu(probs: torch.Tensor, dense: torch.Tensor, max_z_per_row:int=None):
+    assert is_sparse_mask(probs)
+    N, T_DST, H_T = probs.shape
+    _N, H, _T_DST, T = dense.shape
+    assert T_DST == _T_DST
+    assert N == _N
+    assert H_T == H*T
+
+    in_values = mask_values(probs)
+    out_values = in_values.clone()
+
+    def job(n, r0, r1):
+        e0, e1, rows, cols = mask_row_entries(probs, n, r0, r1)
+        if e1 <= e0:
+            return
+        # NOTE: dense is usually expanded view, so do not reshape it
+        scaler = dense[n, cols // T, rows, cols % T]
+        out_values[n, e0:e1] = (in_values[n, e0:e1] * scaler).to(out_values.dtype)
+
+    parallel_for(job, partition_rows(probs, N, T_DST))
+
+    return mask_with_values(probs, out_values)
+
+def flat_csr_sdbmm_cpu(scores: torch.Tensor, value_layer: torch.Tensor, T_M: int, max_z_per_row:int=None, benchmarking:bool=False):
+    assert is_sparse_mask(scores)
+    values = mask_values(scores)
+    assert values.device == value_layer.device
+
+    N, H, T_SRC, HID = value_layer.shape
+    _N, T_DST, HT_SRC = scores.shape
+    assert N == _N
+    assert HT_SRC == (H*T_SRC)
+    dtype = acc_dtype(values, value_layer)
+    output = torch.zeros((N, H, T_DST, HID), dtype=dtype, device=values.device)
+
+    v_flat = value_layer.reshape(N, H*T_SRC, HID)
+
+    def job(n, r0, r1):
+        e0, e1, rows, cols = mask_row_entries(scores, n, r0, r1)
+        if e1 <= e0:
+            return
+        group = (rows - r0) * H + cols // T_SRC
+        weighted = v_flat[n].index_select(0, cols).to(dtype) * values[n, e0:e1].to(dtype)[:, None]
+        acc = torch.zeros(((r1 - r0) * H, HID), dtype=dtype, device=output.device)
+        acc.index_add_(0, group, weighted)
+        output[n, :, r0:r1] = acc.view(r1 - r0, H, HID).transpose(0, 1)
+
+    parallel_for(job, partition_rows(scores, N, T_DST))
+
+    return output
+
+def test_config(IS_CAUSAL, N, H, T, T_DST, T_M, K, HID):
+    from .....utils import seed
+    from .causal_topk_masking import causal_topk_masking
+    from .flat_csr_to_dense import flat_csr_to_dense
+    # NOTE: references are dense torch ops, naive_* of triton kernel modules need triton
+
+    seed()
+
+    FP_MIN = torch.finfo(torch.float16).min * 0.5
+    device = 'cpu'
+
+    estimated_scores = torch.randn((N, H, T_DST, T_M), device=device)
+    estimated_probs = torch.softmax(estimated_scores, dim=-1)
+    causal_attention_mask = ((torch.arange(T, device=device).view(1, T) > torch.arange(T, device=device).view(T, 1)) * FP_MIN).view(1, 1, T, T)
+    causal_attention_mask = causal_attention_mask[:, :, -T_DST:, :]
+    attention_mask = causal_attention_mask[:,:,-1:,:]
+    dst_attention_mask = causal_attention_mask[:,:,:,:1]
+
+    compressed_mask = causal_topk_masking(
+        estimated_probs,
+        k=K,
+        attention_mask=attention_mask,
+        dst_attention_mask=dst_attention_mask,
+        causal_attention_mask=causal_attention_mask,
+        is_causal=IS_CAUSAL,
+    )
+
+    csr_mask = resize_from_m_to_t_csr_cpu(
+        compressed_mask, 0, K,
+        target_width=T,
+        is_causal=IS_CAUSAL,
+    )
+    if torch.cuda.is_available():
+        from .causal_resize_m_to_t import resize_from_m_to_t_csr
+        csr_mask_triton = resize_from_m_to_t_csr(
+            compressed_mask.cuda(), 0, K,
+            target_width=T,
+            is_causal=IS_CAUSAL,
+        )
+        assert torch.equal(csr_mask.crow_indices(), csr_mask_triton.crow_indices().cpu())
+        assert torch.equal(csr_mask.col_indices(), csr_mask_triton.col_indices().cpu())
+    dense_mask = flat_csr_to_dense(csr_mask, T, H)
+    masked_out = dense_mask == 0
+
+    query_layer = torch.randn((N, H, T_DST, HID), device=device)
+    key_layer = torch.randn((N, H, T, HID), device=device)
+    value_layer = torch.randn((N, H, T, HID), device=device)
+    row_scaler = torch.rand((N, H, T_DST, 1), device=device).expand(N, H, T_DST, T)
+
+    def check(name, truth, sparse, threshold=1e-4):
+        if sparse.is_sparse_csr:
+            sparse = flat_csr_to_dense(sparse, T, H)
+        max_error = (truth - sparse).abs().max().item()
+        print(name, max_error)
+        assert max_error < threshold, f'{name} max error exceed threshold ({max_error} >= {threshold})'
+
+    csr_score = flat_csr_masked_bmm_cpu(query_layer, key_layer, csr_mask)
+    score = torch.matmul(query_layer, key_layer.transpose(-1, -2)) * dense_mask
+    check('masked_bmm', score, csr_score)
+
+    csr_probs = flat_csr_softmax_cpu(csr_score, H, T)
+    probs = torch.softmax(flat_csr_to_dense(csr_score, T, H).masked_fill(masked_out, FP_MIN), dim=-1).masked_fill_(masked_out, 0)
+    check('softmax', probs, csr_probs)
+
+    csr_scaled = flat_csr_elmul_cpu(csr_probs, row_scaler)
+    scaled = flat_csr_to_dense(csr_probs, T, H) * row_scaler
+    check('elmul', scaled, csr_scaled)
+
+    context = flat_csr_sdbmm_cpu(csr_scaled, value_layer, T_M)
+    context_truth = torch.matmul(flat_csr_to_dense(csr_scaled, T, H), value_layer)
+    check('sdbmm', context_truth, context)
+
+def test_main():
+    for is_causal in [True, False]:
+        test_config(
+            IS_CAUSAL=is_causal,
+            N=2, H=4, T=512, T_DST=512, T_M=32, K=8, HID=64,
+        )
+        test_config(
+            IS_CAUSAL=is_causal,
+            N=1, H=2, T=300, T_DST=300, T_M=16, K=2, HID=32,
+        )
+
+if __name__ == '__main__':
+    test_main()
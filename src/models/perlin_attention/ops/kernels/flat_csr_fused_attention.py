@@ -0,0 +1,267 @@
+"""
+Fused flat CSR attention.
+
+Computes masked_bmm -> softmax -> elmul(row scaler) -> sdbmm in single pass per row block,
+using online softmax over blocks of entries. Score and probability values are never
+materialized for whole N x Z, only for one block of entries at a time.
+
+PERLIN_FUSED_ATTENTION: 'auto' (default, fused when triton kernels are not used), '1' (always fused), '0' (unfused chain, for debugging)
+PERLIN_CPU_BLOCK_Z: number of entries processed per online softmax step (default: 8192)
+"""
+
+import os
+import torch
+from .flat_csr_cpu import parallel_for, partition_rows, mask_row_entries, is_sparse_mask, acc_dtype
+
+FUSED_ATTENTION = os.environ.get('PERLIN_FUSED_ATTENTION', 'auto')
+CPU_BLOCK_Z = int(os.environ.get('PERLIN_CPU_BLOCK_Z', '8192'))
+
+def use_fused_attention(t: torch.Tensor):
+    if FUSED_ATTENTION == 'auto':
+        from ..dispatch import use_triton
+        return not use_triton(t)
+    return FUSED_ATTENTION == '1'
+
+def flat_csr_fused_attention(
+    q: torch.Tensor,
+    k: torch.Tensor,
+    v: torch.Tensor,
+    mask: torch.Tensor,
+    row_scaler: torch.Tensor = None,
+    T_M: int = None,
+    fused: bool = None,
+):
+    """
+    q: N, H, T_DST, HID
+    k, v: N, H, T_SRC, HID
+    mask: flat csr or block run mask (N, T_DST, H*T_SRC), values are ignored
+    row_scaler: N, H, T_DST (already activated)
+    return: N, H, T_DST, HID (dtype of v, accumulated in acc_dtype)
+    """
+    assert is_sparse_mask(mask)
+    N, H, T_DST, HID = q.shape
+    _, _, T_SRC, _ = k.shape
+    assert k.shape[:2] == (N, H)
+    assert v.shape[:3] == k.shape[:3]
+    assert mask.shape == (N, T_DST, H*T_SRC)
+
+    if fused is None:
+        fused = use_fused_attention(q)
+    if not fused:
+        return flat_csr_unfused_attention(q, k, v, mask, row_scaler, T_M)
+
+    V_HID = v.shape[-1]
+    dtype = acc_dtype(q, k, v)
+    output = torch.zeros((N, H, T_DST, V_HID), dtype=v.dtype, device=q.device)
+
+    q_flat = q.reshape(N, H*T_DST, HID)
+    k_flat = k.reshape(N, H*T_SRC, HID)
+    v_flat = v.reshape(N, H*T_SRC, V_HID)
+
+    def job(n, r0, r1):
+        e0, e1, rows, cols = mask_row_entries(mask, n, r0, r1)
+        if e1 <= e0:
+            return
+        G = (r1 - r0) * H
+        row_max = torch.full((G,), -float('inf'), dtype=dtype, device=q.device)
+        row_sum = torch.zeros((G,), dtype=dtype, device=q.device)
+        acc = torch.zeros((G, V_HID), dtype=dtype, device=q.device)
+        for z0 in range(0, e1 - e0, CPU_BLOCK_Z):
+            z1 = min(e1 - e0, z0 + CPU_BLOCK_Z)
+            _rows = rows[z0:z1]
+            _cols = cols[z0:z1]
+            heads = _cols // T_SRC
+            group = (_rows - r0) * H + heads
+
+            scores = (
+                q_flat[n].index_select(0, heads * T_DST + _rows).to(dtype) *\
+                k_flat[n].index_select(0, _cols).to(dtype)
+            ).sum(-1)
+
+            block_max = torch.full((G,), -float('inf'), dtype=dtype, device=q.device)\
+                .scatter_reduce(0, group, scores, reduce='amax', include_self=True)
+            new_max = torch.maximum(row_max, block_max)
+            # groups which are still empty keep -inf, avoid inf - inf
+            safe_max = torch.where(torch.isinf(new_max), torch.zeros_like(new_max), new_max)
+            correction = torch.exp(row_max - safe_max)
+
+            probs = torch.exp(scores - safe_max[group])
+            row_sum = row_sum * correction
+            row_sum.index_add_(0, group, probs)
+            acc = acc * correction[:, None]
+            acc.index_add_(0, group, v_flat[n].index_select(0, _cols).to(dtype) * probs[:, None])
+            row_max = new_max
+
+        acc = acc / torch.where(row_sum > 0, row_sum, torch.ones_like(row_sum))[:, None]
+        acc = acc.view(r1 - r0, H, V_HID).transpose(0, 1)
+        if row_scaler is not None:
+            acc = acc * row_scaler[n, :, r0:r1, None].to(dtype)
+        output[n, :, r0:r1] = acc.to(output.dtype)
+
+    parallel_for(job, partition_rows(mask, N, T_DST))
+
+    return output
+
+def flat_csr_unfused_attention(
+    q: torch.Tensor,
+    k: torch.Tensor,
+    v: torch.Tensor,
+    mask: torch.Tensor,
+    row_scaler: torch.Tensor = None,
+    T_M: int = None,
+):
+    from ..dispatch import (
+        flat_csr_masked_bmm,
+        flat_csr_softmax,
+        flat_csr_elmul,
+        flat_csr_sdbmm,
+    )
+
+    N, H, T_DST, _ = q.shape
+    T_SRC = k.shape[2]
+    scores = flat_csr_masked_bmm(q, k, mask)
+    probs = flat_csr_softmax(scores, H, T_SRC)
+    if row_scaler is not None:
+        probs = flat_csr_elmul(probs, row_scaler.view(N, H, T_DST, 1).expand(N, H, T_DST, T_SRC))
+    return flat_csr_sdbmm(probs, v, T_M)
+
+def naive_flat_csr_fused_attention(q, k, v, mask, row_scaler=None):
+    # mask: N, H, T_DST, T_SRC (dense 0/1)
+    scores = torch.matmul(q, k.transpose(-1, -2))
+    scores = scores.masked_fill(mask == 0, -float('inf'))
+    probs = torch.softmax(scores, dim=-1)
+    probs = probs.masked_fill(mask == 0, 0)
+    if row_scaler is not None:
+        probs = probs * row_scaler.unsqueeze(-1)
+    return torch.matmul(probs, v)
+
+def test_config(IS_CAUSAL, N, H, T, T_DST, T_M, K, HID, run_benchmark=True):
+    from .....utils import seed
+    from .....utils.bench import bench
+    from .causal_topk_masking import causal_topk_masking
+    from .flat_csr_to_dense import flat_csr_to_dense
+    from ..dispatch import resize_from_m_to_t_csr
+
+    seed()
+
+    FP_MIN = torch.finfo(torch.float16).min * 0.5
+    device = 'cpu'
+
+    estimated_scores = torch.randn((N, H, T_DST, T_M), device=device)
+    estimated_probs = torch.softmax(estimated_scores, dim=-1)
+    causal_attention_mask = ((torch.arange(T, device=device).view(1, T) > torch.arange(T, device=device).view(T, 1)) * FP_MIN).view(1, 1, T, T)
+    causal_attention_mask = causal_attention_mask[:, :, -T_DST:, :]
+    attention_mask = causal_attention_mask[:,:,-1:,:]
+    dst_attention_mask = causal_attention_mask[:,:,:,:1]
+
+    compressed_mask = causal_topk_masking(
+        estimated_probs,
+        k=K,
+        attention_mask=attention_mask,
+        dst_attention_mask=dst_attention_mask,
+        causal_attention_mask=causal_attention_mask,
+        is_causal=IS_CAUSAL,
+    )
+    csr_mask = resize_from_m_to_t_csr(
+        compressed_mask, 0, K,
+        target_width=T,
+        is_causal=IS_CAUSAL,
+    )
+
+    query_layer = torch.randn((N, H, T_DST, HID), device=device)
+    key_layer = torch.randn((N, H, T, HID), device=device)
+    value_layer = torch.randn((N, H, T, HID), device=device)
+    row_scaler = torch.sigmoid(torch.randn((N, H, T_DST), device=device))
+
+    def bench_fused():
+        with torch.no_grad():
+            return flat_csr_fused_attention(query_layer, key_layer, value_layer, csr_mask, row_scaler, T_M, fused=True)
+
+    def bench_unfused():
+        with torch.no_grad():
+            return flat_csr_fused_attention(query_layer, key_layer, value_layer, csr_mask, row_scaler, T_M, fused=False)
+
+    fused = bench_fused()
+    unfused = bench_unfused()
+    assert fused.dtype == value_layer.dtype
+    fused64 = flat_csr_fused_attention(query_layer.double(), key_layer.double(), value_layer.double(), csr_mask, row_scaler, T_M, fused=True)
+    assert fused64.dtype == torch.float64
+    assert (fused64 - fused).abs().max().item() < 1e-4
+    max_error = (fused - unfused).abs().max().item()
+    print('fused vs unfused', max_error)
+    assert max_error < 1e-4
+
+    if T <= 4096:
+        dense_mask = flat_csr_to_dense(csr_mask, T, H)
+        truth = naive_flat_csr_fused_attention(query_layer, key_layer, value_layer, dense_mask, row_scaler)
+        # fully masked rows produce nan in naive softmax
+        truth = torch.nan_to_num(truth, 0.0)
+        max_error = (fused - truth).abs().max().item()
+        print('fused vs naive', max_error)
+        assert max_error < 1e-4
+
+    if run_benchmark:
+        bench('fused_attention', bench_fused, 0.5, 3, 'ms')
+        bench('unfused_attention', bench_unfused, 0.5, 3, 'ms')
+
+def test_scaling(N=1, H=12, T=16384, T_M=128, K=64, HID=64, max_threads=64):
+    """
+    thread scaling of fused attention, row count partition vs nnz balanced partition
+    """
+    import os
+    from .....utils import seed
+    from .....utils.bench import bench
+    from .causal_topk_masking import causal_topk_masking
+    from . import flat_csr_cpu
+
+    seed()
+
+    # NOTE: dense T x T causal mask does not fit in memory at large T, pass visible token counts instead
+    compressed_mask = causal_topk_masking(
+        torch.softmax(torch.randn((N, H, T, T_M)), dim=-1),
+        k=K,
+        attention_mask=torch.zeros((1, 1, 1, T)),
+        dst_attention_mask=torch.zeros((1, 1, T, 1)),
+        causal_attention_mask=None,
+        causal_token_length=torch.arange(1, T + 1),
+    )
+    mask = flat_csr_cpu.resize_from_m_to_t_csr_cpu(compressed_mask, 0, K, target_width=T)
+    query_layer = torch.randn((N, H, T, HID))
+    key_layer = torch.randn((N, H, T, HID))
+    value_layer = torch.randn((N, H, T, HID))
+
+    # NOTE: one intra-op thread per worker, otherwise workers oversubscribe cores
+    torch_num_threads = torch.get_num_threads()
+    partition = flat_csr_cpu.CPU_PARTITION
+    num_threads = flat_csr_cpu.CPU_NUM_THREADS
+    torch.set_num_threads(1)
+    try:
+        num_cores = min(max_threads, os.cpu_count() or 1)
+        threads = [t for t in [1, 2, 4, 8, 16, 32, 64] if t <= num_cores]
+        for partition_mode in ['rows', 'nnz']:
+            flat_csr_cpu.CPU_PARTITION = partition_mode
+            baseline = None
+            for t in threads:
+                flat_csr_cpu.set_cpu_threads(t)
+                interval, _ = bench(
+                    f'fused_attention ({partition_mode}, {t} threads)',
+                    lambda: flat_csr_fused_attention(query_layer, key_layer, value_layer, mask, fused=True),
+                    0.5, 3
+                )
+                if baseline is None:
+                    baseline = interval
+                print(f'speedup x{baseline / max(interval, 1e-12):.2f}')
+    finally:
+        torch.set_num_threads(torch_num_threads)
+        flat_csr_cpu.CPU_PARTITION = partition
+        flat_csr_cpu.set_cpu_threads(num_threads)
+
+def test_main():
+    for is_causal in [True, False]:
+        test_config(is_causal, 1, 2, 300, 300, 16, 2, 32, run_benchmark=False)
+        test_config(is_causal, 2, 4, 1024, 1024, 64, 16, 64, run_benchmark=False)
+    test_config(True, 1, 12, 4096, 4096, 128, 64, 64)
+    test_scaling()
+
+if __name__ == '__main__':
+    test_main()
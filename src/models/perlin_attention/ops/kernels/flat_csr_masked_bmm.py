@@ -135,7 +135,8 @@ def __flat_csr_masked_bmm_compute(
     # )
 
 def flat_csr_masked_bmm(a: torch.Tensor, b: torch.Tensor, mask: torch.Tensor, max_z_per_row: int=None):
-    assert mask.is_sparse_csr
+    is_binary = not isinstance(mask, torch.Tensor)
+    assert is_binary or mask.is_sparse_csr
     
     assert a.ndim == b.ndim
     assert a.ndim == 4
@@ -145,8 +146,13 @@ def flat_csr_masked_bmm(a: torch.Tensor, b: torch.Tensor, mask: torch.Tensor, ma
     assert mask.shape == (N, T_DST, H*T_SRC)
     
     crow_indices = mask.crow_indices()
-    col_indices = mask.col_indices()
-    out_values = mask.values().clone()
+    if is_binary:
+        # BinaryCSRMask, values are implicit ones
+        col_indices = mask.col_indices
+        out_values = torch.zeros(col_indices.shape, dtype=mask.dtype, device=col_indices.device)
+    else:
+        col_indices = mask.col_indices()
+        out_values = mask.values().clone()
     
     assert crow_indices.shape[0] == N
     _, R_1 = crow_indices.shape
@@ -160,7 +166,7 @@ def flat_csr_masked_bmm(a: torch.Tensor, b: torch.Tensor, mask: torch.Tensor, ma
     # )
     
     if max_z_per_row is None:
-        max_z_per_row = mask.crow_indices()
+        max_z_per_row = crow_indices
         max_z_per_row = (max_z_per_row[:,1:] - max_z_per_row[:,:-1]).max().item()
     
     #TODO improve following heuristics
@@ -187,6 +193,9 @@ def flat_csr_masked_bmm(a: torch.Tensor, b: torch.Tensor, mask: torch.Tensor, ma
         num_warps=n_warps,
     )
     
+    if is_binary:
+        return mask.with_values(out_values)
+    
     return torch.sparse_csr_tensor(
         crow_indices=crow_indices,
         col_indices=col_indices,
@@ -1,7 +1,106 @@
 import torch
 
-def flat_csr_to_dense(csr: torch.Tensor, T_SRC, H):
+def __row_range(rows, T_DST):
+    if rows is None:
+        return 0, T_DST
+    if isinstance(rows, int):
+        rows = slice(rows, rows + 1)
+    assert rows.step is None or rows.step == 1
+    r0, r1, _ = rows.indices(T_DST)
+    return r0, max(r0, r1)
+
+def __head_map(heads, H, device):
+    if heads is None:
+        heads = torch.arange(H, device=device)
+    elif isinstance(heads, int):
+        heads = torch.tensor([heads], device=device)
+    elif isinstance(heads, slice):
+        heads = torch.arange(H, device=device)[heads]
+    else:
+        heads = torch.as_tensor(heads, device=device).view(-1)
+    head_map = torch.full((H,), -1, dtype=torch.long, device=device)
+    head_map[heads.long()] = torch.arange(heads.shape[0], device=device)
+    return head_map, heads.shape[0]
+
+def flat_csr_to_dense(csr: torch.Tensor, T_SRC, H, rows=None, heads=None):
+    """
+    csr: flat csr tensor, or other mask format (BinaryCSRMask, BlockRunMask)
+    rows: slice of destination rows to densify (default: all)
+    heads: int, slice or list of heads to densify (default: all)
+    return: N, len(heads), len(rows), T_SRC
+    """
     # flatten CSR allows different number of element per batch
+    N, T_DST, H_T = csr.shape
+    assert H_T == H * T_SRC
+    r0, r1 = __row_range(rows, T_DST)
+
+    if isinstance(csr, torch.Tensor):
+        assert csr.is_sparse_csr
+        crow_indices = csr.crow_indices()
+        col_indices = csr.col_indices()
+        values = csr.values()
+    elif hasattr(csr, 'col_indices') and not callable(csr.col_indices):
+        # BinaryCSRMask
+        crow_indices = csr.crow_indices()
+        col_indices = csr.col_indices
+        values = None
+    else:
+        # BlockRunMask, densify each batch from row entries
+        return __flat_csr_to_dense_by_rows(csr, T_SRC, H, r0, r1, heads)
+
+    device = col_indices.device
+    dtype = values.dtype if values is not None else csr.dtype
+    head_map, HH = __head_map(heads, H, device)
+    dense = torch.zeros((N, HH, r1 - r0, T_SRC), dtype=dtype, device=device)
+    if r1 <= r0 or col_indices.shape[-1] == 0:
+        return dense
+
+    crow_indices = crow_indices.long()
+    # only touch entries of selected rows. entries after crow_indices[:, -1] are padding.
+    z0 = int(crow_indices[:, r0].min())
+    z1 = int(crow_indices[:, r1].max())
+    entries = torch.arange(z0, z1, device=device).view(1, -1).expand(N, -1).contiguous()
+    entry_rows = torch.searchsorted(crow_indices[:, 1:].contiguous(), entries, right=True)
+    valid = (entries >= crow_indices[:, r0:r0+1]) & (entries < crow_indices[:, r1:r1+1])
+
+    cols = col_indices[:, z0:z1].long()
+    entry_heads = head_map[(cols // T_SRC).clamp(0, H - 1)]
+    valid = valid & (entry_heads >= 0) & (cols >= 0)
+
+    idx_n, idx_z = valid.nonzero(as_tuple=True)
+    if values is None:
+        v = torch.ones(idx_n.shape, dtype=dtype, device=device)
+    else:
+        v = values[:, z0:z1][idx_n, idx_z]
+    dense[
+        idx_n,
+        entry_heads[idx_n, idx_z],
+        entry_rows[idx_n, idx_z] - r0,
+        cols[idx_n, idx_z] % T_SRC,
+    ] = v
+    return dense
+
+def __flat_csr_to_dense_by_rows(mask, T_SRC, H, r0, r1, heads):
+    from .flat_csr_cpu import mask_row_entries, mask_values
+
+    N = mask.shape[0]
+    values = mask_values(mask)
+    head_map, HH = __head_map(heads, H, values.device)
+    dense = torch.zeros((N, HH, r1 - r0, T_SRC), dtype=values.dtype, device=values.device)
+    if r1 <= r0:
+        return dense
+    for n in range(N):
+        e0, e1, rows, cols = mask_row_entries(mask, n, r0, r1)
+        entry_heads = head_map[cols // T_SRC]
+        keep = entry_heads >= 0
+        dense[n, entry_heads[keep], rows[keep] - r0, cols[keep] % T_SRC] = values[n, e0:e1][keep]
+    return dense
+
+def naive_flat_csr_to_dense(csr: torch.Tensor, T_SRC, H):
+    # NOTE: previous per-batch conversion, kept as reference
+    # flatten CSR allows different number of element per batch
+    if hasattr(csr, 'to_flat_csr'):
+        csr = csr.to_flat_csr()
     assert csr.is_sparse_csr
     N, T_DST, H_T = csr.shape
     crow_indices = csr.crow_indices()
@@ -17,13 +116,11 @@ def flat_csr_to_dense(csr: torch.Tensor, T_SRC, H):
                 n_trim += 1
             else:
                 break
-        # print(n_trim)
         v = values[i:i+1]
         if n_trim > 0:
             col = col[:, :-n_trim]
             v = v[:, :-n_trim]
         assert col.shape == v.shape
-        # print(crow.shape, col.shape, v.shape, csr.shape)
         if col.shape[-1] == 0:
             t_d = torch.zeros((1, H, T_DST, T_SRC), dtype=v.dtype, device=v.device)
         else:
@@ -33,4 +130,53 @@ def flat_csr_to_dense(csr: torch.Tensor, T_SRC, H):
             t_d = mini_csr.to_dense()
             t_d = t_d.view(1, T_DST, H, T_SRC).transpose(1, 2).contiguous()
         denses.append(t_d)
-    return torch.cat(denses, dim=0)
\ No newline at end of file
+    return torch.cat(denses, dim=0)
+
+def test_main():
+    from .....utils import seed
+    from .....utils.bench import bench
+    from .causal_topk_masking import causal_topk_masking
+    from .flat_csr_cpu import resize_from_m_to_t_csr_cpu
+
+    seed()
+
+    N, H, T, T_M, K = 2, 4, 2048, 64, 8
+    FP_MIN = torch.finfo(torch.float16).min * 0.5
+    device = 'cpu'
+
+    estimated_probs = torch.softmax(torch.randn((N, H, T, T_M), device=device), dim=-1)
+    causal_attention_mask = ((torch.arange(T, device=device).view(1, T) > torch.arange(T, device=device).view(T, 1)) * FP_MIN).view(1, 1, T, T)
+    compressed_mask = causal_topk_masking(
+        estimated_probs,
+        k=K,
+        attention_mask=causal_attention_mask[:,:,-1:,:],
+        dst_attention_mask=causal_attention_mask[:,:,:,:1],
+        causal_attention_mask=causal_attention_mask,
+    )
+    csr_mask = resize_from_m_to_t_csr_cpu(compressed_mask, 0, K, target_width=T)
+    csr_mask = torch.sparse_csr_tensor(
+        csr_mask.crow_indices(), csr_mask.col_indices(),
+        torch.rand(csr_mask.values().shape), size=csr_mask.shape
+    )
+
+    truth = naive_flat_csr_to_dense(csr_mask, T, H)
+    dense = flat_csr_to_dense(csr_mask, T, H)
+    assert torch.equal(truth, dense)
+
+    tile = flat_csr_to_dense(csr_mask, T, H, rows=slice(1000, 1256), heads=[1, 3])
+    assert torch.equal(tile, truth[:, [1, 3], 1000:1256])
+    tile = flat_csr_to_dense(csr_mask, T, H, rows=7, heads=2)
+    assert torch.equal(tile, truth[:, 2:3, 7:8])
+
+    binary_mask = resize_from_m_to_t_csr_cpu(compressed_mask, 0, K, target_width=T, binary=True)
+    assert torch.equal(
+        flat_csr_to_dense(binary_mask, T, H, rows=slice(100, 200)),
+        (truth[:, :, 100:200] != 0).to(truth.dtype)
+    )
+
+    bench('naive_to_dense', lambda: naive_flat_csr_to_dense(csr_mask, T, H), 0.5, 3)
+    bench('to_dense', lambda: flat_csr_to_dense(csr_mask, T, H), 0.5, 3)
+    bench('to_dense_tile', lambda: flat_csr_to_dense(csr_mask, T, H, rows=slice(1024, 1280), heads=0), 0.5, 3)
+
+if __name__ == '__main__':
+    test_main()
@@ -72,7 +72,49 @@ def resize_from_m_to_t(
     
     return output
 
+def token_index_m(attention_mask: torch.Tensor, T_M: int):
+    """
+    index of compressed column (T_M) of each token, same with non causal `resize_from_m_to_t` without training noise.
+    attention_mask: N, 1, 1, T. returns N, T in [0, T_M], masked tokens are T_M
+    """
+    N = attention_mask.shape[0]
+    T = attention_mask.shape[-1]
+    assert attention_mask.shape == (N, 1, 1, T)
+    mask = (attention_mask.view(N, T) > -1).float()
+    mask_cs = mask.cumsum(-1)
+    token_length = mask_cs[:, -1:]
+    token_index_x = torch.floor(((mask_cs - 1) + 0.5) / token_length * T_M - 1e-4).to(torch.long) + ((1 - mask) * T_M).to(torch.long)
+    return torch.clamp(token_index_x, 0, T_M)
+
+def bucket_sum_m(x: torch.Tensor, token_index: torch.Tensor, T_M: int):
+    """
+    sums of tokens of x (N, H, T, D) in each compressed column of token_index (N, T).
+    returns N, H, T_M, D in float32, masked tokens are dropped.
+    `(resize_from_m_to_t(p, 0, T) * x.transpose(-1, -2)).sum(-1)` equals to `p @ bucket_sum_m(x)` for p (N, H, 1, T_M)
+    """
+    N, H, T, D = x.shape
+    assert token_index.shape == (N, T)
+    output = torch.zeros((N, H, T_M + 1, D), dtype=torch.float32, device=x.device)
+    output.scatter_add_(2, token_index.view(N, 1, T, 1).expand(N, H, T, D), x.float())
+    return output[:, :, :T_M]
+
+def test_bucket_sum(N=3, H=4, T=100, T_M=16, D=8):
+    x = torch.randn((N, H, T, D))
+    p = torch.rand((N, H, 1, T_M))
+    attention_mask = torch.zeros((N, 1, 1, T))
+    attention_mask[1, :, :, 70:] = -10000
+    attention_mask[2, :, :, 5:] = -10000
+    truth = (
+        x * (attention_mask.transpose(-1, -2) > -1) * 
+        resize_from_m_to_t(p, 0, attention_mask, target_width=T, is_causal=False, k=7, oversampled=1.0).transpose(-1, -2)
+    ).sum(-2, keepdim=True)
+    output = torch.matmul(p, bucket_sum_m(x, token_index_m(attention_mask, T_M), T_M))
+    assert torch.allclose(output, truth, atol=1e-5), (output - truth).abs().max()
+    print('bucket sum passed')
+
 def test_main():
+    test_bucket_sum()
+    
     N = 4
     H = 12
     MIN_T_SRC = 16
@@ -0,0 +1,221 @@
+"""
+Sort-free per-row top-k selection.
+
+Mask builders only consume membership of top-k (rank < per_item_top_k), so order of
+selected items is not needed. Per-row k-th largest value is found with radix select
+(four 8-bit digit histogram passes over order preserving integer keys of float32), and
+items greater than threshold, plus first ties of threshold in index order, are selected.
+
+Result is same with topk + rank scatter whenever threshold value is unique in row. On ties,
+lower index is selected (torch.topk does not specify which of ties is returned).
+
+PERLIN_TOPK_SELECT: 'auto' (default, threshold on cpu tensors), 'threshold', 'topk'
+"""
+
+import os
+import math
+import torch
+from .flat_csr_cpu import parallel_for, CPU_BLOCK_ROW
+
+TOPK_SELECT = os.environ.get('PERLIN_TOPK_SELECT', 'auto')
+
+def use_threshold_select(t: torch.Tensor):
+    if TOPK_SELECT == 'auto':
+        return t.device.type == 'cpu'
+    return TOPK_SELECT == 'threshold'
+
+def ordered_keys(x: torch.Tensor):
+    """
+    maps float32 to int64 keys in [0, 2**32), with same order. -0.0 and 0.0 are same key.
+    """
+    x = x.float() + 0.0
+    bits = x.view(torch.int32).long()
+    return torch.where(bits >= 0, bits + 2**31, -1 - bits)
+
+def radix_threshold(keys: torch.Tensor, k: torch.Tensor):
+    """
+    keys: R, W from ordered_keys
+    k: R, 1 <= k <= W
+    returns (threshold, remaining), (R, 1). k-th largest key of each row,
+    and number of items equal to threshold which are in top-k.
+    """
+    R = keys.shape[0]
+    prefix = torch.zeros((R, 1), dtype=torch.long, device=keys.device)
+    remaining = k.view(R, 1).long()
+    for shift in (24, 16, 8, 0):
+        candidate = (keys >> (shift + 8)) == prefix
+        digit = (keys >> shift) & 255
+        hist = torch.zeros((R, 256), dtype=torch.long, device=keys.device)\
+            .scatter_add_(1, digit, candidate.long())
+        # number of candidates which have digit >= b
+        above = hist.flip(-1).cumsum(-1).flip(-1)
+        b = ((above >= remaining).long().sum(-1, keepdim=True) - 1).clamp_min(0)
+        remaining = remaining - (above.gather(1, b) - hist.gather(1, b))
+        prefix = (prefix << 8) | b
+    return prefix, remaining
+
+def per_row_k(t: torch.Tensor, per_item_top_k):
+    W = t.shape[-1]
+    R = t.numel() // max(W, 1)
+    if isinstance(per_item_top_k, torch.Tensor):
+        k = torch.ceil(per_item_top_k.to(torch.float64)).long()
+        k = k.expand(t.shape[:-1] + (1,)).reshape(R)
+    else:
+        k = torch.full((R,), int(math.ceil(per_item_top_k)), dtype=torch.long, device=t.device)
+    return k.to(t.device).clamp(0, W)
+
+def threshold_select(rows: torch.Tensor, k: torch.Tensor):
+    """
+    rows: R, W. k: R. returns R, W bool of top-k membership
+    """
+    keys = ordered_keys(rows)
+    threshold, remaining = radix_threshold(keys, k.clamp_min(1))
+    equal = keys == threshold
+    selected = (keys > threshold) | (equal & (equal.cumsum(-1) <= remaining))
+    return selected & (k > 0).view(-1, 1)
+
+def row_blocks_of(t: torch.Tensor, R: int, W: int):
+    block_row = max(1, CPU_BLOCK_ROW * 4096 // W) if t.device.type == 'cpu' else R
+    return [(r0, min(R, r0 + block_row)) for r0 in range(0, R, block_row)]
+
+def topk_threshold_mask(t: torch.Tensor, per_item_top_k):
+    """
+    t: ..., W
+    per_item_top_k: tensor broadcastable to (..., 1), or number. rank < per_item_top_k is selected.
+    return: bool tensor of t.shape
+    """
+    W = t.shape[-1]
+    R = t.numel() // max(W, 1)
+    rows_t = t.reshape(R, W)
+    k = per_row_k(t, per_item_top_k)
+
+    alive = torch.empty((R, W), dtype=torch.bool, device=t.device)
+    if R == 0 or W == 0:
+        return alive.view(t.shape)
+
+    def job(r0, r1):
+        alive[r0:r1] = threshold_select(rows_t[r0:r1], k[r0:r1])
+
+    parallel_for(job, row_blocks_of(t, R, W))
+    return alive.view(t.shape)
+
+def topk_threshold_indices(t: torch.Tensor, per_item_top_k, top_k_elems: int, row_alive: torch.Tensor = None):
+    """
+    indices of `topk_threshold_mask` in ascending order. membership is compacted per block of rows,
+    so bool mask and cumsum of t.shape are never built.
+    t: ..., W
+    row_alive: bool broadcastable to t.shape[:-1]. dead rows select nothing
+    return: ..., top_k_elems long, padded with W
+    """
+    W = t.shape[-1]
+    R = t.numel() // max(W, 1)
+    rows_t = t.reshape(R, W)
+    k = per_row_k(t, per_item_top_k).clamp_max(top_k_elems)
+    if row_alive is not None:
+        k = k * row_alive.expand(t.shape[:-1]).reshape(R).to(k.device)
+
+    indices = torch.full((R, top_k_elems), W, dtype=torch.long, device=t.device)
+    if R == 0 or W == 0 or top_k_elems == 0:
+        return indices.view(t.shape[:-1] + (top_k_elems,))
+
+    def job(r0, r1):
+        indices[r0:r1] = alive_indices(threshold_select(rows_t[r0:r1], k[r0:r1]), top_k_elems)
+
+    parallel_for(job, row_blocks_of(t, R, W))
+    return indices.view(t.shape[:-1] + (top_k_elems,))
+
+def topk_rank_mask(t: torch.Tensor, per_item_top_k, top_k_elems: int = None):
+    """
+    topk + rank scatter version of topk_threshold_mask
+    """
+    W = t.shape[-1]
+    if top_k_elems is None:
+        top_k_elems = min(int(math.ceil(torch.max(torch.as_tensor(per_item_top_k)).item())), W)
+    _, indices = torch.topk(
+        input=t,
+        k=top_k_elems,
+        dim=-1,
+        sorted=True #sorted true is important
+    )
+    ranks = torch.full(t.shape, W, dtype=torch.long, device=t.device)
+    ranks.scatter_(
+        dim=-1,
+        index=indices,
+        src=torch.arange(top_k_elems, dtype=torch.long, device=t.device)\
+            .view((1,) * (t.ndim - 1) + (-1,))\
+            .expand(indices.shape)
+    )
+    return ranks < per_item_top_k
+
+def topk_alive_mask(t: torch.Tensor, per_item_top_k, top_k_elems: int = None):
+    if use_threshold_select(t):
+        return topk_threshold_mask(t, per_item_top_k)
+    return topk_rank_mask(t, per_item_top_k, top_k_elems)
+
+def alive_indices(alive: torch.Tensor, top_k_elems: int):
+    """
+    compacts indices of selected items in ascending order, without sorting.
+    alive: ..., W bool, at most top_k_elems items per row
+    return: ..., top_k_elems long, padded with W
+    """
+    W = alive.shape[-1]
+    pos = alive.long().cumsum(-1) - 1
+    pos.masked_fill_(~alive, top_k_elems)
+    indices = torch.full(alive.shape[:-1] + (top_k_elems + 1,), W, dtype=torch.long, device=alive.device)
+    indices.scatter_(
+        -1,
+        pos,
+        torch.arange(W, device=alive.device).view((1,) * (alive.ndim - 1) + (W,)).expand(alive.shape)
+    )
+    # last column collects dead items
+    return indices[..., :top_k_elems]
+
+def test_config(N, T, HT_M, K, run_benchmark=False):
+    from .....utils import seed
+    from .....utils.bench import bench
+
+    seed()
+
+    t = torch.softmax(torch.randn((N, T, HT_M)), dim=-1)
+    causal_token_length = torch.arange(1, T+1).view(1, T, 1)
+    per_item_top_k = torch.clamp_min(torch.round(K * HT_M / causal_token_length), 1)
+    top_k_elems = min(int(math.ceil(torch.max(per_item_top_k).item())), HT_M)
+
+    truth = topk_rank_mask(t, per_item_top_k, top_k_elems)
+    alive = topk_threshold_mask(t, per_item_top_k)
+    assert torch.equal(truth, alive)
+    assert torch.equal(alive.sum(-1), per_item_top_k.clamp_max(HT_M).long().expand(N, T, 1).squeeze(-1))
+
+    indices = alive_indices(alive, top_k_elems)
+    assert torch.equal(topk_threshold_indices(t, per_item_top_k, top_k_elems), indices)
+    valid = indices < HT_M
+    assert torch.equal(valid.sum(-1), alive.sum(-1))
+    assert torch.equal(alive.gather(-1, indices.clamp_max(HT_M - 1)) & valid, valid)
+    assert ((indices[..., 1:] > indices[..., :-1]) | ~valid[..., 1:]).all()
+
+    if run_benchmark:
+        bench(f'topk_scatter (T={T}, W={HT_M})', lambda: topk_rank_mask(t, per_item_top_k, top_k_elems), 0.5, 3)
+        bench(f'threshold_select (T={T}, W={HT_M})', lambda: topk_threshold_mask(t, per_item_top_k), 0.5, 3)
+
+def test_ties():
+    t = torch.zeros((3, 8))
+    t[0, 5] = 1.0
+    t[1] = -0.0
+    t[2, 2] = -1.0
+    alive = topk_threshold_mask(t, torch.tensor([[3], [2], [8]]))
+    assert alive[0].tolist() == [True, True, False, False, False, True, False, False]
+    assert alive[1].tolist() == [True, True] + [False] * 6
+    assert alive[2].all()
+    assert not topk_threshold_mask(t, 0).any()
+    t = torch.tensor([[-float('inf'), 3.0, -2.0, 1e-30, -1e-30, float('inf')]])
+    assert topk_threshold_mask(t, 4).tolist() == [[False, True, False, True, True, True]]
+
+def test_main():
+    test_ties()
+    test_config(2, 300, 64, 4)
+    test_config(1, 1024, 1024, 16)
+    for T, HT_M in [(4096, 1024), (16384, 2048), (65536, 4096)]:
+        test_config(1, T, HT_M, 64, run_benchmark=True)
+
+if __name__ == '__main__':
+    test_main()
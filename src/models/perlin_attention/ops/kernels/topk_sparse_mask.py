@@ -0,0 +1,336 @@
+"""
+Top-k selection which emits interpolated sparse mask directly.
+
+Instead of scattering ranks into dense (N, T_DST, H*T_M) tensor, comparing with per_item_top_k,
+and scanning the dense compressed mask again in `resize_from_m_to_t_csr`, selected pixels are
+taken from top-k indices, sorted into csr order, and turned into runs of target columns.
+With threshold selection (cpu), membership is compacted into ascending indices per block of rows,
+so only block sized temporaries of width H*T_M are built.
+Output is same with `resize_from_m_to_t_csr(alive_mask)`.
+
+`decode_row_sparse_mask` is single query row version for decoding with cache. it does not
+build anything of target width, except the selected columns.
+
+PERLIN_FUSED_TOPK_MASK: 'auto' (default, fused when triton kernels are not used), '1', '0'
+PERLIN_DECODE_ROW_MASK: '1' (default), '0'
+"""
+
+import os
+import math
+import torch
+from .block_run_mask import interpolation_ranges, block_run_mask_from_cells
+from .topk_select import use_threshold_select, topk_threshold_indices
+
+FUSED_TOPK_MASK = os.environ.get('PERLIN_FUSED_TOPK_MASK', 'auto')
+DECODE_ROW_MASK = os.environ.get('PERLIN_DECODE_ROW_MASK', '1') == '1'
+
+def use_fused_topk_mask(t: torch.Tensor):
+    if FUSED_TOPK_MASK == 'auto':
+        from ..dispatch import use_triton
+        return not use_triton(t)
+    return FUSED_TOPK_MASK == '1'
+
+def select_topk_indices(t: torch.Tensor, top_k_elems: int):
+    if top_k_elems < t.shape[-1] * 0.9:
+        _, indices = torch.topk(
+            input=t,
+            k=top_k_elems,
+            dim=-1,
+            sorted=True #sorted true is important
+        )
+    else:
+        _, indices = torch.sort(
+            t,
+            dim=-1,
+            descending=True,
+            stable=False,
+        )
+        indices = indices[...,:top_k_elems]
+    return indices
+
+def topk_sparse_mask(
+    t: torch.Tensor,
+    per_item_top_k: torch.Tensor,
+    H: int,
+    k: int,
+    target_width: int,
+    dst_alive: torch.Tensor = None,
+    is_causal: bool = True,
+    top_k_elems: int = None,
+    mask_format: str = 'flat_csr',
+):
+    """
+    t: N, T_DST, H*T_M. masked estimated attention probs
+    per_item_top_k: broadcastable to N, T_DST, 1
+    dst_alive: N, T_DST bool. dead rows does not select anything
+    k: upper bound of columns per compressed pixel (same with `k` of resize_from_m_to_t_csr)
+    mask_format: 'flat_csr', 'binary', or 'block_run'
+    """
+    N, T_DST, HT_M = t.shape
+    T_M = HT_M // H
+    T_SRC = target_width
+
+    if top_k_elems is None:
+        top_k_elems = min(int(math.ceil(torch.max(per_item_top_k).item())), HT_M)
+    if use_threshold_select(t):
+        # NOTE: threshold selection gives membership only, compacted in ascending order per block of rows
+        pixels = topk_threshold_indices(
+            t, per_item_top_k, top_k_elems,
+            row_alive=dst_alive.view(N, T_DST) if dst_alive is not None else None,
+        )
+    else:
+        indices = select_topk_indices(t, top_k_elems)
+
+        rank = torch.arange(top_k_elems, device=t.device).view(1, 1, top_k_elems)
+        alive = rank < per_item_top_k
+        if dst_alive is not None:
+            alive = alive & dst_alive.view(N, T_DST, 1)
+        alive = alive.expand(N, T_DST, top_k_elems)
+
+        # sort selected pixels into csr order, dead slots go to the end
+        pixels = indices.masked_fill(~alive, HT_M)
+        pixels, _ = torch.sort(pixels, dim=-1)
+
+    valid = pixels < HT_M
+    pixels.clamp_max_(HT_M - 1)
+
+    v_starts, spans = interpolation_ranges(T_DST, T_M, T_SRC, is_causal, t.device)
+    counts = spans[
+        torch.arange(T_DST, device=t.device).view(1, T_DST, 1),
+        pixels % T_M,
+    ].clamp_max(k) * valid
+
+    run_mask = block_run_mask_from_cells(
+        counts, pixels, v_starts, spans, H, T_M, T_SRC, dtype=torch.float32
+    )
+    if mask_format == 'block_run':
+        return run_mask
+    csr = run_mask.to_flat_csr()
+    if mask_format == 'binary':
+        from .binary_csr_mask import BinaryCSRMask
+        return BinaryCSRMask.from_flat_csr(csr)
+    if mask_format == 'flat_csr':
+        return csr
+    raise Exception(mask_format)
+
+def causal_topk_sparse_masking(
+    probs,
+    k,
+    attention_mask,
+    dst_attention_mask,
+    causal_attention_mask,
+    target_width,
+    max_k=None,
+    is_causal=True,
+    mask_format='flat_csr',
+):
+    """
+    same selection with `causal_topk_masking`, then same output with `resize_from_m_to_t_csr(..., max_k)`
+    """
+    N, H, T_DST, T_M = probs.shape
+
+    masked_estimated_attention_probs = (probs * (dst_attention_mask > -1))
+    causal_token_length = (causal_attention_mask > -1).long().sum(-1).view(1, 1, T_DST, 1)
+
+    t = masked_estimated_attention_probs.transpose(1, 2).reshape(N, T_DST, H*T_M)
+    if is_causal:
+        per_item_top_k = torch.clamp((H * torch.floor(k * T_M / causal_token_length.squeeze(0))).view(1, T_DST, 1), 1, H*T_M)
+    else:
+        token_length = (attention_mask > -1).long().sum(-1).view(N, -1)
+        per_item_top_k = (H * torch.round(k * T_M / token_length)).view(N, 1, 1)
+    per_item_top_k = torch.clamp_min(per_item_top_k, 1)
+
+    dst_alive = ~(dst_attention_mask < -1).expand(N, 1, T_DST, 1).reshape(N, T_DST)
+
+    return topk_sparse_mask(
+        t,
+        per_item_top_k,
+        H=H,
+        k=k if max_k is None else max_k,
+        target_width=target_width,
+        dst_alive=dst_alive,
+        is_causal=is_causal,
+        mask_format=mask_format,
+    )
+
+def use_decode_row_mask():
+    return DECODE_ROW_MASK
+
+def decode_row_sparse_mask(
+    probs: torch.Tensor,
+    k: int,
+    target_width: int,
+    k_oversample: float = 1.0,
+    dst_alive: torch.Tensor = None,
+    mask_format: str = 'flat_csr',
+):
+    """
+    probs: N, H, 1, T_M. estimated attention probs of the new query row, which is the last row of
+        causal attention over target_width keys
+    dst_alive: N bool
+    same selection with causal_batch top-k of PerlinAttention, and same columns with `resize_from_m_to_t_csr`.
+    returns mask of (N, 1, H*target_width)
+    """
+    from .flat_csr_cpu import round_half_away
+
+    N, H, T_DST, T_M = probs.shape
+    assert T_DST == 1
+    T_SRC = target_width
+    HT_M = H * T_M
+    device = probs.device
+
+    # NOTE: same float32 arithmetic with per_item_top_k of PerlinAttention, on cpu to avoid sync
+    causal_token_length = torch.full((1,), T_SRC, dtype=torch.long)
+    per_item_top_k = torch.clamp_min(torch.round(H * (k * k_oversample * T_M / causal_token_length)), 1)
+    top_k_elems = min(int(per_item_top_k.item()), HT_M)
+
+    t = probs.transpose(1, 2).reshape(N, HT_M)
+    _, pixels = torch.topk(t, k=top_k_elems, dim=-1, sorted=False)
+    pixels, _ = torch.sort(pixels, dim=-1)
+
+    # column range of each selected pixel, same rounding with scan_col
+    b = pixels % T_M
+    scale = torch.full((1,), T_SRC, dtype=torch.long, device=device) / T_M
+    v_starts = round_half_away(b * scale)
+    v_ends = round_half_away((b + 1) * scale)
+    counts = (v_ends - v_starts).to(torch.int32).clamp_max(k)
+    if dst_alive is not None:
+        counts = counts * dst_alive.view(N, 1)
+
+    if mask_format == 'block_run':
+        v_starts_table, spans_table = interpolation_ranges(1, T_M, T_SRC, True, device)
+        return block_run_mask_from_cells(
+            counts.view(N, 1, top_k_elems), pixels.view(N, 1, top_k_elems),
+            v_starts_table, spans_table, H, T_M, T_SRC, dtype=torch.float32
+        )
+
+    row_nnz = counts.long().sum(-1)
+    crow_indices = torch.zeros((N, 2), dtype=torch.long, device=device)
+    crow_indices[:, 1] = row_nnz
+    Z = max(int(row_nnz.max().item()), 1)
+
+    lengths = counts.view(-1).long()
+    owner = torch.repeat_interleave(torch.arange(N * top_k_elems, device=device), lengths)
+    offsets = lengths.cumsum(0) - lengths
+    entry = torch.arange(owner.numel(), device=device)
+    i = entry - offsets[owner]
+    range_end = (v_ends + (pixels // T_M) * T_SRC).view(-1)
+    step = ((v_ends - v_starts).view(-1) / lengths.clamp_min(1))
+    # NOTE: columns are written from the end of the range, and evenly strided if the range is clamped by k.
+    cols = range_end[owner] - (i * step[owner]).to(torch.int32) - 1
+
+    batch = owner // top_k_elems
+    batch_offsets = row_nnz.cumsum(0) - row_nnz
+    col_indices = torch.zeros((N, Z), dtype=torch.long, device=device)
+    col_indices[batch, entry - batch_offsets[batch]] = cols.long()
+
+    if mask_format == 'binary':
+        from .binary_csr_mask import BinaryCSRMask
+        return BinaryCSRMask.from_indices(crow_indices, col_indices, (N, 1, H*T_SRC), dtype=torch.float32)
+    if mask_format == 'flat_csr':
+        return torch.sparse_csr_tensor(
+            crow_indices=crow_indices,
+            col_indices=col_indices,
+            values=torch.ones_like(col_indices, dtype=torch.float32),
+            size=(N, 1, H*T_SRC),
+        )
+    raise Exception(mask_format)
+
+def test_decode_row(N, H, T, T_M, K, K_OS=1.0):
+    from .....utils import seed
+    from .topk_select import topk_rank_mask
+    from .flat_csr_cpu import resize_from_m_to_t_csr_cpu
+    from .flat_csr_to_dense import flat_csr_to_dense
+
+    seed()
+
+    probs = torch.softmax(torch.randn((N, H, 1, T_M)), dim=-1)
+    dst_alive = torch.ones((N,), dtype=torch.bool)
+    dst_alive[-1] = N == 1
+
+    # same with dense path of PerlinAttention
+    t = probs.transpose(1, 2).reshape(N, 1, H*T_M)
+    causal_token_length = torch.full((1, 1, 1, 1), T, dtype=torch.long)
+    per_item_top_k = torch.clamp_min(torch.round((H * (K * K_OS * T_M / causal_token_length.squeeze(0))).view(1, 1, 1)), 1)
+    alive = topk_rank_mask(t, per_item_top_k) & dst_alive.view(N, 1, 1)
+    alive = alive.view(N, 1, H, T_M).transpose(1, 2).float()
+    truth = resize_from_m_to_t_csr_cpu(alive, 0, K, target_width=T, is_causal=True)
+
+    mask = decode_row_sparse_mask(probs, K, T, K_OS, dst_alive=dst_alive)
+    assert torch.equal(truth.crow_indices(), mask.crow_indices())
+    for n in range(N):
+        z = truth.crow_indices()[n, -1]
+        assert torch.equal(truth.col_indices()[n, :z], mask.col_indices()[n, :z])
+    dense_truth = flat_csr_to_dense(truth, T, H)
+    for mask_format in ['binary', 'block_run']:
+        assert torch.equal(dense_truth, flat_csr_to_dense(decode_row_sparse_mask(probs, K, T, K_OS, dst_alive, mask_format), T, H))
+
+def test_config(IS_CAUSAL, N, H, T, T_DST, T_M, K, run_benchmark=False):
+    from .....utils import seed
+    from .....utils.bench import bench
+    from .causal_topk_masking import causal_topk_masking
+    from .flat_csr_cpu import resize_from_m_to_t_csr_cpu
+    from .flat_csr_to_dense import flat_csr_to_dense
+
+    seed()
+
+    FP_MIN = torch.finfo(torch.float16).min * 0.5
+    device = 'cpu'
+
+    estimated_probs = torch.softmax(torch.randn((N, H, T_DST, T_M), device=device), dim=-1)
+    causal_attention_mask = ((torch.arange(T, device=device).view(1, T) > torch.arange(T, device=device).view(T, 1)) * FP_MIN).view(1, 1, T, T)
+    causal_attention_mask = causal_attention_mask[:, :, -T_DST:, :]
+    attention_mask = causal_attention_mask[:,:,-1:,:]
+    dst_attention_mask = causal_attention_mask[:,:,:,:1]
+
+    def bench_naive():
+        compressed_mask = causal_topk_masking(
+            estimated_probs,
+            k=K,
+            attention_mask=attention_mask,
+            dst_attention_mask=dst_attention_mask,
+            causal_attention_mask=causal_attention_mask,
+            is_causal=IS_CAUSAL,
+        )
+        return resize_from_m_to_t_csr_cpu(compressed_mask, 0, K, target_width=T, is_causal=IS_CAUSAL)
+
+    def bench_fused(mask_format='flat_csr'):
+        return causal_topk_sparse_masking(
+            estimated_probs,
+            k=K,
+            attention_mask=attention_mask,
+            dst_attention_mask=dst_attention_mask,
+            causal_attention_mask=causal_attention_mask,
+            target_width=T,
+            is_causal=IS_CAUSAL,
+            mask_format=mask_format,
+        )
+
+    truth = bench_naive()
+    fused = bench_fused()
+    assert torch.equal(truth.crow_indices(), fused.crow_indices())
+    for n in range(N):
+        z = truth.crow_indices()[n, -1]
+        assert torch.equal(truth.col_indices()[n, :z], fused.col_indices()[n, :z])
+    if T <= 4096:
+        dense_truth = flat_csr_to_dense(truth, T, H)
+        for mask_format in ['binary', 'block_run']:
+            assert torch.equal(dense_truth, flat_csr_to_dense(bench_fused(mask_format), T, H))
+
+    if run_benchmark:
+        bench('topk_scatter_scan', bench_naive, 0.5, 3)
+        bench('topk_sparse_mask', bench_fused, 0.5, 3)
+        bench('topk_sparse_mask (block_run)', lambda: bench_fused('block_run'), 0.5, 3)
+
+def test_main():
+    for T in [1, 7, 64, 300, 1000, 8192]:
+        test_decode_row(1, 4, T, 32, 8)
+        test_decode_row(3, 12, T, 128, 64, K_OS=1.5)
+    for is_causal in [True, False]:
+        test_config(is_causal, 1, 2, 300, 300, 16, 2)
+        test_config(is_causal, 2, 4, 1024, 1024, 32, 8)
+        test_config(is_causal, 1, 4, 4096, 256, 16, 8)
+    test_config(True, 1, 12, 8192, 8192, 128, 64, run_benchmark=True)
+
+if __name__ == '__main__':
+    test_main()
@@ -1 +1,4 @@
-from .perlin_opt import OPTForCausalLM, OPTModel, OPTDecoder, OPTDecoderLayer, OPTAttention, OPTLearnedPositionalEmbedding
\ No newline at end of file
+from .perlin_opt import OPTForCausalLM, OPTModel, OPTDecoder, OPTDecoderLayer, OPTAttention, OPTLearnedPositionalEmbedding
+from .kv_cache import KVCache
+from .prefix_cache import PrefixCache
+from .snapshot import save_snapshot, load_snapshot
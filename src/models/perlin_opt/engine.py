@@ -0,0 +1,362 @@
+"""
+Continuous batching generation engine for perlin_opt.
+
+Engine keeps a pool of running sequences with different lengths. New requests are admitted
+between decode steps: a request is prefilled alone (batch size 1), and then joins the pool.
+Every decode step generates one token for every running sequence with single model call.
+Each sequence owns its past (KVCache and PerlinAttentionState per layer), and the pasts are
+passed to the model as `RaggedLayerPast`, so embeddings, projections of MLP, layer norms and
+lm head run batched, and attention runs per sequence on its own cache and state.
+Finished sequences leave the pool at the end of the step.
+
+Usage: python -m src.models.perlin_opt.engine
+"""
+
+import time
+import math
+import random
+from collections import deque
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+import torch
+
+from .kv_cache import ragged_past_key_values, split_ragged_past_key_values
+
+@dataclass
+class GenerationRequest:
+    input_ids: List[int]
+    max_new_tokens: int
+    request_id: int = 0
+    arrival_time: float = 0.0
+    temperature: float = 0.0
+    top_k: int = 0
+
+    # filled by engine
+    output_ids: List[int] = field(default_factory=list)
+    past_key_values: Optional[tuple] = None
+    admit_time: Optional[float] = None
+    first_token_time: Optional[float] = None
+    finish_time: Optional[float] = None
+
+    @property
+    def length(self):
+        return len(self.input_ids) + len(self.output_ids)
+
+    @property
+    def max_length(self):
+        return len(self.input_ids) + self.max_new_tokens
+
+    @property
+    def finished(self):
+        return self.finish_time is not None
+
+def sample_tokens(logits: torch.Tensor, requests: List[GenerationRequest]):
+    """
+    logits: N, VOCAB
+    greedy if temperature is 0, otherwise samples from top_k (0 is whole vocab)
+    """
+    tokens = torch.argmax(logits, dim=-1)
+    for i, req in enumerate(requests):
+        if req.temperature <= 0:
+            continue
+        row = logits[i].float() / req.temperature
+        if req.top_k > 0:
+            values, indices = torch.topk(row, k=min(req.top_k, row.shape[-1]))
+            tokens[i] = indices[torch.multinomial(torch.softmax(values, dim=-1), 1)[0]]
+        else:
+            tokens[i] = torch.multinomial(torch.softmax(row, dim=-1), 1)[0]
+    return tokens.tolist()
+
+class GenerationEngine:
+    def __init__(
+        self,
+        model,
+        max_batch_size: int = 16,
+        max_kv_tokens: int = None,
+        eos_token_id: int = None,
+        device: torch.device = None,
+        prefix_cache = None,
+    ):
+        """
+        max_batch_size: maximum number of running sequences
+        max_kv_tokens: budget of cached tokens. a request is admitted only when `length + max_new_tokens` of
+            every running sequence and the request fit in the budget, so the pool never runs out of it.
+        prefix_cache: PrefixCache. prompts are prefilled from the longest cached prefix, and blocks of
+            prompts are stored into the cache.
+        """
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_kv_tokens = max_kv_tokens
+        self.eos_token_id = eos_token_id
+        self.device = next(model.parameters()).device if device is None else device
+        self.prefix_cache = prefix_cache
+
+        self.waiting = deque() # type: deque[GenerationRequest]
+        self.running = [] # type: List[GenerationRequest]
+        self.finished = [] # type: List[GenerationRequest]
+        self.num_steps = 0
+
+    def add_request(self, req: GenerationRequest):
+        assert req.max_new_tokens > 0
+        assert len(req.input_ids) > 0
+        if self.max_kv_tokens is not None:
+            assert req.max_length <= self.max_kv_tokens, f'request is longer than kv budget, {req.max_length} > {self.max_kv_tokens}'
+        self.waiting.append(req)
+
+    def cancel(self, request_ids):
+        """
+        drops waiting and running requests of request_ids and releases their caches. returns dropped requests
+        """
+        request_ids = set(request_ids)
+        dropped = [req for req in list(self.waiting) + self.running if req.request_id in request_ids]
+        self.waiting = deque([req for req in self.waiting if req.request_id not in request_ids])
+        self.running = [req for req in self.running if req.request_id not in request_ids]
+        for req in dropped:
+            req.past_key_values = None
+        return dropped
+
+    def reserved_kv_tokens(self):
+        return sum([req.max_length for req in self.running])
+
+    def can_admit(self, req: GenerationRequest):
+        if len(self.running) >= self.max_batch_size:
+            return False
+        if self.max_kv_tokens is not None:
+            return (self.reserved_kv_tokens() + req.max_length) <= self.max_kv_tokens
+        return True
+
+    def has_work(self):
+        return len(self.waiting) > 0 or len(self.running) > 0
+
+    def append_token(self, req: GenerationRequest, token: int, now: float):
+        req.output_ids.append(token)
+        if req.first_token_time is None:
+            req.first_token_time = now
+        if (len(req.output_ids) >= req.max_new_tokens) or\
+            (self.eos_token_id is not None and token == self.eos_token_id):
+            req.finish_time = now
+
+    @torch.no_grad()
+    def prefill(self, req: GenerationRequest):
+        if self.prefix_cache is None:
+            input_ids = torch.tensor([req.input_ids], dtype=torch.long, device=self.device)
+            output = self.model(
+                input_ids=input_ids,
+                use_cache=True,
+            )
+        else:
+            # NOTE: chunks end at block boundaries, to store states of every block
+            start, past_key_values = self.prefix_cache.lookup(req.input_ids)
+            block_size = self.prefix_cache.block_size
+            while start < len(req.input_ids):
+                end = min(len(req.input_ids), (start // block_size + 1) * block_size)
+                output = self.model(
+                    input_ids=torch.tensor([req.input_ids[start:end]], dtype=torch.long, device=self.device),
+                    past_key_values=past_key_values,
+                    use_cache=True,
+                )
+                past_key_values = output.past_key_values
+                self.prefix_cache.insert(req.input_ids[:end], past_key_values)
+                start = end
+        req.past_key_values = output.past_key_values
+        token, = sample_tokens(output.logits[:, -1], [req])
+        self.append_token(req, token, time.time())
+
+    @torch.no_grad()
+    def decode(self, requests: List[GenerationRequest]):
+        input_ids = torch.tensor([[req.output_ids[-1]] for req in requests], dtype=torch.long, device=self.device)
+        output = self.model(
+            input_ids=input_ids,
+            past_key_values=ragged_past_key_values([req.past_key_values for req in requests]),
+            use_cache=True,
+        )
+        tokens = sample_tokens(output.logits[:, -1], requests)
+        now = time.time()
+        for req, past_key_values, token in zip(requests, split_ragged_past_key_values(output.past_key_values), tokens):
+            req.past_key_values = past_key_values
+            self.append_token(req, token, now)
+
+    def retire(self):
+        running = []
+        for req in self.running:
+            if req.finished:
+                # NOTE: release caches as soon as possible
+                req.past_key_values = None
+                self.finished.append(req)
+            else:
+                running.append(req)
+        self.running = running
+
+    def step(self):
+        """
+        admits waiting requests, and then decodes one token for every running sequence.
+        returns requests which finished at this step.
+        """
+        num_finished = len(self.finished)
+
+        while len(self.waiting) > 0 and self.can_admit(self.waiting[0]):
+            req = self.waiting.popleft()
+            req.admit_time = time.time()
+            self.prefill(req)
+            self.running.append(req)
+
+        # NOTE: prefilled requests are decoded at this step too. the first token is from prefill.
+        decoding = [req for req in self.running if not req.finished]
+        if len(decoding) > 0:
+            self.decode(decoding)
+
+        self.retire()
+        self.num_steps += 1
+        return self.finished[num_finished:]
+
+    def run(self, requests: List[GenerationRequest]):
+        """
+        replays trace. `arrival_time` of requests are seconds from start of the run.
+        returns statistics of the run.
+        """
+        trace = deque(sorted(requests, key=lambda req: req.arrival_time))
+        t_start = time.time()
+        for req in trace:
+            req.arrival_time += t_start
+
+        while len(trace) > 0 or self.has_work():
+            now = time.time()
+            while len(trace) > 0 and trace[0].arrival_time <= now:
+                self.add_request(trace.popleft())
+            if not self.has_work():
+                time.sleep(max(0, min(0.01, trace[0].arrival_time - now)))
+                continue
+            self.step()
+
+        return summarize_requests(requests, time.time() - t_start)
+
+def summarize_requests(requests: List[GenerationRequest], elapsed: float):
+    def percentile(xs, p):
+        xs = sorted(xs)
+        return xs[min(len(xs) - 1, int(math.ceil(p * len(xs))) - 1)] if len(xs) > 0 else float('nan')
+
+    ttfts = [req.first_token_time - req.arrival_time for req in requests if req.first_token_time is not None]
+    tpots = [
+        (req.finish_time - req.first_token_time) / (len(req.output_ids) - 1)
+        for req in requests
+        if req.finished and len(req.output_ids) > 1
+    ]
+    num_tokens = sum([len(req.output_ids) for req in requests])
+    return {
+        'requests': len(requests),
+        'tokens': num_tokens,
+        'elapsed': elapsed,
+        'tokens_per_sec': num_tokens / max(elapsed, 1e-9),
+        'ttft_mean': sum(ttfts) / max(len(ttfts), 1),
+        'ttft_p50': percentile(ttfts, 0.5),
+        'ttft_p90': percentile(ttfts, 0.9),
+        'tpot_mean': sum(tpots) / max(len(tpots), 1),
+    }
+
+def format_summary(summary):
+    return (
+        f'{summary["requests"]} requests, {summary["tokens"]} tokens in {summary["elapsed"]:.2f} s, '
+        f'{summary["tokens_per_sec"]:.1f} tokens/s, '
+        f'TTFT mean {summary["ttft_mean"]*1000:.1f} ms (p50 {summary["ttft_p50"]*1000:.1f}, p90 {summary["ttft_p90"]*1000:.1f}), '
+        f'TPOT mean {summary["tpot_mean"]*1000:.2f} ms'
+    )
+
+def synthetic_trace(
+    num_requests: int = 32,
+    request_rate: float = 8.0,
+    prompt_length = (16, 128),
+    new_tokens = (16, 128),
+    vocab_size: int = 50272,
+    temperature: float = 0.0,
+    top_k: int = 0,
+    seed: int = 42,
+):
+    """
+    poisson arrivals with `request_rate` requests/s (inf for every request at 0), uniform lengths.
+    token 0..3 are reserved for special tokens.
+    """
+    rng = random.Random(seed)
+    requests = []
+    t = 0.0
+    for i in range(num_requests):
+        if not math.isinf(request_rate):
+            t += rng.expovariate(request_rate)
+        requests.append(GenerationRequest(
+            input_ids=[rng.randint(4, vocab_size - 1) for _ in range(rng.randint(*prompt_length))],
+            max_new_tokens=rng.randint(*new_tokens),
+            request_id=i,
+            arrival_time=0.0 if math.isinf(request_rate) else t,
+            temperature=temperature,
+            top_k=top_k,
+        ))
+    return requests
+
+@torch.no_grad()
+def generate_reference(model, req: GenerationRequest):
+    """
+    one sequence at a time, without engine
+    """
+    device = next(model.parameters()).device
+    output = model(input_ids=torch.tensor([req.input_ids], device=device), use_cache=True)
+    tokens = [torch.argmax(output.logits[0, -1]).item()]
+    while len(tokens) < req.max_new_tokens:
+        output = model(
+            input_ids=torch.tensor([[tokens[-1]]], device=device),
+            past_key_values=output.past_key_values,
+            use_cache=True,
+        )
+        tokens.append(torch.argmax(output.logits[0, -1]).item())
+    return tokens
+
+def test_correctness(method='perlin'):
+    from ...utils import seed
+    from ...main.tests.tiny_opt import build_tiny_model
+    seed()
+    model = build_tiny_model(method)
+    requests = synthetic_trace(
+        num_requests=8,
+        request_rate=float('inf'),
+        prompt_length=(4, 48),
+        new_tokens=(4, 24),
+        vocab_size=model.config.vocab_size,
+    )
+    truths = [generate_reference(model, req) for req in requests]
+
+    engine = GenerationEngine(model, max_batch_size=3)
+    for req in requests:
+        engine.add_request(req)
+    while engine.has_work():
+        engine.step()
+        # sequences in the pool have different lengths
+        assert len(engine.running) <= 3
+
+    assert len(engine.finished) == len(requests)
+    for req, truth in zip(requests, truths):
+        assert req.output_ids == truth, (req.request_id, req.output_ids, truth)
+    print(f'[{method}] engine matches sequential decoding, {engine.num_steps} steps')
+
+def test_trace(method='perlin', max_batch_sizes=[1, 4, 16]):
+    from ...utils import seed
+    from ...main.tests.tiny_opt import build_tiny_model
+    for max_batch_size in max_batch_sizes:
+        seed()
+        model = build_tiny_model(method, hidden_size=256, num_layers=4, num_heads=4)
+        requests = synthetic_trace(
+            num_requests=32,
+            request_rate=32.0,
+            prompt_length=(16, 128),
+            new_tokens=(16, 128),
+            vocab_size=model.config.vocab_size,
+        )
+        engine = GenerationEngine(model, max_batch_size=max_batch_size)
+        summary = engine.run(requests)
+        print(f'[{method}, max_batch_size={max_batch_size}] {format_summary(summary)}')
+
+def test_main():
+    test_correctness('none')
+    test_correctness('perlin')
+    test_trace('perlin')
+
+if __name__ == '__main__':
+    test_main()
@@ -0,0 +1,952 @@
+"""
+Preallocated KV cache for causal decoding.
+
+K and V are kept in (N, H, capacity, HID) buffers which are allocated in fixed-size blocks
+of PERLIN_KV_CACHE_BLOCK tokens. New tokens are written into the tail in place, and attention
+reads `[:, :, :length]` views of the buffers, so a decode step does not copy the whole history
+like `torch.cat` does. When capacity runs out, number of blocks is doubled, therefore total
+copy over a generation is amortized O(T).
+
+Layer cache tuple is (keys, values, KVCache[, PerlinAttentionState]). keys and values are
+views of the cache, so `past_key_value[0].shape[2]` is still the length of cached tokens.
+
+PERLIN_KV_CACHE: 'paged' (default), 'cat'
+PERLIN_KV_CACHE_BLOCK: tokens per block (default 256)
+
+Optional retention policy (KVRetention) bounds the cache of perlin attention. Every step, keys
+selected by the SEA partial attention mask (sparse, or dense additive mask when not benchmarking)
+are counted with exponential decay. Other attention methods have no selections, so they do not evict. When the cache is longer than
+PERLIN_KV_EVICT_MAX_TOKENS, blocks of PERLIN_KV_EVICT_BLOCK tokens with the lowest selection
+frequency are evicted and the rest is compacted, except first PERLIN_KV_EVICT_SINK and last
+PERLIN_KV_EVICT_RECENT tokens. `evicted` counts removed tokens, positions and state lengths are
+logical (evicted + length). Every layer evicts same number of tokens at same step.
+PERLIN_KV_EVICT_MAX_TOKENS: 0 (default) disables eviction
+
+With PERLIN_KV_SPILL, evicted blocks are spilled into a host tier (KVHostTier) instead of dropped.
+The host tier is pinned host memory ('host') or an unlinked memory mapped file in
+PERLIN_KV_SPILL_DIR ('mmap'), and keeps a mean key of every spilled block on device. Before
+attention, the query scores resident and spilled blocks with block mean keys, and the top blocks
+(as many as the sparse mask selected at the last step) are the estimated selection. Selected
+blocks which are spilled are fetched back and merged in logical order before the sparse kernels
+run, at most PERLIN_KV_SPILL_FETCH blocks per step. Fetched blocks count against max_tokens, resident
+blocks which are not estimated to be selected are spilled first to make room. Hits, misses and latency are counted per layer
+(KVTierStats). Layers keep different number of resident tokens, `evicted` counts spilled tokens.
+PERLIN_KV_SPILL: 'none' (default), 'host', 'mmap'
+
+Usage: python -m src.models.perlin_opt.kv_cache
+"""
+
+import os
+import math
+import time
+import tempfile
+import torch
+
+from ...utils import strify
+
+KV_CACHE = os.environ.get('PERLIN_KV_CACHE', 'paged')
+KV_CACHE_BLOCK = int(os.environ.get('PERLIN_KV_CACHE_BLOCK', '256'))
+
+KV_EVICT_MAX_TOKENS = int(os.environ.get('PERLIN_KV_EVICT_MAX_TOKENS', '0'))
+KV_EVICT_BLOCK = int(os.environ.get('PERLIN_KV_EVICT_BLOCK', '64'))
+KV_EVICT_SINK = int(os.environ.get('PERLIN_KV_EVICT_SINK', '4'))
+KV_EVICT_RECENT = int(os.environ.get('PERLIN_KV_EVICT_RECENT', '256'))
+KV_EVICT_DECAY = float(os.environ.get('PERLIN_KV_EVICT_DECAY', '0.98'))
+
+KV_SPILL = os.environ.get('PERLIN_KV_SPILL', 'none')
+KV_SPILL_DIR = os.environ.get('PERLIN_KV_SPILL_DIR', tempfile.gettempdir())
+KV_SPILL_FETCH = int(os.environ.get('PERLIN_KV_SPILL_FETCH', '4'))
+
+def use_kv_cache():
+    return KV_CACHE == 'paged'
+
+class KVRetention:
+    def __init__(
+        self,
+        max_tokens: int,
+        block_size: int = KV_EVICT_BLOCK,
+        sink: int = KV_EVICT_SINK,
+        recent: int = KV_EVICT_RECENT,
+        decay: float = KV_EVICT_DECAY,
+        slack: float = 0.125,
+        spill: str = 'none',
+        max_fetch_blocks: int = KV_SPILL_FETCH,
+    ):
+        """
+        slack: ratio of max_tokens which is freed by one eviction, so compaction is not run every step
+        spill: 'none' drops evicted blocks, 'host' or 'mmap' moves them into KVHostTier
+        max_fetch_blocks: blocks fetched back from host tier per step
+        """
+        assert max_tokens >= sink + recent + block_size, 'max_tokens is too small for sink, recent and a block'
+        assert spill in ['none', 'host', 'mmap'], spill
+        self.max_tokens = max_tokens
+        self.block_size = block_size
+        self.sink = sink
+        self.recent = recent
+        self.decay = decay
+        self.slack = slack
+        self.spill = spill
+        self.max_fetch_blocks = max_fetch_blocks
+
+    def select_kept(self, usage: torch.Tensor, num_evict: int = None):
+        """
+        usage: N, T. returns indices of kept tokens (N, T_KEPT) in order, or None if nothing to evict
+        num_evict: number of blocks to evict. by default, enough blocks to shrink into (1 - slack) * max_tokens
+        """
+        N, T = usage.shape
+        B = self.block_size
+        num_blocks = (T - self.recent - self.sink) // B
+        if num_evict is None:
+            target = max(int(self.max_tokens * (1 - self.slack)), self.sink + self.recent)
+            num_evict = math.ceil((T - target) / B)
+        num_evict = min(num_blocks, num_evict)
+        if num_evict <= 0:
+            return None
+
+        region = usage[:, self.sink:self.sink + num_blocks * B].view(N, num_blocks, B)
+        _, evict = torch.topk(region.mean(-1), k=num_evict, dim=-1, largest=False)
+        block_alive = torch.ones((N, num_blocks), dtype=torch.bool, device=usage.device)
+        block_alive.scatter_(1, evict, False)
+        alive = torch.ones((N, T), dtype=torch.bool, device=usage.device)
+        alive[:, self.sink:self.sink + num_blocks * B] = block_alive.repeat_interleave(B, dim=1)
+        return alive.nonzero()[:, 1].view(N, T - num_evict * B)
+
+def kv_retention():
+    if KV_EVICT_MAX_TOKENS <= 0:
+        return None
+    return KVRetention(KV_EVICT_MAX_TOKENS, spill=KV_SPILL)
+
+def key_usage_from_mask(mask, N: int, T_SRC: int, device: torch.device):
+    """
+    number of selections of each key over heads and rows. returns N, T_SRC, or None without mask.
+    mask: sparse mask (N, T_DST, H*T_SRC), or dense additive mask (N, H, T_DST, T_SRC) which is
+    0 on selected and FP_MIN on dropped keys
+    """
+    from ..perlin_attention.ops import is_sparse_mask, mask_row_entries
+    if mask is None:
+        return None
+    if not is_sparse_mask(mask):
+        if not isinstance(mask, torch.Tensor) or mask.layout != torch.strided or mask.ndim != 4:
+            return None
+        assert mask.shape[0] == N and mask.shape[-1] == T_SRC, f'{mask.shape}, {N}, {T_SRC}'
+        return (mask > -1).sum((1, 2), dtype=torch.float32).to(device)
+    usage = torch.zeros((N, T_SRC), dtype=torch.float32, device=device)
+    T_DST = mask.shape[1]
+    for n in range(N):
+        _, _, _, cols = mask_row_entries(mask, n, 0, T_DST)
+        usage[n] += torch.bincount(cols.to(device) % T_SRC, minlength=T_SRC)[:T_SRC].float()
+    return usage
+
+class KVTierStats:
+    """
+    counters of host tier of one attention layer. shared by caches of the layer (all sequences and forks)
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.steps = 0
+        self.selected_blocks = 0
+        self.hit_blocks = 0
+        self.fetched_blocks = 0
+        self.spilled_blocks = 0
+        self.fetch_bytes = 0
+        self.spill_bytes = 0
+        self.fetch_seconds = 0.0
+        self.spill_seconds = 0.0
+
+    @property
+    def hit_rate(self):
+        return self.hit_blocks / max(self.selected_blocks, 1)
+
+    def merge(self, other: "KVTierStats"):
+        for name, value in vars(other).items():
+            setattr(self, name, getattr(self, name) + value)
+        return self
+
+    def strify(self):
+        return (
+            f"KVTierStats(hit rate {self.hit_rate:.3f}, {self.steps} steps, "
+            f"fetched {self.fetched_blocks} blocks {self.fetch_bytes / 1024 / 1024:.1f} MB "
+            f"{self.fetch_seconds * 1000 / max(self.steps, 1):.3f} ms/step, "
+            f"spilled {self.spilled_blocks} blocks {self.spill_bytes / 1024 / 1024:.1f} MB "
+            f"{self.spill_seconds * 1000 / max(self.steps, 1):.3f} ms/step)"
+        )
+
+def sync_device(device: torch.device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
+
+class KVHostTier:
+    """
+    blocks of K/V which are spilled out of device. each row of batch has own slots, but every row
+    spills and fetches same number of blocks, so rows always hold same number of blocks.
+    K/V stay on host, positions, usage and mean keys of blocks stay on device for scoring.
+    """
+    def __init__(
+        self,
+        N: int, H: int, HID: int,
+        dtype: torch.dtype,
+        device: torch.device,
+        block_size: int,
+        mode: str = 'host',
+        directory: str = None,
+    ):
+        assert mode in ['host', 'mmap'], mode
+        self.N, self.H, self.HID = N, H, HID
+        self.dtype = dtype
+        self.device = device
+        self.block_size = block_size
+        self.mode = mode
+        self.directory = KV_SPILL_DIR if directory is None else directory
+        self.num_slots = 0
+        # NOTE: every row holds same number of blocks, counted on host to avoid syncs
+        self.blocks_per_row = 0
+        self.key_storage = self.allocate(0)
+        self.value_storage = self.allocate(0)
+        self.used = torch.zeros((N, 0), dtype=torch.bool, device=device)
+        self.positions = torch.zeros((N, 0, block_size), dtype=torch.long, device=device)
+        self.usage = torch.zeros((N, 0), dtype=torch.float32, device=device)
+        self.summary = torch.zeros((N, 0, H, HID), dtype=torch.float32, device=device)
+
+    @property
+    def num_blocks(self):
+        """
+        spilled blocks per row
+        """
+        return self.blocks_per_row
+
+    def allocate(self, num_slots: int):
+        shape = (self.N, num_slots, self.H, self.block_size, self.HID)
+        if self.mode == 'host' or num_slots == 0:
+            return torch.empty(shape, dtype=self.dtype, pin_memory=torch.cuda.is_available())
+        numel = math.prod(shape)
+        fd, path = tempfile.mkstemp(prefix='perlin_kv_spill_', dir=self.directory)
+        try:
+            os.ftruncate(fd, numel * torch.empty((), dtype=self.dtype).element_size())
+            t = torch.from_file(path, shared=True, size=numel, dtype=self.dtype)
+        finally:
+            os.close(fd)
+            # NOTE: the mapping keeps the file alive, nothing is left on disk after exit
+            os.remove(path)
+        return t.view(shape)
+
+    def grow(self, num_slots: int):
+        if num_slots <= self.num_slots:
+            return
+        num_slots = max(num_slots, self.num_slots * 2)
+        for name in ['key_storage', 'value_storage']:
+            old = getattr(self, name)
+            new = self.allocate(num_slots)
+            new[:, :self.num_slots] = old
+            setattr(self, name, new)
+        grow = num_slots - self.num_slots
+        N = self.N
+        self.used = torch.cat([self.used, torch.zeros((N, grow), dtype=torch.bool, device=self.device)], dim=1)
+        self.positions = torch.cat([self.positions, torch.zeros((N, grow, self.block_size), dtype=torch.long, device=self.device)], dim=1)
+        self.usage = torch.cat([self.usage, torch.zeros((N, grow), dtype=torch.float32, device=self.device)], dim=1)
+        self.summary = torch.cat([self.summary, torch.zeros((N, grow, self.H, self.HID), dtype=torch.float32, device=self.device)], dim=1)
+        self.num_slots = num_slots
+
+    def spill(self, keys: torch.Tensor, values: torch.Tensor, positions: torch.Tensor, usage: torch.Tensor):
+        """
+        keys, values: N, H, E, B, HID. positions: N, E, B. usage: N, E
+        """
+        N, H, E, B, HID = keys.shape
+        self.grow(self.num_blocks + E)
+        # first E free slots of each row
+        slots = torch.argsort((~self.used).int(), dim=1, descending=True, stable=True)[:, :E]
+        rows = torch.arange(N, device=self.device).view(N, 1).expand(N, E)
+        self.key_storage[rows.cpu(), slots.cpu()] = keys.permute(0, 2, 1, 3, 4).to('cpu')
+        self.value_storage[rows.cpu(), slots.cpu()] = values.permute(0, 2, 1, 3, 4).to('cpu')
+        self.used[rows, slots] = True
+        self.positions[rows, slots] = positions
+        self.usage[rows, slots] = usage
+        self.summary[rows, slots] = keys.float().mean(3).permute(0, 2, 1, 3)
+        self.blocks_per_row += E
+
+    def score(self, query: torch.Tensor):
+        """
+        query: N, H, HID. returns N, num_slots. free slots are -inf
+        """
+        score = torch.einsum('nhd,nshd->nsh', query.float(), self.summary).amax(-1)
+        return score.masked_fill(~self.used, float('-inf'))
+
+    def fetch(self, slots: torch.Tensor):
+        """
+        slots: N, F. returns keys, values (N, H, F*B, HID) on device, positions (N, F*B), usage (N, F). slots are freed
+        """
+        N, F = slots.shape
+        B = self.block_size
+        rows = torch.arange(N, device=self.device).view(N, 1).expand(N, F)
+        assert self.used[rows, slots].all()
+        keys = self.key_storage[rows.cpu(), slots.cpu()]
+        values = self.value_storage[rows.cpu(), slots.cpu()]
+        if torch.cuda.is_available() and self.mode == 'host':
+            keys = keys.pin_memory()
+            values = values.pin_memory()
+        keys = keys.to(self.device, non_blocking=True).permute(0, 2, 1, 3, 4).reshape(N, self.H, F * B, self.HID)
+        values = values.to(self.device, non_blocking=True).permute(0, 2, 1, 3, 4).reshape(N, self.H, F * B, self.HID)
+        positions = self.positions[rows, slots].view(N, F * B)
+        usage = self.usage[rows, slots]
+        self.used[rows, slots] = False
+        self.blocks_per_row -= F
+        return keys, values, positions, usage
+
+    def clone(self):
+        new = KVHostTier(self.N, self.H, self.HID, self.dtype, self.device, self.block_size, self.mode, self.directory)
+        new.grow(self.num_slots)
+        new.key_storage[:, :self.num_slots] = self.key_storage[:, :self.num_slots]
+        new.value_storage[:, :self.num_slots] = self.value_storage[:, :self.num_slots]
+        for name in ['used', 'positions', 'usage', 'summary']:
+            getattr(new, name)[:, :self.num_slots] = getattr(self, name)
+        new.blocks_per_row = self.blocks_per_row
+        return new
+
+    def index_select(self, dim: int, index: torch.Tensor):
+        assert dim == 0
+        new = KVHostTier(index.shape[0], self.H, self.HID, self.dtype, self.device, self.block_size, self.mode, self.directory)
+        new.grow(self.num_slots)
+        new.key_storage[:, :self.num_slots] = self.key_storage.index_select(0, index.cpu())
+        new.value_storage[:, :self.num_slots] = self.value_storage.index_select(0, index.cpu())
+        for name in ['used', 'positions', 'usage', 'summary']:
+            getattr(new, name)[:, :self.num_slots] = getattr(self, name).index_select(0, index)
+        new.blocks_per_row = self.blocks_per_row
+        return new
+
+class KVCache:
+    def __init__(
+        self,
+        N: int, H: int, HID: int,
+        dtype: torch.dtype,
+        device: torch.device,
+        block_size: int = None,
+        capacity: int = 0,
+        retention: KVRetention = None,
+        stats: KVTierStats = None,
+    ):
+        self.block_size = KV_CACHE_BLOCK if block_size is None else block_size
+        assert self.block_size > 0
+        self.length = 0
+        self.evicted = 0
+        self.retention = retention
+        self.key_storage = torch.empty((N, H, 0, HID), dtype=dtype, device=device)
+        self.value_storage = torch.empty((N, H, 0, HID), dtype=dtype, device=device)
+        # selection frequency of each key, only with retention
+        self.usage = torch.zeros((N, 0), dtype=torch.float32, device=device) if retention is not None else None
+        # logical positions of resident keys and spilled blocks, only with spilling retention
+        spill = retention is not None and retention.spill != 'none'
+        self.positions = torch.zeros((N, 0), dtype=torch.long, device=device) if spill else None
+        self.tier = None # type: KVHostTier
+        self.stats = (stats if stats is not None else KVTierStats()) if spill else None
+        # number of blocks which sparse mask selected at last step, kept on device
+        self.selected_blocks = torch.zeros((), dtype=torch.long, device=device)
+        self.reserve(capacity)
+
+    @staticmethod
+    def from_states(
+        key_states: torch.Tensor, value_states: torch.Tensor,
+        block_size: int = None, retention: KVRetention = None, stats: KVTierStats = None,
+    ):
+        N, H, T, HID = key_states.shape
+        cache = KVCache(N, H, HID, key_states.dtype, key_states.device, block_size=block_size, retention=retention, stats=stats)
+        cache.append(key_states, value_states)
+        return cache
+
+    @staticmethod
+    def from_storage(key_storage: torch.Tensor, value_storage: torch.Tensor, length: int = None, block_size: int = None):
+        """
+        wraps buffers without copy (e.g. memory mapped snapshot). buffers are replaced on first growth.
+        """
+        assert key_storage.shape == value_storage.shape
+        cache = KVCache.__new__(KVCache)
+        cache.block_size = KV_CACHE_BLOCK if block_size is None else block_size
+        cache.length = key_storage.shape[2] if length is None else length
+        cache.evicted = 0
+        cache.retention = None
+        cache.key_storage = key_storage
+        cache.value_storage = value_storage
+        cache.usage = None
+        cache.positions = None
+        cache.tier = None
+        cache.stats = None
+        cache.selected_blocks = 0
+        return cache
+
+    @property
+    def capacity(self):
+        return self.key_storage.shape[2]
+
+    @property
+    def num_blocks(self):
+        return self.capacity // self.block_size
+
+    def reserve(self, length: int):
+        if length <= self.capacity:
+            return
+        num_blocks = max(math.ceil(length / self.block_size), self.num_blocks * 2)
+        capacity = num_blocks * self.block_size
+
+        # NOTE: views handed out before growing still point old buffers, and they are not modified anymore
+        N, H, _, HID = self.key_storage.shape
+        for name in ['key_storage', 'value_storage']:
+            old = getattr(self, name)
+            new = torch.empty((N, H, capacity, HID), dtype=old.dtype, device=old.device)
+            new[:, :, :self.length] = old[:, :, :self.length]
+            setattr(self, name, new)
+        if self.usage is not None:
+            usage = torch.zeros((N, capacity), dtype=self.usage.dtype, device=self.usage.device)
+            usage[:, :self.length] = self.usage[:, :self.length]
+            self.usage = usage
+        if self.positions is not None:
+            positions = torch.zeros((N, capacity), dtype=self.positions.dtype, device=self.positions.device)
+            positions[:, :self.length] = self.positions[:, :self.length]
+            self.positions = positions
+
+    def keys(self):
+        return self.key_storage[:, :, :self.length]
+
+    def values(self):
+        return self.value_storage[:, :, :self.length]
+
+    def append(self, key_states: torch.Tensor, value_states: torch.Tensor, past_length: int = None):
+        """
+        key_states, value_states: N, H, T, HID
+        past_length: number of tokens the caller already has. if cache is longer than that, the caller
+            holds stale tuple (e.g. same step is run twice), then tokens are appended to a fork.
+        returns cache which holds appended tokens
+        """
+        if past_length is not None and past_length != self.length:
+            assert past_length < self.length
+            return self.fork(past_length).append(key_states, value_states)
+
+        assert key_states.shape == value_states.shape
+        assert key_states.shape[:2] == self.key_storage.shape[:2]
+        T = key_states.shape[2]
+        self.reserve(self.length + T)
+        self.key_storage[:, :, self.length:self.length+T] = key_states
+        self.value_storage[:, :, self.length:self.length+T] = value_states
+        if self.usage is not None:
+            self.usage[:, self.length:self.length+T] = 0
+        if self.positions is not None:
+            self.positions[:, self.length:self.length+T] = torch.arange(
+                self.evicted + self.length, self.evicted + self.length + T, device=self.positions.device
+            ).view(1, T)
+        self.length += T
+        return self
+
+    def record_usage(self, usage: torch.Tensor):
+        """
+        usage: N, length. selections of each key at this step
+        """
+        if self.usage is None:
+            return
+        assert usage.shape == (self.usage.shape[0], self.length)
+        self.usage[:, :self.length].mul_(self.retention.decay).add_(usage)
+        if self.positions is not None:
+            B = self.retention.block_size
+            N, T = usage.shape
+            selected = torch.nn.functional.pad((usage > 0).float(), (0, math.ceil(T / B) * B - T))
+            selected = selected.view(N, -1, B).amax(-1)
+            self.selected_blocks = selected.sum(-1).mean().ceil().long()
+
+    def evict(self):
+        """
+        evicts rarely selected blocks if the cache is longer than retention.max_tokens. returns number of evicted tokens
+        """
+        if self.retention is None or self.length <= self.retention.max_tokens:
+            return 0
+        kept = self.retention.select_kept(self.usage[:, :self.length])
+        if kept is None:
+            return 0
+        N, H, _, HID = self.key_storage.shape
+        T_KEPT = kept.shape[-1]
+        if self.positions is not None:
+            self.spill(kept)
+        # NOTE: compacted into new buffers, views of old buffers (e.g. stale past tuples) are not modified
+        index = kept.view(N, 1, T_KEPT, 1).expand(N, H, T_KEPT, HID)
+        for name in ['key_storage', 'value_storage']:
+            old = getattr(self, name)
+            new = torch.empty_like(old)
+            new[:, :, :T_KEPT] = old[:, :, :self.length].gather(2, index)
+            setattr(self, name, new)
+        usage = torch.zeros_like(self.usage)
+        usage[:, :T_KEPT] = self.usage[:, :self.length].gather(1, kept)
+        self.usage = usage
+        if self.positions is not None:
+            positions = torch.zeros_like(self.positions)
+            positions[:, :T_KEPT] = self.positions[:, :self.length].gather(1, kept)
+            self.positions = positions
+
+        num_evicted = self.length - T_KEPT
+        self.evicted += num_evicted
+        self.length = T_KEPT
+        return num_evicted
+
+    def spill(self, kept: torch.Tensor):
+        """
+        moves blocks which are not in kept (N, T_KEPT) into host tier
+        """
+        N, H, _, HID = self.key_storage.shape
+        B = self.retention.block_size
+        sync_device(self.key_storage.device)
+        t_start = time.time()
+        alive = torch.zeros((N, self.length), dtype=torch.bool, device=kept.device)
+        alive.scatter_(1, kept, True)
+        # NOTE: select_kept evicts whole blocks of B contiguous keys
+        spilled = (~alive).nonzero()[:, 1].view(N, -1, B)
+        E = spilled.shape[1]
+        index = spilled.view(N, 1, E * B, 1).expand(N, H, E * B, HID)
+        keys = self.key_storage[:, :, :self.length].gather(2, index).view(N, H, E, B, HID)
+        values = self.value_storage[:, :, :self.length].gather(2, index).view(N, H, E, B, HID)
+        positions = self.positions[:, :self.length].gather(1, spilled.view(N, E * B)).view(N, E, B)
+        usage = self.usage[:, :self.length].gather(1, spilled.view(N, E * B)).view(N, E, B).mean(-1)
+        if self.tier is None:
+            self.tier = KVHostTier(
+                N, H, HID, self.key_storage.dtype, self.key_storage.device, B, mode=self.retention.spill
+            )
+        self.tier.spill(keys, values, positions, usage)
+        self.stats.spilled_blocks += N * E
+        self.stats.spill_bytes += keys.numel() * keys.element_size() * 2
+        sync_device(self.key_storage.device)
+        self.stats.spill_seconds += time.time() - t_start
+
+    def prefetch(self, query: torch.Tensor):
+        """
+        estimates blocks which the sparse mask of this step selects, and fetches spilled ones back
+        before attention. query: N, H, T_DST, HID. returns number of fetched tokens
+        """
+        if self.tier is None:
+            return 0
+        self.stats.steps += 1
+        if self.tier.num_blocks == 0:
+            return 0
+        N, H, _, HID = self.key_storage.shape
+        B = self.retention.block_size
+        q = query[:, :, -1]
+        R = self.length // B
+        resident = self.key_storage[:, :, :R * B].float().view(N, H, R, B, HID).mean(3)
+        resident_score = torch.einsum('nhd,nhrd->nhr', q.float(), resident).amax(1)
+        spilled_score = self.tier.score(q)
+        score = torch.cat([resident_score, spilled_score], dim=1)
+        # NOTE: number of selected blocks stays on device, and is compared with rank of blocks
+        sorted_score, order = torch.sort(score, dim=-1, descending=True)
+        rank = torch.arange(score.shape[1], device=score.device).view(1, -1)
+        top = (rank < self.selected_blocks) & (sorted_score > float('-inf'))
+        is_selected = torch.zeros_like(top).scatter_(1, order, top)
+        misses = is_selected[:, R:].sum(-1)
+        # NOTE: the only host sync of a step
+        num_selected, num_misses, max_misses = torch.stack([is_selected.sum(), misses.sum(), misses.max()]).tolist()
+        self.stats.selected_blocks += num_selected
+        self.stats.hit_blocks += num_selected - num_misses
+        num_fetch = min(max_misses, self.retention.max_fetch_blocks)
+        if num_fetch == 0:
+            return 0
+
+        # NOTE: misses are the best scored spilled blocks, rows with less misses fetch next best blocks
+        slots = torch.topk(spilled_score, k=num_fetch, dim=-1).indices
+        F = num_fetch * B
+
+        # fetched blocks count against max_tokens. resident blocks which are not estimated to be selected
+        # are spilled to make room, so evict() after attention does not compact and spill them back
+        kept = None
+        num_spill = math.ceil((self.length + F - self.retention.max_tokens) / B)
+        if num_spill > 0:
+            protect = torch.zeros((N, self.length), dtype=torch.bool, device=score.device)
+            protect[:, :R * B] = is_selected[:, :R].repeat_interleave(B, dim=1)
+            kept = self.retention.select_kept(
+                self.usage[:, :self.length].masked_fill(protect, float('inf')), num_evict=num_spill
+            )
+            if kept is not None:
+                self.spill(kept)
+        if kept is None:
+            kept = torch.arange(self.length, device=score.device).view(1, -1).expand(N, -1)
+        T_KEPT = kept.shape[-1]
+        T = T_KEPT + F
+
+        sync_device(self.key_storage.device)
+        t_start = time.time()
+        keys, values, positions, _ = self.tier.fetch(slots)
+        self.reserve(T)
+        # destination of kept and fetched tokens in logical order
+        dest = torch.cat([self.positions[:, :self.length].gather(1, kept), positions], dim=1)
+        dest = torch.argsort(torch.argsort(dest, dim=1), dim=1)
+        # fetched blocks get the best usage of the row, so they are not spilled again at once
+        fetched_usage = self.usage[:, :self.length].gather(1, kept).amax(-1, keepdim=True).expand(N, F)
+        # NOTE: merged in place. kept tokens are gathered before scattering, so each buffer is moved once.
+        #       the caller takes keys() again after prefetch, new tokens of this step stay at the tail
+        for name, fetched in [('key_storage', keys), ('value_storage', values)]:
+            storage = getattr(self, name)
+            resident = storage[:, :, :self.length].gather(2, kept.view(N, 1, T_KEPT, 1).expand(N, H, T_KEPT, HID))
+            storage.scatter_(2, dest[:, :T_KEPT].view(N, 1, T_KEPT, 1).expand(N, H, T_KEPT, HID), resident)
+            storage.scatter_(2, dest[:, T_KEPT:].view(N, 1, F, 1).expand(N, H, F, HID), fetched)
+        for name, fetched in [('usage', fetched_usage), ('positions', positions)]:
+            storage = getattr(self, name)
+            resident = storage[:, :self.length].gather(1, kept)
+            storage.scatter_(1, dest[:, :T_KEPT], resident)
+            storage.scatter_(1, dest[:, T_KEPT:], fetched)
+        self.evicted += self.length - T_KEPT - F
+        self.length = T
+        self.stats.fetched_blocks += N * num_fetch
+        self.stats.fetch_bytes += keys.numel() * keys.element_size() * 2
+        sync_device(self.key_storage.device)
+        self.stats.fetch_seconds += time.time() - t_start
+        return F
+
+    def fork(self, length: int = None):
+        length = self.length if length is None else length
+        N, H, _, HID = self.key_storage.shape
+        new = KVCache(
+            N, H, HID,
+            self.key_storage.dtype, self.key_storage.device,
+            block_size=self.block_size,
+            capacity=self.capacity,
+            retention=self.retention,
+            stats=self.stats,
+        )
+        new.key_storage[:, :, :length] = self.key_storage[:, :, :length]
+        new.value_storage[:, :, :length] = self.value_storage[:, :, :length]
+        if self.usage is not None:
+            new.usage[:, :length] = self.usage[:, :length]
+        if self.positions is not None:
+            new.positions[:, :length] = self.positions[:, :length]
+        new.tier = self.tier.clone() if self.tier is not None else None
+        new.selected_blocks = self.selected_blocks
+        new.length = length
+        new.evicted = self.evicted
+        return new
+
+    def index_select(self, dim: int, index: torch.Tensor):
+        assert dim == 0
+        new = KVCache.__new__(KVCache)
+        new.block_size = self.block_size
+        new.length = self.length
+        new.evicted = self.evicted
+        new.retention = self.retention
+        new.key_storage = self.key_storage.index_select(0, index)
+        new.value_storage = self.value_storage.index_select(0, index)
+        new.usage = self.usage.index_select(0, index) if self.usage is not None else None
+        new.positions = self.positions.index_select(0, index) if self.positions is not None else None
+        new.tier = self.tier.index_select(0, index) if self.tier is not None else None
+        new.stats = self.stats
+        new.selected_blocks = self.selected_blocks
+        return new
+
+    def strify(self):
+        spilled = f", spilled={self.tier.num_blocks} blocks" if self.tier is not None else ""
+        return f"KVCache({self.length}/{self.capacity}, evicted={self.evicted}{spilled}, {strify(self.key_storage)})"
+
+def unpack_past_key_value(past_key_value):
+    """
+    returns (keys, values, KVCache or None, state or None)
+    """
+    keys, values = past_key_value[:2]
+    cache = None
+    state = None
+    for item in past_key_value[2:]:
+        if isinstance(item, KVCache):
+            cache = item
+        else:
+            state = item
+    return keys, values, cache, state
+
+def past_evicted_length(past_key_value):
+    """
+    number of tokens evicted from the layer past. logical length is `evicted + past_key_value[0].shape[2]`
+    """
+    _, _, cache, _ = unpack_past_key_value(past_key_value)
+    return cache.evicted if cache is not None else 0
+
+def past_spilled_blocks(past_key_value):
+    """
+    number of blocks of the layer past in host tier
+    """
+    _, _, cache, _ = unpack_past_key_value(past_key_value)
+    return cache.tier.num_blocks if cache is not None and cache.tier is not None else 0
+
+def collect_kv_tier_stats(model: torch.nn.Module):
+    """
+    returns list of (module name, KVTierStats) of attention layers, in order of layers
+    """
+    return [
+        (name, module.kv_tier_stats)
+        for name, module in model.named_modules()
+        if isinstance(getattr(module, 'kv_tier_stats', None), KVTierStats)
+    ]
+
+def fork_past_key_values(past_key_values):
+    """
+    forks perlin attention states of every layer, for decoding another branch from same past.
+    KVCache is shared, because the branch which appends later forks it by itself (see `KVCache.append`).
+    """
+    forked = ()
+    for layer_past in past_key_values:
+        forked += (tuple(
+            item.fork() if (not isinstance(item, KVCache)) and hasattr(item, 'fork') else item
+            for item in layer_past
+        ),)
+    return forked
+
+class RaggedLayerPast:
+    """
+    layer past of a batch of sequences which have different lengths.
+    each item is layer past tuple of one sequence (batch size 1), and decoder runs attention per item.
+    """
+    def __init__(self, pasts):
+        self.pasts = list(pasts)
+
+    def lengths(self):
+        return [layer_past[0].shape[2] for layer_past in self.pasts]
+
+    def evicted_lengths(self):
+        return [past_evicted_length(layer_past) for layer_past in self.pasts]
+
+    def strify(self):
+        return f"RaggedLayerPast({self.lengths()})"
+
+def ragged_past_key_values(sequence_past_key_values):
+    """
+    list of past_key_values of sequences -> tuple of RaggedLayerPast for each layer
+    """
+    assert len(sequence_past_key_values) > 0
+    num_layers = len(sequence_past_key_values[0])
+    return tuple(
+        RaggedLayerPast([past[i] for past in sequence_past_key_values])
+        for i in range(num_layers)
+    )
+
+def split_ragged_past_key_values(past_key_values):
+    """
+    tuple of RaggedLayerPast for each layer -> list of past_key_values of sequences
+    """
+    num_sequences = len(past_key_values[0].pasts)
+    return [
+        tuple(layer_past.pasts[i] for layer_past in past_key_values)
+        for i in range(num_sequences)
+    ]
+
+def ragged_attention_mask(past_lengths, length: int, device: torch.device):
+    """
+    left padded attention mask (N, max(past_lengths) + length)
+    """
+    T = max(past_lengths) + length
+    lengths = torch.tensor(past_lengths, device=device).view(-1, 1) + length
+    return (torch.arange(T, device=device).view(1, T) >= (T - lengths)).long()
+
+def test_correctness():
+    N, H, HID = 2, 4, 8
+    k = torch.randn((N, H, 5, HID))
+    v = torch.randn((N, H, 5, HID))
+    cache = KVCache.from_states(k, v, block_size=4)
+    assert cache.capacity == 8
+    keys, values = k, v
+    for i in range(20):
+        kk = torch.randn((N, H, 1, HID))
+        vv = torch.randn((N, H, 1, HID))
+        cache = cache.append(kk, vv, past_length=keys.shape[2])
+        keys = torch.cat([keys, kk], dim=2)
+        values = torch.cat([values, vv], dim=2)
+        assert torch.equal(cache.keys(), keys)
+        assert torch.equal(cache.values(), values)
+        assert cache.capacity % 4 == 0
+        # attention reads cache through views
+        assert cache.keys().view(N*H, -1, HID).data_ptr() == cache.key_storage.data_ptr()
+
+    # stale tuple is forked, original cache is not modified
+    stale_keys = cache.keys()
+    kk = torch.randn((N, H, 1, HID))
+    cache.append(kk, kk)
+    forked = cache.append(-kk, -kk, past_length=stale_keys.shape[2])
+    assert forked is not cache
+    assert torch.equal(cache.keys()[:, :, -1:], kk)
+    assert torch.equal(forked.keys()[:, :, -1:], -kk)
+    assert torch.equal(forked.keys()[:, :, :-1], stale_keys)
+
+    beam_idx = torch.tensor([1, 1])
+    reordered = cache.index_select(0, beam_idx)
+    assert torch.equal(reordered.keys(), cache.keys().index_select(0, beam_idx))
+
+def test_retention():
+    N, H, HID, B = 2, 2, 4, 4
+    retention = KVRetention(max_tokens=32, block_size=B, sink=2, recent=8, decay=1.0, slack=0.25)
+    k = torch.arange(40, dtype=torch.float32).view(1, 1, 40, 1).expand(N, H, 40, HID).contiguous()
+    cache = KVCache(N, H, HID, k.dtype, k.device, block_size=8, retention=retention)
+    cache.append(k[:, :, :33], k[:, :, :33])
+    # blocks of sink..length-recent are [2, 6), [6, 10), [10, 14), [14, 18), [18, 22)
+    usage = torch.zeros((N, 33))
+    usage[0, 2:6] = 5
+    usage[0, 10:14] = 3
+    usage[1, 2:6] = 2
+    usage[1, 14:18] = 1
+    cache.record_usage(usage)
+
+    num_evicted = cache.evict()
+    # 33 -> target 24, three blocks are evicted
+    assert num_evicted == 12 and cache.length == 21 and cache.evicted == 12
+    tail = list(range(22, 33))
+    assert cache.keys()[0, 0, :, 0].long().tolist() == [0, 1, 2, 3, 4, 5, 10, 11, 12, 13] + tail
+    assert cache.keys()[1, 0, :, 0].long().tolist() == [0, 1, 2, 3, 4, 5, 14, 15, 16, 17] + tail
+    assert torch.equal(cache.values(), cache.keys())
+    assert cache.usage[0, :10].tolist() == [0, 0, 5, 5, 5, 5, 3, 3, 3, 3]
+    # below the cap, nothing is evicted
+    cache.append(k[:, :, 33:34], k[:, :, 33:34])
+    assert cache.evict() == 0 and cache.length == 22
+
+def test_usage_from_mask(N=2, H=3, T_DST=5, T_SRC=7):
+    FP_MIN = torch.finfo(torch.float16).min * 0.5
+    alive = torch.rand((N, H, T_DST, T_SRC)) > 0.5
+    usage = key_usage_from_mask((~alive).float() * FP_MIN, N, T_SRC, 'cpu')
+    assert torch.equal(usage, alive.float().sum((1, 2)))
+    assert key_usage_from_mask(None, N, T_SRC, 'cpu') is None
+
+def test_evict_model(benchmarking=False, T_PREFILL=128, T_DECODE=320, cap=384):
+    """
+    eviction of tiny perlin_opt is driven by selections of partial attention mask, which is dense
+    when not benchmarking. other methods do not evict.
+    """
+    global KV_EVICT_MAX_TOKENS
+    from ...utils import seed
+    from ...main.tests.tiny_opt import build_tiny_model
+    seed()
+    input_ids = torch.randint(4, 512, (1, T_PREFILL + T_DECODE))
+    max_tokens = KV_EVICT_MAX_TOKENS
+    KV_EVICT_MAX_TOKENS = cap
+    try:
+        for method in ['perlin', 'none']:
+            model = build_tiny_model(method, benchmarking=benchmarking)
+            with torch.no_grad():
+                output = model(input_ids=input_ids[:, :T_PREFILL], use_cache=True)
+                for i in range(T_PREFILL, input_ids.shape[-1]):
+                    output = model(input_ids=input_ids[:, i:i+1], past_key_values=output.past_key_values, use_cache=True)
+            caches = [unpack_past_key_value(layer_past)[2] for layer_past in output.past_key_values]
+            for cache in caches:
+                if method == 'perlin':
+                    assert cache.evicted > 0 and cache.length <= cap, (cache.evicted, cache.length)
+                    # NOTE: without selections, topk of zeros evicts arbitrary blocks
+                    assert cache.usage[:, :cache.length].sum() > 0
+                else:
+                    assert cache.retention is None and cache.evicted == 0 and cache.length == input_ids.shape[-1]
+            print(f'[{method}, benchmarking={benchmarking}] evicted {caches[0].evicted} tokens')
+    finally:
+        KV_EVICT_MAX_TOKENS = max_tokens
+
+def test_tier(mode='host'):
+    N, H, HID, B = 2, 2, 4, 4
+    retention = KVRetention(max_tokens=32, block_size=B, sink=2, recent=8, decay=1.0, slack=0.25, spill=mode, max_fetch_blocks=2)
+    k = torch.arange(40, dtype=torch.float32).view(1, 1, 40, 1).expand(N, H, 40, HID).contiguous()
+    cache = KVCache(N, H, HID, k.dtype, k.device, block_size=8, retention=retention)
+    cache.append(k[:, :, :33], -k[:, :, :33])
+    usage = torch.zeros((N, 33))
+    usage[0, 2:6] = 5
+    usage[0, 10:14] = 3
+    usage[1, 2:6] = 2
+    usage[1, 14:18] = 1
+    cache.record_usage(usage)
+    assert cache.selected_blocks == 4
+
+    # same blocks as test_retention are spilled instead of dropped
+    assert cache.evict() == 12 and cache.length == 21 and cache.tier.num_blocks == 3
+    assert cache.positions[0, :10].tolist() == [0, 1, 2, 3, 4, 5, 10, 11, 12, 13]
+    assert cache.tier.positions[0][cache.tier.used[0]].view(-1).tolist() == [6, 7, 8, 9, 14, 15, 16, 17, 18, 19, 20, 21]
+    assert cache.stats.spilled_blocks == N * 3
+
+    # query is parallel to keys, so the highest blocks are selected. resident blocks are [0, 4), [4, 8)..
+    # of resident slots, keys of row 0 are [0..5, 10..13, 22..32], largest spilled block is [18, 22)
+    cache.append(k[:, :, 33:34], -k[:, :, 33:34])
+    cache.selected_blocks = torch.tensor(6)
+    query = torch.ones((N, H, 1, HID))
+    assert cache.prefetch(query) == 2 * B
+    assert cache.length == 30 and cache.evicted == 4 and cache.tier.num_blocks == 1
+    assert cache.keys()[0, 0, :, 0].long().tolist() == [0, 1, 2, 3, 4, 5] + list(range(10, 34))
+    assert cache.keys()[1, 0, :, 0].long().tolist() == [0, 1, 2, 3, 4, 5] + list(range(10, 14)) + list(range(14, 34))
+    assert torch.equal(cache.values(), -cache.keys())
+    assert torch.equal(cache.positions[:, :cache.length], cache.keys()[:, 0, :, 0].long())
+    assert cache.stats.fetched_blocks == N * 2 and 0 < cache.stats.hit_rate < 1
+
+    forked = cache.fork()
+    assert torch.equal(forked.keys(), cache.keys()) and forked.tier is not cache.tier
+    assert forked.tier.num_blocks == 1 and forked.stats is cache.stats
+    reordered = cache.index_select(0, torch.tensor([1, 1]))
+    assert torch.equal(reordered.tier.positions[0], cache.tier.positions[1])
+
+    # fetched blocks count against max_tokens, so evict() does not run again at the same step
+    cache.append(k[:, :, 34:36], -k[:, :, 34:36])
+    cache.selected_blocks = torch.tensor(9)
+    assert cache.prefetch(query) == B
+    assert cache.length == retention.max_tokens and cache.evict() == 0
+    assert cache.evicted == cache.tier.num_blocks * B == B
+    assert torch.equal(cache.positions[:, :cache.length], cache.keys()[:, 0, :, 0].long())
+    assert torch.equal(cache.values(), -cache.keys())
+    print(f'tier {mode} passed', cache.strify(), cache.stats.strify())
+
+def test_decode_speed(
+    N=1, H=12, HID=64, LAYERS=12, T_PROMPT=128, T_MAX=8192, report_every=1024,
+):
+    """
+    simulates decoding of LAYERS attention layers with both cache types.
+    per-token latency of cache update should be flat for paged cache, and linear for cat.
+    """
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    dtype = torch.float16 if device == 'cuda' else torch.float32
+    def sync():
+        if device == 'cuda':
+            torch.cuda.synchronize()
+
+    for method in ['cat', 'paged']:
+        pasts = []
+        for _ in range(LAYERS):
+            k = torch.randn((N, H, T_PROMPT, HID), dtype=dtype, device=device)
+            v = torch.randn((N, H, T_PROMPT, HID), dtype=dtype, device=device)
+            pasts.append((k, v, KVCache.from_states(k, v)) if method == 'paged' else (k, v))
+
+        t_update = t_total = 0
+        steps = 0
+        for t in range(T_PROMPT, T_MAX):
+            sync()
+            t_start = time.time()
+            for i in range(LAYERS):
+                q = torch.randn((N, H, 1, HID), dtype=dtype, device=device)
+                k = torch.randn((N, H, 1, HID), dtype=dtype, device=device)
+                v = torch.randn((N, H, 1, HID), dtype=dtype, device=device)
+                sync()
+                t_update_start = time.time()
+                if method == 'paged':
+                    keys, values, cache, _ = unpack_past_key_value(pasts[i])
+                    cache = cache.append(k, v, past_length=keys.shape[2])
+                    keys, values = cache.keys(), cache.values()
+                    pasts[i] = (keys, values, cache)
+                else:
+                    keys = torch.cat([pasts[i][0], k], dim=2)
+                    values = torch.cat([pasts[i][1], v], dim=2)
+                    pasts[i] = (keys, values)
+                sync()
+                t_update += time.time() - t_update_start
+
+                probs = torch.softmax(torch.bmm(q.view(N*H, 1, HID), keys.view(N*H, -1, HID).transpose(-1, -2)), dim=-1)
+                torch.bmm(probs, values.view(N*H, -1, HID))
+            sync()
+            t_total += time.time() - t_start
+            steps += 1
+
+            if (t + 1) % report_every == 0:
+                print(
+                    f'[{method}] T={t+1}, '
+                    f'cache update {t_update / steps * 1000:.3f} ms/token, '
+                    f'decode step {t_total / steps * 1000:.3f} ms/token, '
+                    f'{steps / t_total:.1f} tokens/s'
+                )
+                t_update = t_total = 0
+                steps = 0
+
+def test_main():
+    test_correctness()
+    test_retention()
+    test_usage_from_mask()
+    test_evict_model(benchmarking=False)
+    test_evict_model(benchmarking=True)
+    test_tier('host')
+    test_tier('mmap')
+    test_decode_speed()
+
+if __name__ == '__main__':
+    test_main()
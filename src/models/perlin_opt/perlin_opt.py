@@ -48,6 +48,17 @@ from transformers.utils import (
 from transformers.models.opt.configuration_opt import OPTConfig
 
 from ...utils import strify, checkpoint
+from .kv_cache import (
+    KVCache, 
+    use_kv_cache, 
+    unpack_past_key_value, 
+    RaggedLayerPast, 
+    ragged_attention_mask,
+    kv_retention,
+    key_usage_from_mask,
+    past_evicted_length,
+    KVTierStats,
+)
 
 logger = logging.get_logger(__name__)
 
@@ -118,15 +129,16 @@ class OPTLearnedPositionalEmbedding(nn.Embedding):
         self.offset = 2
         super().__init__(num_embeddings + self.offset, embedding_dim)
 
-    def forward(self, attention_mask: torch.LongTensor, past_key_values_length: int = 0):
-        """`input_ids_shape` is expected to be [bsz x seqlen]."""
+    def forward(self, attention_mask: torch.LongTensor, past_key_values_length: int = 0, position_offset = 0):
+        """`input_ids_shape` is expected to be [bsz x seqlen].
+        position_offset: number of evicted past tokens, int or (bsz, 1)"""
         attention_mask = attention_mask.long()
 
         # create positions depending on attention_mask
         positions = (torch.cumsum(attention_mask, dim=1).type_as(attention_mask) * attention_mask).long() - 1
 
         # cut positions if `past_key_values_length` is > 0
-        positions = positions[:, past_key_values_length:]
+        positions = positions[:, past_key_values_length:] + position_offset
 
         return super().forward(positions + self.offset)
 
@@ -163,6 +175,8 @@ class OPTAttention(nn.Module):
                 f" and `num_heads`: {num_heads})."
             )
         self.scaling = self.head_dim**-0.5
+        # scaling is multiplied into q_proj by freeze_for_inference
+        self.scaling_folded = False
         self.is_decoder = is_decoder
 
         self.k_proj = nn.Linear(embed_dim, embed_dim, bias=bias)
@@ -240,17 +254,35 @@ class OPTAttention(nn.Module):
         self.last_loss = None
         self.checkout_perlin_output = False
         self.last_perlin_output = None
+        self.last_partial_attention_mask = None
+        # hit rate and latency of host tier of KV cache of this layer
+        self.kv_tier_stats = KVTierStats()
         self.swap_out_device = None
 
     def _shape(self, tensor: torch.Tensor, seq_len: int, bsz: int):
         return tensor.view(bsz, seq_len, self.num_heads, self.head_dim).transpose(1, 2).contiguous()
     
+    def freeze_for_inference(self):
+        """
+        multiplies scaling of query into q_proj, and merges LoRA of output into out_proj
+        """
+        if not self.scaling_folded:
+            self.q_proj.weight.data.mul_(self.scaling)
+            if self.q_proj.bias is not None:
+                self.q_proj.bias.data.mul_(self.scaling)
+            # NOTE: perlin self attention with LoRA reads scaling from q_proj
+            self.q_proj.scaling = torch.tensor(self.scaling, dtype=self.q_proj.weight.dtype, device=self.q_proj.weight.device)
+            self.scaling_folded = True
+        if self.pconfig.lora_enabled:
+            self.perlin_out_lora.merge_into(self.out_proj)
+    
     def attention(self, q: torch.Tensor, k: torch.Tensor, v: torch.Tensor, attention_mask: torch.Tensor, last_state: object):
         if self.checkout_intermediates:
             self.last_q = q
             self.last_k = k
             self.last_v = v
             self.last_attention_mask = attention_mask
+        self.last_partial_attention_mask = None
         
         op_dtype = q.dtype
         N_H, T_DST, _HID_Q = q.shape
@@ -466,6 +498,8 @@ class OPTAttention(nn.Module):
             ) #type: PerlinAttentionOutput
             # return q, None, None #TODO REMOVE
             self.last_loss = output.loss
+            # NOTE: selections of keys are tracked by KV retention policy
+            self.last_partial_attention_mask = output.partial_attention_mask
             if not self.benchmarking and self.checkout_perlin_output:
                 warnings.warn("you are checking-out LARGE buffers!!")
                 if self.swap_out_device is None:
@@ -542,6 +576,13 @@ class OPTAttention(nn.Module):
         use_cache: bool = False,
     ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
         """Input shape: Batch x Time x Channel"""
+        
+        if isinstance(past_key_value, RaggedLayerPast):
+            return self.forward_ragged(
+                hidden_states=hidden_states,
+                past_key_value=past_key_value,
+                attention_mask=attention_mask,
+            )
 
         # if key_value_states are provided this layer is used as a cross-attention layer
         # for the decoder
@@ -559,10 +600,14 @@ class OPTAttention(nn.Module):
         bsz, tgt_len, _ = hidden_states.size()
 
         # get query proj
-        query_states = self.q_proj(hidden_states) * torch.tensor(self.scaling, dtype=op_dtype, device=hidden_states.device)
-        self.q_proj.scaling = torch.tensor(self.scaling, dtype=op_dtype, device=hidden_states.device)
+        if self.scaling_folded:
+            query_states = self.q_proj(hidden_states)
+        else:
+            query_states = self.q_proj(hidden_states) * torch.tensor(self.scaling, dtype=op_dtype, device=hidden_states.device)
+            self.q_proj.scaling = torch.tensor(self.scaling, dtype=op_dtype, device=hidden_states.device)
         
         past_state = None
+        kv_cache = None
         # get key, value proj
         if is_cross_attention and past_key_value is not None:
             # reuse k,v, cross_attentions
@@ -576,13 +621,34 @@ class OPTAttention(nn.Module):
             # reuse k, v, self_attention
             key_states = self._shape(self.k_proj(hidden_states), -1, bsz)
             value_states = self._shape(self.v_proj(hidden_states), -1, bsz)
-            key_states = torch.cat([past_key_value[0], key_states], dim=2)
-            value_states = torch.cat([past_key_value[1], value_states], dim=2)
-            past_state = past_key_value[2] if len(past_key_value) > 2 else None
+            past_keys, past_values, kv_cache, past_state = unpack_past_key_value(past_key_value)
+            if kv_cache is not None:
+                # NOTE: append in place, and attend on views of preallocated cache
+                kv_cache = kv_cache.append(key_states, value_states, past_length=past_keys.shape[2])
+                # NOTE: spilled blocks which are estimated to be selected are fetched before sparse attention.
+                #       only for a sequence (or ragged batch), because left padding of batch is not tracked by tiers
+                if kv_cache.tier is not None and bsz == 1 and kv_cache.prefetch(self._shape(query_states, tgt_len, bsz)) > 0:
+                    if past_state is not None:
+                        past_state = past_state.fork()
+                        past_state.evicted = kv_cache.evicted
+                key_states = kv_cache.keys()
+                value_states = kv_cache.values()
+            else:
+                key_states = torch.cat([past_keys, key_states], dim=2)
+                value_states = torch.cat([past_values, value_states], dim=2)
         else:
             # self_attention
             key_states = self._shape(self.k_proj(hidden_states), -1, bsz)
             value_states = self._shape(self.v_proj(hidden_states), -1, bsz)
+            if self.is_decoder and use_cache and (not self.training) and use_kv_cache():
+                # NOTE: retention is driven by selections of perlin partial attention mask
+                kv_cache = KVCache.from_states(
+                    key_states, value_states, 
+                    retention=kv_retention() if self.attention_method == 'perlin' else None, 
+                    stats=self.kv_tier_stats,
+                )
+                key_states = kv_cache.keys()
+                value_states = kv_cache.values()
 
         if self.is_decoder:
             # if cross_attention save Tuple(torch.Tensor, torch.Tensor) of all cross attention key/value_states.
@@ -593,6 +659,16 @@ class OPTAttention(nn.Module):
             # can concat previous decoder key/value_states to current projected key/value_states (third "elif" case)
             # if encoder bi-directional self-attention `past_key_value` is always `None`
             past_key_value = (key_states, value_states)
+            if kv_cache is not None:
+                past_key_value = (*past_key_value, kv_cache)
+        
+        if kv_cache is not None and attention_mask.shape[-1] != key_states.shape[2]:
+            # NOTE: with host tier, layers keep different number of resident keys. past is not padded (see prefetch)
+            assert kv_cache.tier is not None and bsz == 1, f'attention mask {attention_mask.shape} does not match {key_states.shape[2]} cached keys'
+            attention_mask = torch.cat([
+                attention_mask.new_zeros(attention_mask.shape[:-1] + (key_states.shape[2] - tgt_len,)),
+                attention_mask[..., -tgt_len:],
+            ], dim=-1)
 
         proj_shape = (bsz * self.num_heads, -1, self.head_dim)
         query_states = self._shape(query_states, tgt_len, bsz).view(*proj_shape)
@@ -624,6 +700,18 @@ class OPTAttention(nn.Module):
         if attn_output.dtype != op_dtype:
             attn_output = attn_output.to(op_dtype)
         
+        if kv_cache is not None and kv_cache.retention is not None:
+            usage = key_usage_from_mask(
+                self.last_partial_attention_mask, bsz, kv_cache.length, kv_cache.usage.device
+            )
+            if usage is None:
+                raise Exception('KV retention needs partial attention mask, but attention did not return it')
+            kv_cache.record_usage(usage)
+            if kv_cache.evict() > 0:
+                past_key_value = (kv_cache.keys(), kv_cache.values(), kv_cache)
+            if attn_state is not None:
+                attn_state.evicted = kv_cache.evicted
+        
         if attn_state is not None:
             past_key_value = (*past_key_value, attn_state)
 
@@ -633,6 +721,35 @@ class OPTAttention(nn.Module):
             attn_output = self.out_proj(attn_output)
 
         return attn_output, attn_weights_reshaped, past_key_value
+    
+    def forward_ragged(
+        self,
+        hidden_states: torch.Tensor,
+        past_key_value: RaggedLayerPast,
+        attention_mask: torch.Tensor,
+    ):
+        """
+        batch of sequences with different cached lengths. each sequence attends on its own cache and state,
+        and the rest of the decoder layer runs batched.
+        attention_mask: N, 1, T_DST, max(T_SRC), left padded
+        """
+        assert hidden_states.shape[0] == len(past_key_value.pasts)
+        
+        T_DST = hidden_states.shape[1]
+        attn_outputs = []
+        presents = []
+        for i, layer_past in enumerate(past_key_value.pasts):
+            T_SRC = layer_past[0].shape[2] + T_DST
+            attn_output, _, present = self.forward(
+                hidden_states=hidden_states[i:i+1],
+                past_key_value=layer_past,
+                attention_mask=attention_mask[i:i+1, :, :, -T_SRC:],
+                use_cache=True,
+            )
+            attn_outputs.append(attn_output)
+            presents.append(present)
+        
+        return torch.cat(attn_outputs, dim=0), None, RaggedLayerPast(presents)
 
 
 class OPTDecoderLayer(nn.Module):
@@ -1069,7 +1186,17 @@ class OPTDecoder(OPTPreTrainedModel):
             inputs_embeds = self.embed_tokens(input_ids)
 
         batch_size, seq_length = input_shape
-        past_key_values_length = past_key_values[0][0].shape[2] if past_key_values is not None else 0
+        if past_key_values is not None and isinstance(past_key_values[0], RaggedLayerPast):
+            # NOTE: sequences have different lengths, left pad masks. positions are counted from the mask.
+            past_lengths = past_key_values[0].lengths()
+            past_key_values_length = max(past_lengths)
+            if attention_mask is None:
+                attention_mask = ragged_attention_mask(past_lengths, seq_length, inputs_embeds.device)
+            position_offset = torch.tensor(past_key_values[0].evicted_lengths(), device=inputs_embeds.device).view(-1, 1)
+        else:
+            past_key_values_length = past_key_values[0][0].shape[2] if past_key_values is not None else 0
+            # NOTE: KV cache can evict tokens, masks are built on cached tokens and positions on all tokens
+            position_offset = past_evicted_length(past_key_values[0]) if past_key_values is not None else 0
         # required mask seq length can be calculated via length of past
         mask_seq_length = past_key_values_length + seq_length
 
@@ -1084,7 +1211,7 @@ class OPTDecoder(OPTPreTrainedModel):
         causal_attention_mask = self._prepare_decoder_attention_mask(
             attention_mask, input_shape, inputs_embeds, past_key_values_length
         )
-        pos_embeds = self.embed_positions(attention_mask, past_key_values_length)
+        pos_embeds = self.embed_positions(attention_mask, past_key_values_length, position_offset)
 
         if self.project_in is not None:
             inputs_embeds = self.project_in(inputs_embeds)
@@ -1577,9 +1704,24 @@ class OPTForCausalLM(OPTPreTrainedModel):
 
     @staticmethod
     def _reorder_cache(past_key_values, beam_idx):
+        """
+        reorders K/V, KVCache and PerlinAttentionState of every layer by beam_idx, in batch
+        """
         reordered_past = ()
         for layer_past in past_key_values:
-            reordered_past += (tuple(past_state.index_select(0, beam_idx) for past_state in layer_past),)
+            keys, values, cache, state = unpack_past_key_value(layer_past)
+            if cache is not None:
+                # NOTE: keys and values are views of the cache, so they are not gathered twice
+                cache = cache.index_select(0, beam_idx.to(cache.key_storage.device))
+                reordered = (cache.keys(), cache.values(), cache)
+            else:
+                reordered = (
+                    keys.index_select(0, beam_idx.to(keys.device)), 
+                    values.index_select(0, beam_idx.to(values.device)),
+                )
+            if state is not None:
+                reordered += (state.index_select(0, beam_idx),)
+            reordered_past += (reordered,)
         return reordered_past
 
 
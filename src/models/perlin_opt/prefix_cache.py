@@ -0,0 +1,248 @@
+"""
+LRU prefix cache for prompts which share common prefixes.
+
+Prompts are split into blocks of PERLIN_PREFIX_CACHE_BLOCK tokens, and each block is keyed by
+chained hash of the tokens from the start of prompt to the end of block. An entry stores K/V of
+its own block for every layer and the forked PerlinAttentionState (performer cumsums, CNN
+buffers, cumulative average) at the end of block. New request looks up the longest cached chain
+of blocks, restores a fresh KVCache from the blocks and forks the states, and then prefills
+only the rest of the prompt.
+
+Entries are evicted in LRU order when stored bytes exceed `max_bytes`. Ancestors of a block are
+always touched after the block, so leaves are evicted before their prefixes.
+
+PERLIN_PREFIX_CACHE_BLOCK: tokens per block (default 256)
+
+Usage: python -m src.models.perlin_opt.prefix_cache
+"""
+
+import os
+import hashlib
+from collections import OrderedDict
+from typing import List
+
+import torch
+from torch import nn
+
+from .kv_cache import KVCache, unpack_past_key_value, past_evicted_length
+
+PREFIX_CACHE_BLOCK = int(os.environ.get('PERLIN_PREFIX_CACHE_BLOCK', '256'))
+
+def object_nbytes(obj, seen=None):
+    """
+    bytes of tensors reachable from decoding state objects
+    """
+    seen = set() if seen is None else seen
+    if id(obj) in seen or isinstance(obj, nn.Module):
+        return 0
+    seen.add(id(obj))
+    if isinstance(obj, torch.Tensor):
+        return obj.numel() * obj.element_size()
+    if isinstance(obj, dict):
+        return sum([object_nbytes(v, seen) for v in obj.values()])
+    if isinstance(obj, (list, tuple, set)):
+        return sum([object_nbytes(v, seen) for v in obj])
+    if hasattr(obj, '__dict__'):
+        return sum([object_nbytes(v, seen) for k, v in vars(obj).items() if k != 'parent'])
+    return 0
+
+class PrefixCacheEntry:
+    def __init__(self, parent: bytes, start: int, end: int, layers: list):
+        """
+        layers: list of (keys, values, state or None). keys and values are only for tokens [start, end)
+        """
+        self.parent = parent
+        self.start = start
+        self.end = end
+        self.layers = layers
+        self.nbytes = object_nbytes(layers)
+
+class PrefixCache:
+    def __init__(self, max_bytes: int = 1 << 30, block_size: int = None):
+        self.block_size = PREFIX_CACHE_BLOCK if block_size is None else block_size
+        assert self.block_size > 0
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.entries = OrderedDict() # type: OrderedDict[bytes, PrefixCacheEntry]
+
+        self.num_lookups = 0
+        self.num_lookup_tokens = 0
+        self.num_hit_tokens = 0
+
+    def block_hashes(self, input_ids: List[int], length: int):
+        """
+        chained hashes of blocks which are fully in input_ids[:length]
+        """
+        hashes = []
+        h = b''
+        for start in range(0, length - self.block_size + 1, self.block_size):
+            block = input_ids[start:start+self.block_size]
+            h = hashlib.blake2b(
+                h + b''.join([int(t).to_bytes(8, 'little', signed=True) for t in block]),
+                digest_size=16,
+            ).digest()
+            hashes.append(h)
+        return hashes
+
+    def touch(self, hashes: List[bytes]):
+        # NOTE: leaf first, so prefixes are more recent than their extensions
+        for h in reversed(hashes):
+            self.entries.move_to_end(h)
+
+    def evict(self):
+        while self.nbytes > self.max_bytes and len(self.entries) > 0:
+            _, entry = self.entries.popitem(last=False)
+            self.nbytes -= entry.nbytes
+
+    def lookup(self, input_ids: List[int]):
+        """
+        returns (length, past_key_values) of the longest cached prefix. past is independent from cache.
+        at least one token is left for prefill, because the request needs logits of the last token.
+        returns (0, None) on miss
+        """
+        self.num_lookups += 1
+        self.num_lookup_tokens += len(input_ids)
+        chain = []
+        for h in self.block_hashes(input_ids, len(input_ids) - 1):
+            if h not in self.entries:
+                break
+            chain.append(h)
+        if len(chain) == 0:
+            return 0, None
+        self.touch(chain)
+        entries = [self.entries[h] for h in chain]
+        length = entries[-1].end
+        self.num_hit_tokens += length
+
+        past_key_values = ()
+        for i in range(len(entries[0].layers)):
+            keys = torch.cat([entry.layers[i][0] for entry in entries], dim=2)
+            values = torch.cat([entry.layers[i][1] for entry in entries], dim=2)
+            cache = KVCache.from_states(keys, values)
+            layer_past = (cache.keys(), cache.values(), cache)
+            state = entries[-1].layers[i][2]
+            if state is not None:
+                layer_past += (state.fork(),)
+            past_key_values += (layer_past,)
+        return length, past_key_values
+
+    def insert(self, input_ids: List[int], past_key_values):
+        """
+        stores the last full block of input_ids. past_key_values should be the past right after
+        input_ids, and its length should be multiple of block_size. caller can keep decoding with past.
+        """
+        length = len(input_ids)
+        if length == 0 or length % self.block_size != 0:
+            return
+        if past_evicted_length(past_key_values[0]) > 0:
+            # NOTE: KV retention evicted tokens of the prefix
+            return
+        hashes = self.block_hashes(input_ids, length)
+        if hashes[-1] in self.entries:
+            self.touch(hashes)
+            return
+        if len(hashes) > 1 and hashes[-2] not in self.entries:
+            # NOTE: prefix was evicted, this block can not be looked up
+            return
+
+        start = length - self.block_size
+        layers = []
+        for layer_past in past_key_values:
+            keys, values, _, state = unpack_past_key_value(layer_past)
+            assert keys.shape[0] == 1, 'prefix cache stores a sequence'
+            assert keys.shape[2] == length
+            layers.append((
+                keys[:, :, start:length].clone(),
+                values[:, :, start:length].clone(),
+                state.fork() if state is not None else None,
+            ))
+        entry = PrefixCacheEntry(hashes[-2] if len(hashes) > 1 else None, start, length, layers)
+        self.entries[hashes[-1]] = entry
+        self.nbytes += entry.nbytes
+        self.touch(hashes)
+        self.evict()
+
+    def strify(self):
+        hit_rate = self.num_hit_tokens / max(self.num_lookup_tokens, 1)
+        return (
+            f"PrefixCache({len(self.entries)} blocks, {self.nbytes / 1024 / 1024:.1f}/{self.max_bytes / 1024 / 1024:.1f} MB, "
+            f"{self.num_lookups} lookups, token hit rate {hit_rate:.3f})"
+        )
+
+def test_lru(N=1, H=2, HID=4, LAYERS=2, B=4):
+    def fake_past(T):
+        return tuple(
+            (torch.randn((N, H, T, HID)), torch.randn((N, H, T, HID)))
+            for _ in range(LAYERS)
+        )
+    block_nbytes = LAYERS * 2 * N * H * B * HID * 4
+    cache = PrefixCache(max_bytes=block_nbytes * 3, block_size=B)
+
+    prompt = list(range(100, 100 + B * 3 + 1))
+    past = fake_past(len(prompt))
+    for end in range(B, len(prompt), B):
+        cache.insert(prompt[:end], tuple((k[:, :, :end], v[:, :, :end]) for k, v in past))
+    assert len(cache.entries) == 3 and cache.nbytes == block_nbytes * 3
+
+    length, restored = cache.lookup(prompt)
+    assert length == B * 3
+    for (k, v), layer_past in zip(past, restored):
+        assert torch.equal(layer_past[0], k[:, :, :length])
+        assert torch.equal(layer_past[1], v[:, :, :length])
+        assert isinstance(layer_past[2], KVCache)
+
+    # shares first block only
+    other = prompt[:B] + [7] * (B * 2 + 1)
+    assert cache.lookup(other)[0] == B
+    # last token is always prefilled
+    assert cache.lookup(prompt[:B * 2])[0] == B
+
+    # budget is full, leaf of prompt is evicted before prefixes
+    other_past = fake_past(len(other))
+    cache.insert(other[:B * 2], tuple((k[:, :, :B * 2], v[:, :, :B * 2]) for k, v in other_past))
+    assert len(cache.entries) == 3 and cache.nbytes <= cache.max_bytes
+    assert cache.lookup(prompt)[0] == B * 2
+    assert cache.lookup(other)[0] == B * 2
+    print('lru passed', cache.strify())
+
+def test_engine(method='perlin', B=16):
+    from ...utils import seed
+    from ...main.tests.tiny_opt import build_tiny_model
+    from .engine import GenerationEngine, GenerationRequest
+    seed()
+    model = build_tiny_model(method)
+    import random
+    rng = random.Random(42)
+    document = [rng.randint(4, model.config.vocab_size - 1) for _ in range(B * 4 + 3)]
+    def requests():
+        rng = random.Random(0)
+        return [
+            GenerationRequest(
+                input_ids=document[:rng.randint(B, len(document))] + [rng.randint(4, 100) for _ in range(rng.randint(1, 8))],
+                max_new_tokens=8,
+                request_id=i,
+            )
+            for i in range(8)
+        ]
+
+    outputs = []
+    for prefix_cache in [None, PrefixCache(block_size=B)]:
+        engine = GenerationEngine(model, max_batch_size=1, prefix_cache=prefix_cache)
+        reqs = requests()
+        for req in reqs:
+            engine.add_request(req)
+        while engine.has_work():
+            engine.step()
+        outputs.append([req.output_ids for req in reqs])
+        if prefix_cache is not None:
+            assert prefix_cache.num_hit_tokens > 0
+            print(f'[{method}]', prefix_cache.strify())
+    assert outputs[0] == outputs[1], outputs
+
+def test_main():
+    test_lru()
+    test_engine('none')
+    test_engine('perlin')
+
+if __name__ == '__main__':
+    test_main()
@@ -0,0 +1,345 @@
+"""
+On-disk snapshots of prefilled decoding sessions.
+
+A snapshot stores per-layer K/V and every PerlinAttentionState sub-state (performer cumsums,
+streaming CNN buffers or windows, cumulative averages) of a batch 1 session, so a long document
+is prefilled once and restored without running the model again.
+
+File layout:
+    MAGIC (8 bytes) | header length (uint64 LE) | header (JSON) | padding | tensors (64 bytes aligned)
+Header has format version, fingerprint of the model, structure of the session, and offsets of
+tensors. Restoring maps the file with mmap and tensors are views of the mapping, therefore
+loading is O(header) and pages are read lazily. The mapping is private, writes never reach the file.
+On cpu, K/V views are wrapped into KVCache without copy, the first decode step grows the cache.
+
+Fingerprint covers SNAPSHOT_VERSION, model class and config, PerlinAttentionConfig (except runtime
+toggles), attention methods, and full bytes of every parameter. Snapshots with other fingerprint are
+rejected, because states of other weights or configs silently give wrong outputs. Hashing reads all
+weights, so callers which load many snapshots should compute the fingerprint once.
+
+Usage: python -m src.models.perlin_opt.snapshot
+"""
+
+import os
+import json
+import mmap
+import struct
+import hashlib
+from typing import List
+
+import torch
+from torch import nn
+
+from .kv_cache import KVCache, unpack_past_key_value
+from ..perlin_attention.attention_state import (
+    PerlinAttentionState,
+    StatefulCausalPerformer,
+    StatefulCausalCNN,
+    StatefulCumAvg,
+)
+
+SNAPSHOT_VERSION = 1
+SNAPSHOT_MAGIC = b'SEASNAP\x00'
+SNAPSHOT_ALIGN = 64
+
+def snapshot_fingerprint(model: nn.Module):
+    from .perlin_opt import OPTAttention
+    from ..perlin_attention import get_default_config
+
+    attentions = [m for m in model.modules() if isinstance(m, OPTAttention)]
+    # NOTE: modules keep the config which was default when they were built
+    pconfig = (attentions[0].pconfig if len(attentions) > 0 else get_default_config()).to_json()
+    # NOTE: runtime toggles do not change states
+    for key in ['use_cache', 'compile']:
+        pconfig.pop(key, None)
+    methods = sorted(set([m.attention_method for m in attentions]))
+
+    h = hashlib.sha256()
+    h.update(json.dumps({
+        'version': SNAPSHOT_VERSION,
+        'model': type(model).__name__,
+        'config': model.config.to_dict() if hasattr(model, 'config') else None,
+        'perlin': pconfig,
+        'methods': methods,
+    }, sort_keys=True, default=str).encode())
+    with torch.no_grad():
+        for name, p in model.named_parameters():
+            h.update(name.encode())
+            h.update(str(tuple(p.shape)).encode())
+            # NOTE: fine-tuned weights usually keep shapes, so every element is hashed
+            h.update(p.detach().reshape(-1).cpu().contiguous().view(torch.uint8).numpy().tobytes())
+    return h.hexdigest()
+
+class SnapshotWriter:
+    def __init__(self, module_names: dict):
+        self.module_names = module_names
+        self.tensors = [] # type: List[torch.Tensor]
+
+    def tensor(self, t):
+        if not isinstance(t, torch.Tensor):
+            return t
+        self.tensors.append(t.detach())
+        return {'__tensor__': len(self.tensors) - 1}
+
+    def sub_state(self, sub):
+        if isinstance(sub, StatefulCumAvg):
+            return {
+                'type': 'cumavg',
+                'cumsum': self.tensor(sub.cumsum),
+                'prev_len': sub.prev_len,
+            }
+        elif isinstance(sub, StatefulCausalPerformer):
+            return {
+                'type': 'performer',
+                'seq_index': sub.seq_index,
+                'last_k_cumsum': self.tensor(sub.last_k_cumsum),
+                'last_context_cumsum': self.tensor(sub.last_context_cumsum),
+                'qs': [self.tensor(q) for q in sub.qs],
+            }
+        elif isinstance(sub, StatefulCausalCNN):
+            return {
+                'type': 'cnn',
+                'streaming': sub.streaming,
+                'window_size': sub.window_size,
+                'window_align': sub.window_align,
+                'xs': [self.tensor(x) for x in sub.xs],
+                'xs_len': sub.xs_len,
+                # NOTE: buffers are keyed by id of module, which is not valid in other process
+                'buffers': {self.module_names[key]: self.tensor(buf) for key, buf in sub.buffers.items()},
+            }
+        else:
+            raise Exception(f'snapshot of {type(sub)} is not supported')
+
+    def state(self, state: PerlinAttentionState):
+        if state is None:
+            return None
+        return {
+            'num_heads': state.num_heads,
+            'head_dim': state.head_dim,
+            'embd_dim': state.embd_dim,
+            'max_seq_length': state.max_seq_length,
+            'length': state.length,
+            'evicted': state.evicted,
+            'states': {name: self.sub_state(sub) for name, sub in state.states.items()},
+        }
+
+class SnapshotReader:
+    def __init__(self, tensors: List[torch.Tensor], modules: dict):
+        self.tensors = tensors
+        self.modules = modules
+
+    def tensor(self, t):
+        if isinstance(t, dict) and '__tensor__' in t:
+            return self.tensors[t['__tensor__']]
+        return t
+
+    def sub_state(self, parent: PerlinAttentionState, desc: dict):
+        if desc['type'] == 'cumavg':
+            sub = StatefulCumAvg(parent)
+            sub.cumsum = self.tensor(desc['cumsum'])
+            sub.prev_len = desc['prev_len']
+        elif desc['type'] == 'performer':
+            # NOTE: performer module is not used after the state is created
+            sub = StatefulCausalPerformer(parent, None)
+            sub.seq_index = desc['seq_index']
+            sub.last_k_cumsum = self.tensor(desc['last_k_cumsum'])
+            sub.last_context_cumsum = self.tensor(desc['last_context_cumsum'])
+            sub.qs = [self.tensor(q) for q in desc['qs']]
+        elif desc['type'] == 'cnn':
+            sub = StatefulCausalCNN(parent, None)
+            sub.streaming = desc['streaming']
+            sub.window_size = desc['window_size']
+            sub.window_align = desc['window_align']
+            sub.xs = [self.tensor(x) for x in desc['xs']]
+            sub.xs_len = desc['xs_len']
+            sub.buffers = {id(self.modules[name]): self.tensor(buf) for name, buf in desc['buffers'].items()}
+        else:
+            raise Exception(f'unknown state type {desc["type"]}')
+        return sub
+
+    def state(self, desc: dict):
+        if desc is None:
+            return None
+        state = PerlinAttentionState(None)
+        state.num_heads = desc['num_heads']
+        state.head_dim = desc['head_dim']
+        state.embd_dim = desc['embd_dim']
+        state.max_seq_length = desc['max_seq_length']
+        state.length = desc['length']
+        state.evicted = desc.get('evicted', 0)
+        state.states = {name: self.sub_state(state, sub) for name, sub in desc['states'].items()}
+        return state
+
+def save_snapshot(path: str, model: nn.Module, past_key_values, input_ids: List[int] = None):
+    """
+    past_key_values: past of a prefilled batch 1 session (from perlin_opt.OPTForCausalLM)
+    input_ids: tokens of the session, stored for callers to validate
+    """
+    writer = SnapshotWriter({id(m): name for name, m in model.named_modules()})
+    layers = []
+    for layer_past in past_key_values:
+        keys, values, cache, state = unpack_past_key_value(layer_past)
+        assert keys.shape[0] == 1, 'snapshot stores a session of batch size 1'
+        assert cache is None or cache.tier is None or cache.tier.num_blocks == 0, 'blocks in host tier are not stored'
+        layers.append({
+            'keys': writer.tensor(keys),
+            'values': writer.tensor(values),
+            'evicted': cache.evicted if cache is not None else 0,
+            'state': writer.state(state),
+        })
+
+    table = []
+    offset = 0
+    for t in writer.tensors:
+        nbytes = t.numel() * t.element_size()
+        table.append({
+            'dtype': str(t.dtype).split('.')[-1],
+            'shape': list(t.shape),
+            'offset': offset,
+            'nbytes': nbytes,
+        })
+        offset += (nbytes + SNAPSHOT_ALIGN - 1) // SNAPSHOT_ALIGN * SNAPSHOT_ALIGN
+    header = json.dumps({
+        'version': SNAPSHOT_VERSION,
+        'fingerprint': snapshot_fingerprint(model),
+        'length': past_key_values[0][0].shape[2],
+        'input_ids': list(input_ids) if input_ids is not None else None,
+        'layers': layers,
+        'tensors': table,
+    }).encode()
+
+    data_start = len(SNAPSHOT_MAGIC) + 8 + len(header)
+    data_start = (data_start + SNAPSHOT_ALIGN - 1) // SNAPSHOT_ALIGN * SNAPSHOT_ALIGN
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for t, desc in zip(writer.tensors, table):
+            f.seek(data_start + desc['offset'])
+            if desc['nbytes'] > 0:
+                f.write(t.contiguous().cpu().reshape(-1).view(torch.uint8).numpy().tobytes())
+        f.truncate(data_start + offset)
+    # NOTE: readers never see partially written snapshot
+    os.replace(tmp_path, path)
+
+def read_snapshot_header(path: str):
+    with open(path, 'rb') as f:
+        magic = f.read(len(SNAPSHOT_MAGIC))
+        if magic != SNAPSHOT_MAGIC:
+            raise Exception(f'{path} is not a snapshot')
+        header_len, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_len))
+    data_start = len(SNAPSHOT_MAGIC) + 8 + header_len
+    data_start = (data_start + SNAPSHOT_ALIGN - 1) // SNAPSHOT_ALIGN * SNAPSHOT_ALIGN
+    return header, data_start
+
+def load_snapshot(path: str, model: nn.Module, device: torch.device = None, fingerprint: str = None):
+    """
+    returns (past_key_values, input_ids). raises if the snapshot is written by other version, model or config.
+    fingerprint: `snapshot_fingerprint(model)`, pass it to skip recomputing for every load
+    """
+    header, data_start = read_snapshot_header(path)
+    if header['version'] != SNAPSHOT_VERSION:
+        raise Exception(f'snapshot version {header["version"]} is not supported (current {SNAPSHOT_VERSION})')
+    fingerprint = snapshot_fingerprint(model) if fingerprint is None else fingerprint
+    if header['fingerprint'] != fingerprint:
+        raise Exception(f'stale snapshot {path}, it is written by other model or PerlinAttentionConfig')
+    device = torch.device('cpu') if device is None else torch.device(device)
+
+    tensors = []
+    with open(path, 'rb') as f:
+        # NOTE: private mapping, the file is never modified. tensors keep the mapping alive.
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    for desc in header['tensors']:
+        dtype = getattr(torch, desc['dtype'])
+        if desc['nbytes'] == 0:
+            t = torch.empty(desc['shape'], dtype=dtype)
+        else:
+            t = torch.frombuffer(
+                mm, dtype=torch.uint8, count=desc['nbytes'], offset=data_start + desc['offset']
+            ).view(dtype).view(desc['shape'])
+        tensors.append(t if device.type == 'cpu' else t.to(device, non_blocking=True))
+
+    reader = SnapshotReader(tensors, dict(model.named_modules()))
+    past_key_values = ()
+    for layer in header['layers']:
+        keys = reader.tensor(layer['keys'])
+        values = reader.tensor(layer['values'])
+        cache = KVCache.from_storage(keys, values)
+        cache.evicted = layer.get('evicted', 0)
+        layer_past = (cache.keys(), cache.values(), cache)
+        state = reader.state(layer['state'])
+        if state is not None:
+            layer_past += (state,)
+        past_key_values += (layer_past,)
+    return past_key_values, header['input_ids']
+
+def test_config(method='perlin', T=300, T_DECODE=16, path='./cache/perlin_opt/snapshot_test.bin'):
+    import time
+    from ...utils import seed
+    from ...main.tests.tiny_opt import build_tiny_model
+    seed()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    model = build_tiny_model(method)
+    input_ids = torch.randint(4, model.config.vocab_size, (1, T))
+    continuation = torch.randint(4, model.config.vocab_size, (1, T_DECODE))
+
+    def decode(past_key_values):
+        logits = []
+        for i in range(T_DECODE):
+            output = model(input_ids=continuation[:, i:i+1], past_key_values=past_key_values, use_cache=True)
+            past_key_values = output.past_key_values
+            logits.append(output.logits)
+        return torch.cat(logits, dim=1)
+
+    with torch.no_grad():
+        t = time.time()
+        output = model(input_ids=input_ids, use_cache=True)
+        elapsed_prefill = time.time() - t
+        save_snapshot(path, model, output.past_key_values, input_ids=input_ids[0].tolist())
+        truth = decode(output.past_key_values)
+
+        fingerprint = snapshot_fingerprint(model)
+        t = time.time()
+        past_key_values, restored_ids = load_snapshot(path, model, fingerprint=fingerprint)
+        elapsed_restore = time.time() - t
+        assert restored_ids == input_ids[0].tolist()
+        restored = decode(past_key_values)
+    assert torch.allclose(restored, truth, atol=1e-5), (restored - truth).abs().max()
+    print(f'[{method}] prefill {elapsed_prefill*1000:.2f} ms, restore {elapsed_restore*1000:.2f} ms, {os.path.getsize(path) / 1024:.1f} KB')
+
+    def assert_rejected():
+        rejected = False
+        try:
+            load_snapshot(path, model)
+        except Exception as ex:
+            assert 'stale' in str(ex), ex
+            rejected = True
+        assert rejected, 'stale snapshot should be rejected'
+
+    # snapshot of other config is rejected
+    pconfig = [m for m in model.modules() if hasattr(m, 'pconfig')][0].pconfig
+    pconfig.k = pconfig.k + 1
+    try:
+        assert_rejected()
+    finally:
+        pconfig.k = pconfig.k - 1
+
+    # snapshot of other weights with same shapes is rejected
+    with torch.no_grad():
+        p = model.lm_head.weight.view(-1)
+        original = p[-1].item()
+        p[-1] += 1.0
+        try:
+            assert_rejected()
+        finally:
+            p[-1] = original
+    os.remove(path)
+
+def test_main():
+    test_config('none')
+    test_config('perlin')
+
+if __name__ == '__main__':
+    test_main()
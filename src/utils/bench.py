@@ -7,6 +7,8 @@ def bench(name, fn, t_warmup, t_sample, timeunit='ms', tracetree=False):
     sample_count = 0
     bench_sync = get_bench().synchronize
     bench_disabled = get_bench().disabled
+    if not torch.cuda.is_available():
+        return bench_cpu(name, fn, t_warmup, t_sample, timeunit=timeunit)
     
     try:
         torch.cuda.synchronize()
@@ -68,3 +70,44 @@ def bench(name, fn, t_warmup, t_sample, timeunit='ms', tracetree=False):
         get_bench().synchronize = bench_sync
         get_bench().disabled = bench_disabled
     return interval, mem
+
+
+def bench_cpu(name, fn, t_warmup, t_sample, timeunit='ms'):
+    """
+    wall clock version of bench, for hosts without cuda. memory and tracetree are not measured.
+    """
+    sample_count = 0
+    
+    print(f'[{name}] warmup... ', end = '', flush=True)
+    t = time.time()
+    while True:
+        with torch.no_grad():
+            fn()
+        if time.time() - t > t_warmup:
+            break
+    gc.collect()
+    print('benchmarking', end = '', flush=True)
+    elapsed = 0
+    t = time.time()
+    last_report = time.time()
+    while True:
+        start = time.perf_counter()
+        with torch.no_grad():
+            fn()
+        elapsed += time.perf_counter() - start
+        
+        sample_count += 1
+        if time.time() - t > t_sample:
+            break
+        if time.time() - last_report > 0.5:
+            last_report = time.time()
+            print('.', end='', flush=True)
+    mem = 0
+    interval = elapsed/(sample_count + 1e-8)
+    if timeunit == 'ms':
+        print(f' done. sampled {sample_count}its. {interval*1000:.2f}ms/it', flush=True)
+    elif timeunit == 'us':
+        print(f' done. sampled {sample_count}its. {interval*1000*1000:.2f}us/it', flush=True)
+    else:
+        raise Exception()
+    return interval, mem